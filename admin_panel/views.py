@@ -16,6 +16,7 @@ from coupons.models import (
     SEO, HomePageSEO, Tag, DealHighlight, DealSection
 )
 from analytics.models import PageView, Event, OfferAnalytics, StoreAnalytics, CategoryAnalytics
+from analytics.counters import counter_engine
 from .forms import (
     OfferForm, StoreForm, CategoryForm, UserForm, NewsletterForm, 
     TagForm, SEOForm, HomePageSEOForm, DealSectionForm, DealHighlightForm
@@ -353,6 +354,7 @@ def offer_detail(request, slug):
     # Get analytics data if available
     try:
         analytics = OfferAnalytics.objects.get(offer=offer)
+        counter_engine.merge('offer', [analytics])
     except OfferAnalytics.DoesNotExist:
         analytics = None
     
@@ -0,0 +1,77 @@
+"""
+User activity.
+
+Page views are not copied into UserActivity any more: a signed-in user's
+page view activity is read from PageView (and the UserPageViewDaily
+rollup) when it is needed. UserActivity only holds semantic actions such
+as saving or using an offer and subscribing, queued through the
+ingestion buffer like page views.
+
+active_users() combines both into the rows the "most active users"
+tables have always used.
+"""
+from django.contrib.auth.models import User
+from django.db.models import Count
+from django.utils import timezone
+
+from .buffer import page_view_buffer
+from .models import UserActivity
+from .rollups import _day_start, user_page_view_counts
+
+# Rows written by the middleware before activity was derived from PageView;
+# they duplicate page views and are left out of activity counts
+LEGACY_PAGE_VIEW_ACTIVITY = 'page_view'
+
+
+def record_user_activity(request, activity_type, description='', **data):
+    """Queue a semantic action for the signed-in user of `request`."""
+    if not request.user.is_authenticated:
+        return
+    page_view_buffer.record_activity(
+        user_id=request.user.pk,
+        session_id=getattr(request, 'analytics_session_id', ''),
+        activity_type=activity_type,
+        description=description,
+        data=data,
+        timestamp=timezone.now(),
+    )
+
+
+def action_counts(start_day):
+    """Semantic actions per user since start_day, keyed by user id."""
+    rows = (
+        UserActivity.objects.filter(timestamp__gte=_day_start(start_day))
+        .exclude(activity_type=LEGACY_PAGE_VIEW_ACTIVITY)
+        .values_list('user_id')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    return dict(rows)
+
+
+def active_users(start_day, limit=None):
+    """
+    Users ranked by activity (page views plus semantic actions) since
+    start_day, as dicts with the keys the old UserActivity aggregate had:
+    user__id, user__username and activity_count, plus the page_views and
+    actions it is made of.
+    """
+    page_views = user_page_view_counts(start_day)
+    actions = action_counts(start_day)
+
+    totals = page_views.copy()
+    totals.update(actions)
+    ranked = totals.most_common(limit)
+    usernames = dict(User.objects.filter(pk__in=[user_id for user_id, _ in ranked]).values_list('pk', 'username'))
+
+    return [
+        {
+            'user__id': user_id,
+            'user__username': usernames.get(user_id, ''),
+            'activity_count': count,
+            'page_views': page_views.get(user_id, 0),
+            'actions': actions.get(user_id, 0),
+        }
+        for user_id, count in ranked
+        if user_id in usernames
+    ]
@@ -0,0 +1,103 @@
+"""
+Retention for the raw analytics tables.
+
+Rows older than the retention window are written to gzip NDJSON files
+partitioned by table and day, e.g.
+
+    <ARCHIVE_DIR>/page_views/2026-01-31/part-000000123001-000000128000.ndjson.gz
+
+and then deleted, one bounded chunk at a time. Page views and events are
+only archived once they have been folded into the daily rollups, which
+stay the source of truth for historical dashboards. Archived page views
+keep their route/referer/user agent ids; the dimension tables are never
+pruned, so the ids stay resolvable.
+"""
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Event, PageView, UserActivity
+from .rollups import EVENT_WATERMARK, PAGE_VIEW_WATERMARK, _day_start, get_watermark
+
+# Archive name -> (model, rollup watermark that must cover the rows)
+ARCHIVE_TABLES = {
+    'page_views': (PageView, PAGE_VIEW_WATERMARK),
+    'events': (Event, EVENT_WATERMARK),
+    'user_activity': (UserActivity, None),
+}
+
+DEFAULT_ARCHIVE_SETTINGS = {
+    'DIR': os.path.join(settings.BASE_DIR, 'analytics_archive'),
+    'RETENTION_DAYS': 90,
+}
+
+
+def get_archive_settings():
+    conf = dict(DEFAULT_ARCHIVE_SETTINGS)
+    conf.update(getattr(settings, 'ANALYTICS_ARCHIVE', {}))
+    return conf
+
+
+def retention_cutoff(days):
+    """Rows before the start of this day are archived."""
+    return _day_start(timezone.localdate() - timedelta(days=days))
+
+
+def archivable(name, cutoff):
+    model, watermark = ARCHIVE_TABLES[name]
+    queryset = model.objects.filter(timestamp__lt=cutoff)
+    if watermark:
+        queryset = queryset.filter(id__lte=get_watermark(watermark))
+    return queryset
+
+
+def _write_partition(directory, rows):
+    os.makedirs(directory, exist_ok=True)
+    # Named by id range, so re-archiving a chunk after an interrupted run
+    # replaces the file instead of duplicating rows
+    name = f"part-{rows[0]['id']:012d}-{rows[-1]['id']:012d}.ndjson.gz"
+    path = os.path.join(directory, name)
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, cls=DjangoJSONEncoder))
+            f.write('\n')
+    os.replace(tmp_path, path)
+    return path
+
+
+def archive_table(name, cutoff, output_dir, chunk_size=5000):
+    """
+    Archive and delete the rows of one table older than cutoff.
+
+    Works through the table in id order, one chunk per iteration: the
+    chunk's partition files are written (atomically, via a temp file)
+    before its rows are deleted in a short transaction. Stopping at any
+    point is safe; the next run picks up from the oldest remaining row.
+    Yields the number of rows archived per chunk.
+    """
+    model = ARCHIVE_TABLES[name][0]
+    queryset = archivable(name, cutoff)
+
+    while True:
+        rows = list(queryset.order_by('id').values()[:chunk_size])
+        if not rows:
+            return
+
+        by_day = defaultdict(list)
+        for row in rows:
+            by_day[timezone.localtime(row['timestamp']).date()].append(row)
+        for day, day_rows in sorted(by_day.items()):
+            _write_partition(os.path.join(output_dir, name, day.isoformat()), day_rows)
+
+        with transaction.atomic():
+            model.objects.filter(id__in=[row['id'] for row in rows]).delete()
+
+        yield len(rows)
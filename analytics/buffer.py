@@ -0,0 +1,281 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import DateTimeField, DurationField, ExpressionWrapper, F, Value
+from django.utils import timezone
+
+from .counters import counter_engine
+from .geoip import geoip_resolver
+from .live import live_feed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SETTINGS = {
+    'ASYNC': True,              # Flush from a background thread; False writes inline
+    'FLUSH_INTERVAL_MS': 500,   # Flush at least this often...
+    'MAX_ROWS': 200,            # ...or as soon as this many items are queued
+    'MAX_QUEUE_SIZE': 10000,    # Items beyond this are dropped instead of blocking requests
+}
+
+
+# Guards resetting the buffer in a forked worker
+_fork_lock = threading.Lock()
+
+
+def get_buffer_settings():
+    conf = dict(DEFAULT_BUFFER_SETTINGS)
+    conf.update(getattr(settings, 'ANALYTICS_BUFFER', {}))
+    return conf
+
+
+class PageViewBuffer:
+    """
+    In-process write-behind buffer for request tracking.
+
+    The middleware only enqueues plain dicts; page views, session touches
+    and user activity rows are written in bulk by a background thread every
+    FLUSH_INTERVAL_MS or MAX_ROWS items, and drained on interpreter exit.
+    The same thread flushes the analytics counter engine and publishes the
+    live feed.
+    """
+
+    def __init__(self):
+        self._atexit_registered = False
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._queue = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.dropped = 0
+        self.flushed = 0
+
+    def _check_pid(self):
+        # A forked worker inherits the parent's queued items (the parent
+        # writes those), locks another thread may have held, and no flusher
+        # thread; like TwoTierCache's per-process state it starts over
+        if self._pid == os.getpid():
+            return
+        with _fork_lock:
+            if self._pid != os.getpid():
+                self._reset()
+
+    @property
+    def conf(self):
+        return get_buffer_settings()
+
+    def stats(self):
+        return {
+            'queued': self.qsize(),
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+        }
+
+    def _get_queue(self):
+        self._check_pid()
+        if self._queue is None:
+            with self._lock:
+                if self._queue is None:
+                    self._queue = queue.Queue(maxsize=self.conf['MAX_QUEUE_SIZE'])
+        return self._queue
+
+    def qsize(self):
+        return self._get_queue().qsize()
+
+    # Producers (called from the request path)
+
+    def record_page_view(self, **fields):
+        self._put('page_view', fields)
+
+    def record_activity(self, **fields):
+        self._put('activity', fields)
+
+    def touch_session(self, session_id, user_id=None, start_time=None, last_activity=None, hits=1):
+        last_activity = last_activity or timezone.now()
+        self._put('session', {
+            'session_id': session_id,
+            'user_id': user_id,
+            'start_time': start_time or last_activity,
+            'last_activity': last_activity,
+            'hits': hits,
+        })
+
+    def _put(self, kind, payload):
+        conf = self.conf
+        try:
+            self._get_queue().put_nowait((kind, payload))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning('Analytics buffer full, %s items dropped so far', self.dropped)
+            return
+
+        if not conf['ASYNC']:
+            self.flush()
+            return
+
+        self.ensure_started()
+        if self.qsize() >= conf['MAX_ROWS']:
+            self._wakeup.set()
+
+    # Background flusher
+
+    def ensure_started(self):
+        self._check_pid()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='analytics-buffer', daemon=True
+            )
+            self._thread.start()
+            if not self._atexit_registered:
+                atexit.register(self.shutdown)
+                self._atexit_registered = True
+
+    def _run(self):
+        from .sessions import session_tracker  # Imports this module
+
+        interval = self.conf['FLUSH_INTERVAL_MS'] / 1000.0
+        while not self._stopping.is_set():
+            self._wakeup.wait(interval)
+            self._wakeup.clear()
+            try:
+                session_tracker.flush_idle()
+                self.flush()
+                counter_engine.flush()
+            except Exception:
+                logger.exception('Analytics buffer flush failed')
+            finally:
+                # Push this process's live deltas once per live feed interval
+                live_feed.publish()
+                close_old_connections()
+
+    def shutdown(self, timeout=5):
+        """Stop the flusher thread and write whatever is still queued."""
+        from .sessions import session_tracker
+
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        try:
+            session_tracker.flush_idle(force=True)
+            self.flush()
+            counter_engine.flush()
+        except Exception:
+            logger.exception('Analytics buffer drain failed')
+
+    # Writing
+
+    def _drain(self):
+        items = []
+        q = self._get_queue()
+        while True:
+            try:
+                items.append(q.get_nowait())
+            except queue.Empty:
+                return items
+
+    def flush(self):
+        with self._flush_lock:
+            items = self._drain()
+            if not items:
+                return 0
+            self._write(items)
+            self.flushed += len(items)
+            return len(items)
+
+    def _write(self, items):
+        from .dimensions import build_page_views
+        from .models import PageView, UserActivity
+
+        page_views = []
+        activities = []
+        sessions = {}
+
+        for kind, payload in items:
+            if kind == 'page_view':
+                page_views.append(payload)
+            elif kind == 'activity':
+                activities.append(UserActivity(**payload))
+            elif kind == 'session':
+                touch = sessions.setdefault(payload['session_id'], {
+                    'user_id': payload['user_id'],
+                    'start_time': payload['start_time'],
+                    'last_activity': payload['last_activity'],
+                    'hits': 0,
+                })
+                touch['hits'] += payload['hits']
+                touch['start_time'] = min(touch['start_time'], payload['start_time'])
+                touch['last_activity'] = max(touch['last_activity'], payload['last_activity'])
+                if payload['user_id']:
+                    touch['user_id'] = payload['user_id']
+
+        # Route, referer domain and user agent ids for the whole batch
+        if page_views:
+            page_views = build_page_views(page_views)
+
+        # One lookup per IP prefix for the whole batch, outside the transaction
+        geoip_resolver.enrich(page_views)
+
+        with transaction.atomic():
+            if sessions:
+                self._write_sessions(sessions)
+            if page_views:
+                PageView.objects.bulk_create(page_views, batch_size=500)
+            if activities:
+                UserActivity.objects.bulk_create(activities, batch_size=500)
+
+    def _write_sessions(self, sessions):
+        from .models import Session
+
+        existing = set(
+            Session.objects.filter(session_id__in=list(sessions)).values_list('session_id', flat=True)
+        )
+
+        # Duration is derived from the activity being flushed, since nothing
+        # else ever closes a session
+        new_sessions = [
+            Session(
+                session_id=session_id,
+                user_id=touch['user_id'],
+                start_time=touch['start_time'],
+                last_activity=touch['last_activity'],
+                page_views=touch['hits'],
+                duration=touch['last_activity'] - touch['start_time'],
+            )
+            for session_id, touch in sessions.items()
+            if session_id not in existing
+        ]
+        if new_sessions:
+            Session.objects.bulk_create(new_sessions, ignore_conflicts=True)
+
+        for session_id in existing:
+            touch = sessions[session_id]
+            updates = {
+                'last_activity': touch['last_activity'],
+                'page_views': F('page_views') + touch['hits'],
+                'duration': ExpressionWrapper(
+                    Value(touch['last_activity'], output_field=DateTimeField()) - F('start_time'),
+                    output_field=DurationField(),
+                ),
+            }
+            if touch['user_id']:
+                updates['user_id'] = touch['user_id']
+            Session.objects.filter(session_id=session_id).update(**updates)
+
+
+page_view_buffer = PageViewBuffer()
@@ -0,0 +1,36 @@
+import asyncio
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .live import LIVE_GROUP, get_live_settings, live_feed
+
+
+class LiveFeedConsumer(AsyncJsonWebsocketConsumer):
+    """Pushes live analytics deltas to staff dashboards."""
+
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated or not user.is_staff:
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(LIVE_GROUP, self.channel_name)
+        await self.accept()
+        await self.send_json({'type': 'hello', 'interval': get_live_settings()['INTERVAL']})
+        self.ticker = asyncio.ensure_future(self.tick())
+
+    async def disconnect(self, code):
+        ticker = getattr(self, 'ticker', None)
+        if ticker:
+            ticker.cancel()
+        await self.channel_layer.group_discard(LIVE_GROUP, self.channel_name)
+
+    async def tick(self):
+        # Flush this process's deltas even when no requests come in
+        interval = get_live_settings()['INTERVAL']
+        while True:
+            await asyncio.sleep(interval)
+            await live_feed.apublish()
+
+    async def analytics_update(self, event):
+        await self.send_json({'type': 'update', **event['data']})
@@ -0,0 +1,77 @@
+"""
+Request-scoped analytics context.
+
+Detail views register the object they rendered with track_object() so
+AnalyticsMiddleware can count the view without re-parsing the path and
+re-fetching the object by slug.
+"""
+
+# URL name -> (counter kind, URL kwarg holding the slug)
+TRACKED_URL_NAMES = {
+    'deal_detail': ('offer', 'slug'),
+    'store_detail': ('store', 'store_slug'),
+    'category_detail': ('category', 'category_slug'),
+}
+
+# Responses that count as a view of the tracked object: plain renders, and
+# the 410 page of an expired offer. analytics.reconcile recounts the same
+COUNTED_STATUS_CODES = (200, 410)
+
+# Model name -> counter kind
+TRACKED_MODELS = {
+    'coupon': 'offer',
+    'store': 'store',
+    'category': 'category',
+}
+
+
+def track_object(request, obj):
+    """Register the primary object a view rendered for this request."""
+    request.analytics_object = obj
+
+
+def get_tracked_object(request):
+    return getattr(request, 'analytics_object', None)
+
+
+def track_target(request, kind, object_id):
+    """Register the counter target directly, e.g. for a page served from a cache."""
+    request.analytics_target = (kind, object_id)
+
+
+def get_tracked_target(request):
+    """(kind, object_id) registered for this request, or None. Never queries."""
+    target = getattr(request, 'analytics_target', None)
+    if target is not None:
+        return target
+    obj = get_tracked_object(request)
+    if obj is not None:
+        kind = TRACKED_MODELS.get(obj._meta.model_name)
+        return (kind, obj.pk) if kind else None
+    return None
+
+
+def resolve_tracked_target(request):
+    """
+    Return (kind, object_id) for the object this request displayed, or None.
+
+    Uses the object or target registered for the request when there is
+    one; otherwise falls back to one slug lookup based on
+    request.resolver_match.
+    """
+    if get_tracked_object(request) is not None or hasattr(request, 'analytics_target'):
+        return get_tracked_target(request)
+
+    match = getattr(request, 'resolver_match', None)
+    if match is None or match.url_name not in TRACKED_URL_NAMES:
+        return None
+
+    kind, slug_kwarg = TRACKED_URL_NAMES[match.url_name]
+    slug = match.kwargs.get(slug_kwarg)
+    if not slug:
+        return None
+
+    from coupons.models import Coupon, Store, Category
+    model = {'offer': Coupon, 'store': Store, 'category': Category}[kind]
+    object_id = model.objects.filter(slug=slug).values_list('pk', flat=True).first()
+    return (kind, object_id) if object_id else None
@@ -0,0 +1,178 @@
+import logging
+import threading
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# kind -> (model name in this app, FK attname, counter fields)
+COUNTER_MODELS = {
+    'offer': ('OfferAnalytics', 'offer_id', ('views', 'saves', 'code_copies', 'uses')),
+    'store': ('StoreAnalytics', 'store_id', ('views', 'offer_clicks')),
+    'category': ('CategoryAnalytics', 'category_id', ('views', 'offer_clicks')),
+}
+
+# kind -> per-day model that receives the same deltas, keyed by flush date
+DAILY_COUNTER_MODELS = {
+    'store': 'StoreDaily',
+    'category': 'CategoryDaily',
+}
+
+
+class CounterEngine:
+    """
+    Write-behind counters for the Offer/Store/CategoryAnalytics tables
+    (and the per-day StoreDaily/CategoryDaily tables).
+
+    Increments are accumulated in process memory keyed by
+    (kind, object id, field) and written by flush() as one
+    ``UPDATE ... SET field = field + delta`` per object, so concurrent
+    workers never lose updates. flush() runs on the analytics buffer's
+    background thread; pending() and merge() let readers add deltas that
+    have not reached the database yet.
+    """
+
+    def __init__(self):
+        self._deltas = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def incr(self, kind, object_id, field, delta=1):
+        if kind not in COUNTER_MODELS:
+            raise ValueError(f'Unknown analytics counter kind: {kind}')
+        if field not in COUNTER_MODELS[kind][2]:
+            raise ValueError(f'Unknown {kind} counter field: {field}')
+        if not object_id or not delta:
+            return
+
+        with self._lock:
+            self._deltas[(kind, object_id, field)] += delta
+
+        if kind == 'offer':
+            from .live import live_feed
+            live_feed.record_offer(object_id, delta)
+
+        from .buffer import get_buffer_settings, page_view_buffer
+        if get_buffer_settings()['ASYNC']:
+            page_view_buffer.ensure_started()
+        else:
+            self.flush()
+
+    def pending(self, kind, object_id):
+        """Unflushed deltas for one object, as {field: delta}."""
+        with self._lock:
+            return {
+                field: delta
+                for (k, oid, field), delta in self._deltas.items()
+                if k == kind and oid == object_id
+            }
+
+    def merge(self, kind, rows, id_attr=None):
+        """
+        Add unflushed deltas to already-loaded rows (model instances or
+        dicts from .values()) in place, and return them.
+        """
+        id_attr = id_attr or COUNTER_MODELS[kind][1]
+        with self._lock:
+            if not self._deltas:
+                return rows
+            by_object = defaultdict(dict)
+            for (k, oid, field), delta in self._deltas.items():
+                if k == kind:
+                    by_object[oid][field] = delta
+
+        for row in rows:
+            if isinstance(row, dict):
+                deltas = by_object.get(row.get(id_attr), {})
+                for field, delta in deltas.items():
+                    if field in row:
+                        row[field] = (row[field] or 0) + delta
+            else:
+                deltas = by_object.get(getattr(row, id_attr, None), {})
+                for field, delta in deltas.items():
+                    setattr(row, field, (getattr(row, field) or 0) + delta)
+        return rows
+
+    def get_counts(self, kind, object_id):
+        """Stored counters for one object with pending deltas applied."""
+        model_name, fk_attname, fields = COUNTER_MODELS[kind]
+        model = _get_model(model_name)
+        counts = model.objects.filter(**{fk_attname: object_id}).values(*fields).first()
+        counts = counts or {field: 0 for field in fields}
+        for field, delta in self.pending(kind, object_id).items():
+            counts[field] += delta
+        return counts
+
+    def flush(self):
+        with self._lock:
+            if not self._deltas:
+                return 0
+            deltas, self._deltas = self._deltas, defaultdict(int)
+
+        grouped = defaultdict(dict)
+        for (kind, object_id, field), delta in deltas.items():
+            grouped[(kind, object_id)][field] = delta
+
+        now = timezone.now()
+        written = 0
+        for (kind, object_id), fields in grouped.items():
+            try:
+                self._write(kind, object_id, fields, now)
+                written += 1
+            except IntegrityError:
+                if _target_exists(kind, object_id):
+                    logger.warning('Conflict flushing %s counters for %s, retrying next flush', kind, object_id)
+                    self._restore(kind, object_id, fields)
+                # Otherwise the object was deleted before its counters were flushed
+            except Exception:
+                logger.exception('Failed to flush %s counters for %s', kind, object_id)
+                self._restore(kind, object_id, fields)
+        return written
+
+    def _write(self, kind, object_id, fields, now):
+        model_name, fk_attname, _ = COUNTER_MODELS[kind]
+        model = _get_model(model_name)
+
+        extra = {'last_viewed': now} if 'views' in fields else {}
+        with transaction.atomic():
+            _upsert(model, {fk_attname: object_id}, fields, extra)
+            if kind in DAILY_COUNTER_MODELS:
+                daily = _get_model(DAILY_COUNTER_MODELS[kind])
+                _upsert(daily, {'date': timezone.localdate(now), fk_attname: object_id}, fields)
+
+    def _restore(self, kind, object_id, fields):
+        with self._lock:
+            for field, delta in fields.items():
+                self._deltas[(kind, object_id, field)] += delta
+
+
+def _upsert(model, key, fields, extra=None):
+    """Add `fields` deltas to the row matching `key`, creating it if needed."""
+    extra = extra or {}
+    updates = {field: F(field) + delta for field, delta in fields.items()}
+    if model.objects.filter(**key).update(**updates, **extra):
+        return
+    try:
+        # Savepoint, so losing the race below keeps the caller's transaction
+        with transaction.atomic():
+            model.objects.create(**key, **fields, **extra)
+    except IntegrityError:
+        # Another worker created the row since the UPDATE, add to it instead
+        if not model.objects.filter(**key).update(**updates, **extra):
+            raise
+
+
+def _target_exists(kind, object_id):
+    model_name, fk_attname, _ = COUNTER_MODELS[kind]
+    field = _get_model(model_name)._meta.get_field(fk_attname.removesuffix('_id'))
+    return field.related_model.objects.filter(pk=object_id).exists()
+
+
+def _get_model(model_name):
+    from django.apps import apps
+    return apps.get_model('analytics', model_name)
+
+
+counter_engine = CounterEngine()
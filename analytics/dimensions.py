@@ -0,0 +1,179 @@
+"""
+Dictionary encoding of PageView strings.
+
+Routes, referer domains and user agents are stored once in their own
+tables and PageView rows only carry the integer ids. The ingestion
+buffer resolves a whole batch at a time through a bounded per-process
+cache: unseen values cost one SELECT per dimension per batch (plus one
+INSERT for values that are new to the table), everything else is a dict
+lookup. User agents are parsed once, when their row is created.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import transaction
+
+from .ua import user_agent_cache
+
+DEFAULT_DIMENSION_CACHE_SETTINGS = {
+    'MAX_SIZE': 20000,  # Ids kept in memory per dimension
+}
+
+
+def get_dimension_cache_settings():
+    conf = dict(DEFAULT_DIMENSION_CACHE_SETTINGS)
+    conf.update(getattr(settings, 'ANALYTICS_DIMENSION_CACHE', {}))
+    return conf
+
+
+def normalize_path(path):
+    return (path or '/')[:255]
+
+
+def referer_domain(referer):
+    """Lower-cased host name of a referer URL, '' when there is none."""
+    if not referer:
+        return ''
+    try:
+        host = urlsplit(referer).hostname or ''
+    except ValueError:
+        return ''
+    return host[:255]
+
+
+def user_agent_hash(user_agent):
+    return hashlib.sha1(user_agent.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class DimensionCache:
+    """Bounded LRU map from a dimension's natural key to its row id."""
+
+    def __init__(self, model_name, key_field, build, max_size=None):
+        self.model_name = model_name
+        self.key_field = key_field
+        self.build = build
+        self.max_size = max_size or get_dimension_cache_settings()['MAX_SIZE']
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def model(self):
+        from django.apps import apps
+        return apps.get_model('analytics', self.model_name)
+
+    def resolve(self, values):
+        """
+        Ids for {key: source value}, creating rows for keys not in the
+        table yet. Returns {key: id}.
+        """
+        ids = {}
+        with self._lock:
+            for key in values:
+                row_id = self._ids.get(key)
+                if row_id is not None:
+                    self._ids.move_to_end(key)
+                    ids[key] = row_id
+            self.hits += len(ids)
+            self.misses += len(values) - len(ids)
+
+        missing = [key for key in values if key not in ids]
+        if missing:
+            model = self.model
+            lookup = f'{self.key_field}__in'
+            found = dict(model.objects.filter(**{lookup: missing}).values_list(self.key_field, 'id'))
+            new = [key for key in missing if key not in found]
+            if new:
+                # Another process may insert the same keys concurrently
+                model.objects.bulk_create([self.build(key, values[key]) for key in new], ignore_conflicts=True)
+                found.update(model.objects.filter(**{lookup: new}).values_list(self.key_field, 'id'))
+            ids.update(found)
+            # Rows created in a transaction that rolls back are gone again,
+            # so their ids are only remembered once it commits (at once
+            # outside of one)
+            transaction.on_commit(lambda: self._remember(found))
+        return ids
+
+    def _remember(self, found):
+        with self._lock:
+            for key, row_id in found.items():
+                self._ids[key] = row_id
+                self._ids.move_to_end(key)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._ids),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self.hits = self.misses = 0
+
+
+def _build_route(path, _):
+    from .models import Route
+    return Route(path=path)
+
+
+def _build_referer_domain(domain, _):
+    from .models import RefererDomain
+    return RefererDomain(domain=domain)
+
+
+def _build_user_agent(key, user_agent):
+    from .models import UserAgent
+    return UserAgent(hash=key, user_agent=user_agent, **user_agent_cache.parse(user_agent)._asdict())
+
+
+route_ids = DimensionCache('Route', 'path', _build_route)
+referer_domain_ids = DimensionCache('RefererDomain', 'domain', _build_referer_domain)
+user_agent_ids = DimensionCache('UserAgent', 'hash', _build_user_agent)
+
+
+def build_page_views(payloads):
+    """
+    Unsaved PageView objects for buffered page view payloads, which carry
+    the raw path, referer and user_agent strings.
+    """
+    from .models import PageView
+
+    rows = []
+    paths, domains, agents = {}, {}, {}
+    for payload in payloads:
+        payload = dict(payload)
+        path = normalize_path(payload.pop('path', ''))
+        domain = referer_domain(payload.pop('referer', ''))
+        user_agent = payload.pop('user_agent', '')
+        agent_key = user_agent_hash(user_agent) if user_agent else None
+
+        paths[path] = path
+        if domain:
+            domains[domain] = domain
+        if agent_key:
+            agents[agent_key] = user_agent
+        rows.append((payload, path, domain, agent_key))
+
+    path_ids = route_ids.resolve(paths)
+    domain_ids = referer_domain_ids.resolve(domains) if domains else {}
+    agent_ids = user_agent_ids.resolve(agents) if agents else {}
+
+    return [
+        PageView(
+            route_id=path_ids[path],
+            referer_domain_id=domain_ids.get(domain),
+            user_agent_id=agent_ids.get(agent_key),
+            **payload,
+        )
+        for payload, path, domain, agent_key in rows
+    ]
@@ -0,0 +1,167 @@
+from collections import Counter
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.constants import OnConflict
+
+from .counters import counter_engine
+from .live import LIVE_EVENTS, live_feed
+from .models import Event
+
+MAX_BATCH_SIZE = 100
+
+# Event type -> OfferAnalytics counter it increments
+OFFER_COUNTER_EVENTS = {
+    'copy_code': 'code_copies',
+    'save_offer': 'saves',
+    'use_offer': 'uses',
+}
+
+
+class InvalidEvent(ValueError):
+    pass
+
+
+def clean_event(raw):
+    """Validate one event payload and return the fields for an Event row."""
+    if not isinstance(raw, dict):
+        raise InvalidEvent('Invalid data format')
+
+    event_type = raw.get('event_type')
+    if not isinstance(event_type, str) or not event_type or len(event_type) > 50:
+        raise InvalidEvent('event_type is required')
+
+    event_data = raw.get('data', {})
+    # Make sure event_data is a dictionary
+    if not isinstance(event_data, dict):
+        event_data = {}
+
+    client_event_id = raw.get('event_id') or raw.get('id')
+    if client_event_id is not None:
+        client_event_id = str(client_event_id)[:64]
+
+    return {
+        'event_type': event_type,
+        'page': str(raw.get('page') or '')[:255],
+        'element': str(raw.get('element') or '')[:255],
+        'data': event_data,
+        'client_event_id': client_event_id or None,
+    }
+
+
+def resolve_offers(references):
+    """Map offer slugs (or codes, for older clients) to offer ids in one query."""
+    references = {ref for ref in references if isinstance(ref, str) and ref}
+    if not references:
+        return {}
+
+    from coupons.models import Coupon
+    by_slug, by_code = {}, {}
+    rows = Coupon.objects.filter(
+        Q(slug__in=references) | Q(code__in=references)
+    ).values_list('pk', 'slug', 'code')
+    for pk, slug, code in rows:
+        by_slug[slug] = pk
+        if code:
+            by_code.setdefault(code, pk)
+
+    return {
+        ref: by_slug.get(ref) or by_code.get(ref)
+        for ref in references
+        if ref in by_slug or ref in by_code
+    }
+
+
+def _insert_new(rows):
+    """
+    Insert Event rows in one statement, skipping client_event_ids that are
+    already stored, and return the client_event_ids this call inserted.
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        # INSERT ... ON CONFLICT DO NOTHING RETURNING client_event_id only
+        # returns the rows it inserted, so a retry racing the original
+        # request can tell which of them it won
+        fields = [field for field in Event._meta.concrete_fields if not field.primary_key]
+        returned = Event.objects._insert(
+            rows,
+            fields=fields,
+            returning_fields=[Event._meta.get_field('client_event_id')],
+            on_conflict=OnConflict.IGNORE,
+        )
+        return {row[0] for row in returned if row and row[0]}
+
+    # Without RETURNING, ids stored before this call are read first; only
+    # a retry racing the original between the two statements is miscounted
+    ids = [row.client_event_id for row in rows if row.client_event_id]
+    stored = set(Event.objects.filter(client_event_id__in=ids).values_list('client_event_id', flat=True))
+    Event.objects.bulk_create(rows, ignore_conflicts=True)
+    return set(ids) - stored
+
+
+def ingest_events(events, user=None, session_id=''):
+    """
+    Store a batch of cleaned events and apply their counter deltas.
+
+    Events carrying a client_event_id that was already stored (or that
+    repeats within the batch) are skipped, so client retries are safe.
+    The batch is one INSERT that reports which rows it inserted, and side
+    effects only run for those: a retry racing the original request loses
+    on the unique client_event_id and is counted as a duplicate. Returns
+    (stored, duplicates).
+    """
+    seen = set()
+    candidates = []
+    duplicates = 0
+
+    for event in events:
+        client_event_id = event['client_event_id']
+        if client_event_id:
+            if client_event_id in seen:
+                duplicates += 1
+                continue
+            seen.add(client_event_id)
+        candidates.append(event)
+
+    if not candidates:
+        return 0, duplicates
+
+    user = user if user is not None and user.is_authenticated else None
+    inserted = _insert_new([Event(user=user, session_id=session_id, **event) for event in candidates])
+    fresh = [
+        event for event in candidates
+        if not event['client_event_id'] or event['client_event_id'] in inserted
+    ]
+    duplicates += len(candidates) - len(fresh)
+
+    if not fresh:
+        return 0, duplicates
+
+    for event in fresh:
+        if event['event_type'] in LIVE_EVENTS:
+            live_feed.record(event['event_type'])
+
+    # Update offer analytics in aggregate
+    counted = [event for event in fresh if event['event_type'] in OFFER_COUNTER_EVENTS]
+    offer_ids = resolve_offers(event['data'].get('slug') for event in counted)
+    deltas = Counter()
+    for event in counted:
+        slug = event['data'].get('slug')
+        offer_id = offer_ids.get(slug) if isinstance(slug, str) else None
+        if offer_id:
+            deltas[(offer_id, OFFER_COUNTER_EVENTS[event['event_type']])] += 1
+    for (offer_id, field), delta in deltas.items():
+        counter_engine.incr('offer', offer_id, field, delta)
+
+    # Every counted offer interaction is an offer click for its store and category
+    clicks = Counter()
+    for (offer_id, field), delta in deltas.items():
+        clicks[offer_id] += delta
+    if clicks:
+        from coupons.models import Coupon
+        owners = Coupon.objects.filter(pk__in=list(clicks)).values_list('pk', 'store_id', 'category_id', 'title')
+        for offer_id, store_id, category_id, title in owners:
+            counter_engine.incr('store', store_id, 'offer_clicks', clicks[offer_id])
+            counter_engine.incr('category', category_id, 'offer_clicks', clicks[offer_id])
+            live_feed.note_title(offer_id, title)
+
+    return len(fresh), duplicates
@@ -0,0 +1,134 @@
+"""
+Streaming export of the raw analytics tables.
+
+Rows are read with .iterator(chunk_size=...) and encoded a batch at a
+time, so memory use does not depend on the size of the date range. Used
+by the staff export endpoint and the export_analytics command.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime, time as dt_time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Event, PageView, Session
+from .rollups import _day_start
+
+# Export name -> (model, timestamp field the date range applies to)
+EXPORT_TABLES = {
+    'page_views': (PageView, 'timestamp'),
+    'events': (Event, 'timestamp'),
+    'sessions': (Session, 'start_time'),
+}
+
+# Extra columns decoded from dimension tables: column -> lookup
+EXPORT_LOOKUPS = {
+    'page_views': {
+        'path': 'route__path',
+        'referer_domain': 'referer_domain__domain',
+        'user_agent': 'user_agent__user_agent',
+        'browser': 'user_agent__browser',
+        'browser_version': 'user_agent__browser_version',
+        'operating_system': 'user_agent__operating_system',
+        'device_type': 'user_agent__device_type',
+        'is_mobile': 'user_agent__is_mobile',
+        'is_tablet': 'user_agent__is_tablet',
+        'is_pc': 'user_agent__is_pc',
+    },
+}
+
+EXPORT_FORMATS = ('csv', 'ndjson')
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def export_columns(table):
+    """All exportable columns of a table, in model order, then decoded dimensions."""
+    model = EXPORT_TABLES[table][0]
+    return [field.attname for field in model._meta.concrete_fields] + list(EXPORT_LOOKUPS.get(table, {}))
+
+
+def clean_columns(table, requested=None):
+    available = export_columns(table)
+    if not requested:
+        return available
+    unknown = [column for column in requested if column not in available]
+    if unknown:
+        raise ValueError(f"Unknown {table} columns: {', '.join(unknown)}")
+    return list(requested)
+
+
+def export_rows(table, start_day, end_day, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield value tuples for rows between start_day and end_day (inclusive)."""
+    model, date_field = EXPORT_TABLES[table]
+    lookups = EXPORT_LOOKUPS.get(table, {})
+    queryset = model.objects.filter(**{
+        f'{date_field}__gte': _day_start(start_day),
+        f'{date_field}__lt': _day_start(end_day + timedelta(days=1)),
+    }).order_by('pk').values_list(*[lookups.get(column, column) for column in columns])
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_json_encoder = DjangoJSONEncoder()
+
+
+def _csv_value(value):
+    # JSON columns as JSON rather than a Python repr, and dates, times and
+    # durations in the same ISO 8601 form as the NDJSON export
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, cls=DjangoJSONEncoder)
+    if isinstance(value, (datetime, date, dt_time, timedelta)):
+        return _json_encoder.default(value)
+    return value
+
+
+def iter_csv(rows, columns, batch_size=DEFAULT_CHUNK_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in _batches(rows, batch_size):
+        writer.writerows([_csv_value(value) for value in row] for row in batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # Header only, for an empty range
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def iter_ndjson(rows, columns, batch_size=DEFAULT_CHUNK_SIZE):
+    for batch in _batches(rows, batch_size):
+        yield ''.join(
+            json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+            for row in batch
+        ).encode('utf-8')
+
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=31)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(table, start_day, end_day, columns, fmt='csv', compress=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Encoded (and optionally gzipped) export of one table, as a byte chunk iterator."""
+    rows = export_rows(table, start_day, end_day, columns, chunk_size)
+    encode = iter_ndjson if fmt == 'ndjson' else iter_csv
+    chunks = encode(rows, columns, chunk_size)
+    return gzip_stream(chunks) if compress else chunks
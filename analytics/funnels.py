@@ -0,0 +1,234 @@
+"""
+view_offer -> copy_code -> use_offer conversion funnels.
+
+Funnel steps are read in batches into NumPy arrays:
+- views are offer detail page views (PageView) plus any view_offer events;
+- copies and uses are copy_code / use_offer events, whose offer slug is in
+  Event.data.
+
+compute_funnel() then works out every (session, offer) pair in one
+vectorized pass. A pair reaches a step at the first time that step
+happens at or after the previous step was reached. The results are
+conversion rates and median seconds between steps, grouped by store,
+category, source or offer.
+
+Only raw rows are used, so windows longer than the archive retention
+(see analytics/archive.py) only cover what is still in the tables.
+"""
+import re
+
+import numpy as np
+from django.db.models.fields.json import KeyTextTransform
+
+from .events import resolve_offers
+from .models import Event, PageView, Route
+from .rollups import _day_start
+
+FUNNEL_STEPS = ('view_offer', 'copy_code', 'use_offer')
+
+# Dimension -> (label, Coupon field the offers are grouped by)
+FUNNEL_DIMENSIONS = {
+    'store': ('Store', 'store__name'),
+    'category': ('Category', 'category__name'),
+    'source': ('Source', 'source'),
+    'offer': ('Offer', 'title'),
+}
+
+DETAIL_PATH = re.compile(r'^/deals/[^/]+/([^/]+)/$')
+
+DEFAULT_CHUNK_SIZE = 20000
+
+
+class _Codes(dict):
+    """Maps values to dense integer codes in first-seen order."""
+
+    def code(self, value):
+        code = self.get(value)
+        if code is None:
+            code = self[value] = len(self)
+        return code
+
+
+def load_funnel_events(start_day, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read funnel steps since start_day.
+
+    Returns (sessions, refs, steps, timestamps) arrays plus the list of
+    offer references (slugs, or codes from older clients) that the refs
+    codes point into.
+    """
+    sessions, refs = _Codes(), _Codes()
+    batches = []
+    start = _day_start(start_day)
+
+    def add_batch(rows):
+        if rows:
+            session_codes, ref_codes, steps, timestamps = zip(*rows)
+            batches.append((
+                np.array(session_codes, dtype=np.int64),
+                np.array(ref_codes, dtype=np.int64),
+                np.array(steps, dtype=np.int8),
+                np.array(timestamps, dtype=np.float64),
+            ))
+
+    # Offer detail routes -> slug, matched once per route rather than per row
+    detail_routes = {}
+    for route_id, path in Route.objects.filter(path__startswith='/deals/').values_list('id', 'path').iterator():
+        match = DETAIL_PATH.match(path)
+        if match:
+            detail_routes[route_id] = match.group(1)
+
+    page_views = (
+        PageView.objects.filter(timestamp__gte=start, route__path__startswith='/deals/')
+        .exclude(session_id='')
+        .values_list('session_id', 'route_id', 'timestamp')
+        .iterator(chunk_size=chunk_size)
+    )
+    rows = []
+    for session_id, route_id, timestamp in page_views:
+        slug = detail_routes.get(route_id)
+        if slug:
+            rows.append((sessions.code(session_id), refs.code(slug), 0, timestamp.timestamp()))
+        if len(rows) >= chunk_size:
+            add_batch(rows)
+            rows = []
+    add_batch(rows)
+
+    events = (
+        Event.objects.filter(timestamp__gte=start, event_type__in=FUNNEL_STEPS)
+        .exclude(session_id='')
+        .annotate(slug=KeyTextTransform('slug', 'data'))
+        .exclude(slug__isnull=True)
+        .values_list('session_id', 'slug', 'event_type', 'timestamp')
+        .iterator(chunk_size=chunk_size)
+    )
+    rows = []
+    for session_id, slug, event_type, timestamp in events:
+        if isinstance(slug, str) and slug:
+            rows.append((sessions.code(session_id), refs.code(slug), FUNNEL_STEPS.index(event_type), timestamp.timestamp()))
+        if len(rows) >= chunk_size:
+            add_batch(rows)
+            rows = []
+    add_batch(rows)
+
+    if not batches:
+        empty = np.array([], dtype=np.int64)
+        return empty, empty, empty.astype(np.int8), empty.astype(np.float64), list(refs)
+
+    columns = [np.concatenate(column) for column in zip(*batches)]
+    return (*columns, list(refs))
+
+
+def _group_medians(groups, values, n_groups):
+    """Median of values per group code, NaN for empty groups."""
+    medians = np.full(n_groups, np.nan)
+    if not len(values):
+        return medians
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    present = counts > 0
+    low = starts[present] + (counts[present] - 1) // 2
+    high = starts[present] + counts[present] // 2
+    medians[present] = (values[low] + values[high]) / 2
+    return medians
+
+
+def compute_funnel(sessions, offers, steps, timestamps, offer_groups, n_groups):
+    """
+    Session-ordered funnel over all offers at once.
+
+    offers are offer codes (negative for unknown offers, which are
+    dropped) and offer_groups maps each offer code to a group code.
+    Returns {'reached': (n_groups, steps) counts, 'medians':
+    (n_groups, steps - 1) median seconds between consecutive steps}.
+    """
+    n_steps = len(FUNNEL_STEPS)
+    known = offers >= 0
+    sessions, offers, steps, timestamps = sessions[known], offers[known], steps[known], timestamps[known]
+
+    reached_counts = np.zeros((n_groups, n_steps), dtype=np.int64)
+    medians = np.full((n_groups, n_steps - 1), np.nan)
+    if not len(offers):
+        return {'reached': reached_counts, 'medians': medians}
+
+    # One row per (session, offer) pair
+    pair_keys = sessions * (int(offers.max()) + 1) + offers
+    pair_codes, pair_index = np.unique(pair_keys, return_inverse=True)
+    pair_offers = pair_codes % (int(offers.max()) + 1)
+    pair_groups = offer_groups[pair_offers]
+
+    # First time each pair reached each step, in step order
+    reached = np.full((len(pair_codes), n_steps), np.inf)
+    for step in range(n_steps):
+        mask = steps == step
+        if step:
+            mask &= timestamps >= reached[pair_index, step - 1]
+        np.minimum.at(reached[:, step], pair_index[mask], timestamps[mask])
+
+    done = np.isfinite(reached)
+    for step in range(n_steps):
+        reached_counts[:, step] = np.bincount(pair_groups[done[:, step]], minlength=n_groups)
+        if step:
+            delta = reached[done[:, step], step] - reached[done[:, step], step - 1]
+            medians[:, step - 1] = _group_medians(pair_groups[done[:, step]], delta, n_groups)
+
+    return {'reached': reached_counts, 'medians': medians}
+
+
+def _rate(numerator, denominator):
+    return round(numerator * 100 / denominator, 2) if denominator else 0
+
+
+def _seconds(value):
+    return None if np.isnan(value) else float(value)
+
+
+def funnel_report(start_day, dimension='store'):
+    """Funnel rows per `dimension` group since start_day, plus a total row."""
+    from coupons.models import Coupon
+
+    field = FUNNEL_DIMENSIONS[dimension][1]
+    sessions, refs, steps, timestamps, ref_values = load_funnel_events(start_day)
+
+    # Offer references -> offer codes -> group codes
+    ref_offers = resolve_offers(ref_values)
+    offer_pks = sorted(set(ref_offers.values()), key=str)
+    offer_codes = {pk: code for code, pk in enumerate(offer_pks)}
+    ref_to_offer = np.array([offer_codes.get(ref_offers.get(ref), -1) for ref in ref_values] or [-1], dtype=np.int64)
+
+    labels = dict(Coupon.objects.filter(pk__in=offer_pks).values_list('pk', field))
+    if dimension == 'source':
+        choices = dict(Coupon._meta.get_field('source').choices)
+        labels = {pk: choices.get(value, value) for pk, value in labels.items()}
+    groups = _Codes()
+    offer_groups = np.array([groups.code(labels.get(pk) or '') for pk in offer_pks] or [0], dtype=np.int64)
+
+    offers = ref_to_offer[refs] if len(refs) else refs
+    result = compute_funnel(sessions, offers, steps, timestamps, offer_groups, max(len(groups), 1))
+
+    def row(label, reached, medians):
+        viewed, copied, used = (int(count) for count in reached)
+        return {
+            'label': label,
+            'viewed': viewed,
+            'copied': copied,
+            'used': used,
+            'view_to_copy': _rate(copied, viewed),
+            'copy_to_use': _rate(used, copied),
+            'overall': _rate(used, viewed),
+            'median_view_to_copy': _seconds(medians[0]),
+            'median_copy_to_use': _seconds(medians[1]),
+        }
+
+    rows = [
+        row(label, result['reached'][code], result['medians'][code])
+        for label, code in groups.items()
+    ]
+    rows.sort(key=lambda item: (-item['viewed'], item['label']))
+
+    # Overall medians need the ungrouped pass
+    totals = compute_funnel(sessions, offers, steps, timestamps, np.zeros(len(offer_groups), dtype=np.int64), 1)
+    total = row('All offers', totals['reached'][0], totals['medians'][0])
+    return {'rows': rows, 'total': total}
@@ -0,0 +1,201 @@
+"""
+Local GeoIP enrichment for page views.
+
+Country and city come from a MaxMind (GeoLite2/GeoIP2 City or Country)
+.mmdb file set in ANALYTICS_GEOIP['DATABASE']. The file is opened once
+per process in memory-mapped mode, so forked workers share the pages.
+Lookups are cached per /24 (IPv4) or /48 (IPv6) prefix, since visitors in
+one prefix almost always resolve to the same place, and applied to whole
+batches by the ingestion buffer before the bulk INSERT.
+
+The file is checked for changes every RELOAD_INTERVAL seconds, so an
+update (e.g. by geoipupdate) is picked up without a restart.
+
+Without a configured (or readable) database file everything here is a
+no-op and country/city stay blank.
+"""
+import ipaddress
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GEOIP_SETTINGS = {
+    'DATABASE': None,       # Path to a .mmdb file; None disables enrichment
+    'CACHE_SIZE': 50000,    # Prefixes kept in memory
+    'TTL': 60 * 60 * 24,    # Seconds before a prefix is looked up again
+    'RELOAD_INTERVAL': 60,  # Seconds between checks for an updated file
+}
+
+EMPTY_LOCATION = ('', '')
+
+
+def get_geoip_settings():
+    conf = dict(DEFAULT_GEOIP_SETTINGS)
+    conf.update(getattr(settings, 'ANALYTICS_GEOIP', {}))
+    return conf
+
+
+def _address(ip):
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    # ::ffff:a.b.c.d is looked up (and cached) as a.b.c.d
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address
+
+
+def ip_prefix(ip):
+    """The /24 (IPv4) or /48 (IPv6) network an address belongs to, or None."""
+    address = _address(ip)
+    if address is None:
+        return None
+    prefix_length = 24 if address.version == 4 else 48
+    return ipaddress.ip_network(f'{address}/{prefix_length}', strict=False)
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _name(record):
+    if not record:
+        return ''
+    return (record.get('names') or {}).get('en') or record.get('iso_code') or ''
+
+
+def _location(record):
+    if not record:
+        return EMPTY_LOCATION
+    country = _name(record.get('country')) or _name(record.get('registered_country'))
+    return country[:100], _name(record.get('city'))[:100]
+
+
+class GeoIPResolver:
+    """
+    Memory-mapped MaxMind reader with a bounded LRU cache from IP prefix
+    to (country, city). Shared by the ingestion buffer for the process.
+    """
+
+    def __init__(self, database=None, cache_size=None, ttl=None, reload_interval=None):
+        conf = get_geoip_settings()
+        self.database = database or conf['DATABASE']
+        self.cache_size = cache_size or conf['CACHE_SIZE']
+        self.ttl = ttl or conf['TTL']
+        self.reload_interval = conf['RELOAD_INTERVAL'] if reload_interval is None else reload_interval
+        self._reader = None
+        self._opened = False
+        self._signature = None
+        self._next_check = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def reader(self):
+        if not self._opened or self._file_changed():
+            with self._lock:
+                signature = _file_signature(self.database) if self.database else None
+                if not self._opened or signature != self._signature:
+                    # A replaced reader is left to lookups still using it
+                    # and closed once they drop it
+                    self._reader = self._open()
+                    self._signature = signature
+                    self._next_check = time.monotonic() + self.reload_interval
+                    self._entries.clear()
+                    self._opened = True
+        return self._reader
+
+    def _file_changed(self):
+        now = time.monotonic()
+        if not self.database or now < self._next_check:
+            return False
+        self._next_check = now + self.reload_interval
+        return _file_signature(self.database) != self._signature
+
+    @property
+    def enabled(self):
+        return self.reader is not None
+
+    def _open(self):
+        if not self.database:
+            return None
+        try:
+            import maxminddb
+            return maxminddb.open_database(str(self.database), maxminddb.MODE_MMAP)
+        except (ImportError, OSError, ValueError):
+            logger.warning('GeoIP database %s could not be opened; location enrichment is off', self.database, exc_info=True)
+            return None
+
+    def lookup(self, ip):
+        """(country, city) for an address; blanks when unknown."""
+        reader = self.reader
+        address = _address(ip) if reader is not None and ip else None
+        if address is None:
+            return EMPTY_LOCATION
+        prefix = ip_prefix(address)
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(prefix)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        try:
+            location = _location(reader.get(address))
+        except ValueError:
+            # e.g. an IPv6 address against an IPv4-only database
+            location = EMPTY_LOCATION
+
+        with self._lock:
+            self._entries[prefix] = (location, now + self.ttl)
+            self._entries.move_to_end(prefix)
+            while len(self._entries) > self.cache_size:
+                self._entries.popitem(last=False)
+        return location
+
+    def enrich(self, page_views):
+        """Fill country/city on unsaved PageView objects that have neither."""
+        if not page_views or not self.enabled:
+            return
+        for page_view in page_views:
+            if page_view.ip_address and not page_view.country and not page_view.city:
+                page_view.country, page_view.city = self.lookup(page_view.ip_address)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self._reader is not None,
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+            self._reader = None
+            self._opened = False
+            self._signature = None
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+geoip_resolver = GeoIPResolver()
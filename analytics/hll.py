@@ -0,0 +1,107 @@
+"""
+HyperLogLog sketches for approximate distinct counts.
+
+A sketch with precision p keeps 2**p one-byte registers (16 KB at the
+default p=14) and estimates the number of distinct values added with a
+standard error of about 1.04 / sqrt(2**p), i.e. ~0.81% at p=14: about
+two thirds of estimates land within 0.81% of the true count and ~99.7%
+within 2.4%. Small cardinalities fall back to linear counting, which is
+close to exact. Sketches merge losslessly (register-wise max), so per-day
+sketches answer any date range, and adding a value twice is harmless. A
+sketch can be reduced to a lower precision without loss, but not raised.
+"""
+import hashlib
+import math
+
+DEFAULT_PRECISION = 14
+
+
+def _hash(value):
+    digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class HyperLogLog:
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 18:
+            raise ValueError('precision must be between 4 and 18')
+        self.precision = precision
+        self.m = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.m)
+        else:
+            if len(registers) != self.m:
+                raise ValueError('register count does not match precision')
+            self.registers = bytearray(registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        # Stored as one precision byte followed by the registers
+        data = bytes(data)
+        return cls(data[0], data[1:])
+
+    def to_bytes(self):
+        return bytes([self.precision]) + bytes(self.registers)
+
+    def add(self, value):
+        h = _hash(value)
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('cannot merge sketches with different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def reduce(self, precision):
+        """
+        This sketch at a lower precision, as if it had been built at that
+        precision from the start. Lets sketches stored before a PRECISION
+        change merge with new ones.
+        """
+        if precision > self.precision:
+            raise ValueError('cannot raise the precision of a sketch')
+        if precision == self.precision:
+            return self
+        # The index bits dropped from the bottom of the index become the
+        # top of the remaining hash bits, ahead of the ones the rank counted
+        dropped = self.precision - precision
+        reduced = HyperLogLog(precision)
+        for index, rank in enumerate(self.registers):
+            if not rank:
+                continue
+            low = index & ((1 << dropped) - 1)
+            rank = dropped - low.bit_length() + 1 if low else dropped + rank
+            target = index >> dropped
+            if rank > reduced.registers[target]:
+                reduced.registers[target] = rank
+        return reduced
+
+    def count(self):
+        m = self.m
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    @property
+    def standard_error(self):
+        return 1.04 / math.sqrt(self.m)
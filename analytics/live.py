@@ -0,0 +1,178 @@
+"""
+Live analytics feed.
+
+The ingestion path records page views, tracked events and offer activity
+here as they arrive. At most once per INTERVAL seconds the accumulated
+deltas are sent to the `analytics_live` channel group, where
+LiveFeedConsumer forwards them to connected dashboards. Each message
+covers one interval of one process; clients sum messages to get rates
+and rank "top offers right now" over a rolling window.
+
+Publishing happens off the request path: from the analytics buffer's
+background flush thread, and from every connected consumer's ticker so a
+quiet process still sends its last deltas.
+
+The flush thread needs a channel layer that works across event loops,
+i.e. channels_redis (CHANNEL_REDIS_URL). InMemoryChannelLayer queues are
+bound to the server's loop, so sends from the thread's own loop are not
+reliably delivered; with it the thread leaves publishing to the consumers,
+which run on the server loop, and the feed only covers this process. Offer titles come from the
+objects the ingestion path already has (note_title()); the few it does
+not are looked up by the publisher.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+LIVE_GROUP = 'analytics_live'
+
+# Event types pushed as their own per-interval counts
+LIVE_EVENTS = ('copy_code', 'use_offer')
+
+DEFAULT_LIVE_SETTINGS = {
+    'ENABLED': True,
+    'INTERVAL': 1.0,   # Seconds between messages per process
+    'TOP_OFFERS': 10,  # Most active offers included per message
+}
+
+
+def get_live_settings():
+    conf = dict(DEFAULT_LIVE_SETTINGS)
+    conf.update(getattr(settings, 'ANALYTICS_LIVE_FEED', {}))
+    return conf
+
+
+def _get_channel_layer():
+    try:
+        from channels.layers import get_channel_layer
+    except ImportError:
+        return None
+    return get_channel_layer()
+
+
+def _is_in_memory(layer):
+    from channels.layers import InMemoryChannelLayer
+    return isinstance(layer, InMemoryChannelLayer)
+
+
+class LiveFeed:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._offers = Counter()
+        self._last_publish = time.monotonic()
+        self._titles = {}
+        self._warned_in_memory = False
+
+    @property
+    def conf(self):
+        return get_live_settings()
+
+    # Recording (called from the ingestion path)
+
+    def record(self, metric, delta=1):
+        if not self.conf['ENABLED']:
+            return
+        with self._lock:
+            self._counts[metric] += delta
+
+    def record_offer(self, offer_id, delta=1):
+        if not self.conf['ENABLED']:
+            return
+        with self._lock:
+            self._offers[offer_id] += delta
+
+    def note_title(self, offer_id, title):
+        """Remember an offer's title so publishing needs no query for it."""
+        if not self.conf['ENABLED'] or self._titles.get(offer_id) == title:
+            return
+        with self._lock:
+            if len(self._titles) > 10000:
+                self._titles.clear()
+            self._titles[offer_id] = title
+
+    # Publishing
+
+    def _take(self):
+        conf = self.conf
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_publish < conf['INTERVAL']:
+                return None
+            elapsed = now - self._last_publish
+            self._last_publish = now
+            if not self._counts and not self._offers:
+                return None
+            counts, self._counts = self._counts, Counter()
+            offers, self._offers = self._offers, Counter()
+
+        top = offers.most_common(conf['TOP_OFFERS'])
+        return {
+            'ts': time.time(),
+            'interval': round(elapsed, 3),
+            'page_views': counts['page_views'],
+            **{event_type: counts[event_type] for event_type in LIVE_EVENTS},
+            'offers': [
+                {'id': str(offer_id), 'title': title, 'count': count}
+                for (offer_id, count), title in zip(top, self._get_titles([offer_id for offer_id, _ in top]))
+            ],
+        }
+
+    def _get_titles(self, offer_ids):
+        # Only offers no request has shown yet, e.g. ones counted from events
+        missing = [offer_id for offer_id in offer_ids if offer_id not in self._titles]
+        if missing:
+            from coupons.models import Coupon
+            for offer_id, title in Coupon.objects.filter(pk__in=missing).values_list('pk', 'title'):
+                self.note_title(offer_id, title)
+        return [self._titles.get(offer_id, '') for offer_id in offer_ids]
+
+    def publish(self):
+        """
+        Send the pending deltas if an interval has passed. Called from the
+        analytics buffer's flush thread, never from a request.
+        """
+        if not self.conf['ENABLED']:
+            return
+        layer = _get_channel_layer()
+        if layer is None:
+            return
+        if _is_in_memory(layer):
+            # Left to apublish() on the server loop
+            if not self._warned_in_memory:
+                self._warned_in_memory = True
+                logger.warning(
+                    'The live analytics feed needs a Redis channel layer '
+                    '(CHANNEL_REDIS_URL) to publish from the flush thread; '
+                    'only connected dashboards publish it with InMemoryChannelLayer'
+                )
+            return
+        try:
+            message = self._take()
+            if message:
+                async_to_sync(layer.group_send)(LIVE_GROUP, {'type': 'analytics.update', 'data': message})
+        except Exception:
+            logger.exception('Publishing the live analytics feed failed')
+
+    async def apublish(self):
+        """Async variant of publish() for consumers."""
+        if not self.conf['ENABLED']:
+            return
+        layer = _get_channel_layer()
+        if layer is None:
+            return
+        try:
+            message = await sync_to_async(self._take)()
+            if message:
+                await layer.group_send(LIVE_GROUP, {'type': 'analytics.update', 'data': message})
+        except Exception:
+            logger.exception('Publishing the live analytics feed failed')
+
+
+live_feed = LiveFeed()
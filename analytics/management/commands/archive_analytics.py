@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+from analytics.archive import ARCHIVE_TABLES, archivable, archive_table, get_archive_settings, retention_cutoff
+from analytics.rollups import get_watermark
+
+class Command(BaseCommand):
+    help = 'Move raw analytics rows older than the retention window to gzip NDJSON archives'
+
+    def add_arguments(self, parser):
+        conf = get_archive_settings()
+        parser.add_argument('--retention-days', type=int, default=conf['RETENTION_DAYS'], help='Keep this many days of raw rows')
+        parser.add_argument('--output-dir', default=str(conf['DIR']), help='Directory the archive partitions are written to')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows archived and deleted per transaction')
+        parser.add_argument('--table', action='append', choices=list(ARCHIVE_TABLES), help='Only archive these tables (repeatable)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many rows would be archived')
+
+    def handle(self, *args, **options):
+        cutoff = retention_cutoff(options['retention_days'])
+        tables = options['table'] or list(ARCHIVE_TABLES)
+        self.stdout.write(f'Archiving rows older than {cutoff:%Y-%m-%d %H:%M} to {options["output_dir"]}')
+
+        for name in tables:
+            model, watermark = ARCHIVE_TABLES[name]
+            if watermark:
+                # Rows not folded yet would vanish from the rollups
+                pending = model.objects.filter(timestamp__lt=cutoff, id__gt=get_watermark(watermark)).count()
+                if pending:
+                    self.stdout.write(self.style.WARNING(
+                        f'{name}: skipping {pending} rows not folded into the rollups yet (run rollup_analytics first)'
+                    ))
+
+            if options['dry_run']:
+                self.stdout.write(f'{name}: {archivable(name, cutoff).count()} rows would be archived')
+                continue
+
+            archived = 0
+            started = time.monotonic()
+            for count in archive_table(name, cutoff, options['output_dir'], options['chunk_size']):
+                archived += count
+                elapsed = time.monotonic() - started
+                self.stdout.write(f'{name}: archived {archived} rows ({archived / elapsed:.0f} rows/sec)...')
+
+            elapsed = time.monotonic() - started
+            rate = archived / elapsed if elapsed else 0
+            self.stdout.write(self.style.SUCCESS(
+                f'{name}: archived {archived} rows in {elapsed:.1f}s ({rate:.0f} rows/sec)'
+            ))
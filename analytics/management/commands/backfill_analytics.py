@@ -1,35 +1,86 @@
 # analytics/management/commands/backfill_analytics.py
+from collections import Counter
+
 from django.core.management.base import BaseCommand
-from analytics.models import CouponAnalytics, StoreAnalytics, CategoryAnalytics
+from analytics.counters import counter_engine
+from analytics.models import OfferAnalytics, StoreAnalytics, CategoryAnalytics
+from analytics.reconcile import COUNTER_FIELDS, reconcile_offers
 from coupons.models import Coupon, Store, Category
-from django.utils import timezone
+
+# label -> (object model, analytics model, analytics FK attname)
+BACKFILL_MODELS = [
+    ('offer', Coupon, OfferAnalytics, 'offer_id'),
+    ('store', Store, StoreAnalytics, 'store_id'),
+    ('category', Category, CategoryAnalytics, 'category_id'),
+]
 
 class Command(BaseCommand):
-    help = 'Backfill analytics data for existing coupons, stores, and categories'
-    
+    help = 'Create missing analytics rows for offers, stores and categories, and optionally reconcile offer counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Objects handled per batch')
+        parser.add_argument('--reconcile', action='store_true', help='Recompute offer counters from PageView/Event history and report drift')
+        parser.add_argument('--workers', type=int, default=4, help='Threads used to reconcile chunks in parallel')
+        parser.add_argument('--apply', action='store_true', help='With --reconcile, raise stored counters that are below the recomputed values')
+        parser.add_argument('--top', type=int, default=10, help='With --reconcile, list this many offers with the largest drift')
+
     def handle(self, *args, **options):
-        # Backfill coupon analytics
-        self.stdout.write('Backfilling coupon analytics...')
-        coupons = Coupon.objects.all()
-        for coupon in coupons:
-            analytics, created = CouponAnalytics.objects.get_or_create(coupon=coupon)
-            if created:
-                self.stdout.write(f'Created analytics for coupon: {coupon.title}')
-        
-        # Backfill store analytics
-        self.stdout.write('Backfilling store analytics...')
-        stores = Store.objects.all()
-        for store in stores:
-            analytics, created = StoreAnalytics.objects.get_or_create(store=store)
-            if created:
-                self.stdout.write(f'Created analytics for store: {store.name}')
-        
-        # Backfill category analytics
-        self.stdout.write('Backfilling category analytics...')
-        categories = Category.objects.all()
-        for category in categories:
-            analytics, created = CategoryAnalytics.objects.get_or_create(category=category)
-            if created:
-                self.stdout.write(f'Created analytics for category: {category.name}')
-        
-        self.stdout.write(self.style.SUCCESS('Analytics backfill complete!'))
\ No newline at end of file
+        chunk_size = options['chunk_size']
+
+        for label, model, analytics_model, fk_attname in BACKFILL_MODELS:
+            self.stdout.write(f'Backfilling {label} analytics...')
+            # Only objects without a row; rerunning after an interruption
+            # simply continues with whatever is still missing
+            missing = model.objects.filter(analytics__isnull=True).values_list('pk', flat=True)
+            created = 0
+            batch = []
+            for pk in missing.iterator(chunk_size=chunk_size):
+                batch.append(analytics_model(**{fk_attname: pk}))
+                if len(batch) >= chunk_size:
+                    analytics_model.objects.bulk_create(batch, ignore_conflicts=True)
+                    created += len(batch)
+                    batch = []
+            if batch:
+                analytics_model.objects.bulk_create(batch, ignore_conflicts=True)
+                created += len(batch)
+            self.stdout.write(f'Created {created} {label} analytics rows')
+
+        if options['reconcile']:
+            self.reconcile(options)
+
+        self.stdout.write(self.style.SUCCESS('Analytics backfill complete!'))
+
+    def reconcile(self, options):
+        # Write this process's pending increments first so they are not reported as drift
+        counter_engine.flush()
+
+        self.stdout.write('Reconciling offer counters with raw history (history is a lower bound, see analytics/reconcile.py)...')
+        checked = 0
+        drifted = []
+        totals = Counter()
+        for count, drift in reconcile_offers(options['chunk_size'], options['workers'], options['apply']):
+            checked += count
+            drifted.extend(drift)
+            for _, _, _, delta in drift:
+                for field, value in delta.items():
+                    totals[field] += value
+            self.stdout.write(f'Checked {checked} offers, {len(drifted)} drifting...')
+
+        self.stdout.write(f'{len(drifted)} of {checked} offers drift from their raw history')
+        self.stdout.write('Net drift (recomputed - stored): ' + ', '.join(
+            f'{field} {totals[field]:+d}' for field in COUNTER_FIELDS
+        ))
+
+        drifted.sort(key=lambda row: sum(abs(value) for value in row[3].values()), reverse=True)
+        titles = dict(Coupon.objects.filter(pk__in=[row[0] for row in drifted[:options['top']]]).values_list('pk', 'title'))
+        for pk, stored, recomputed, delta in drifted[:options['top']]:
+            changes = ', '.join(
+                f'{field} {stored.get(field, 0)} -> {recomputed.get(field, 0)}'
+                for field in COUNTER_FIELDS if delta[field]
+            )
+            self.stdout.write(f'  {titles.get(pk, pk)}: {changes}')
+
+        if options['apply']:
+            raised = sum(1 for row in drifted if any(value > 0 for value in row[3].values()))
+            if raised:
+                self.stdout.write(self.style.WARNING(f'Raised counters for {raised} offers; counters above their history are left as they are'))
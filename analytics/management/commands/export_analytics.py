@@ -0,0 +1,55 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from analytics.export import DEFAULT_CHUNK_SIZE, EXPORT_FORMATS, EXPORT_TABLES, clean_columns, export_columns, stream_export
+
+class Command(BaseCommand):
+    help = 'Stream raw page views, events or sessions for a date range as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=list(EXPORT_TABLES))
+        parser.add_argument('--start', type=date.fromisoformat, help='First day to export, YYYY-MM-DD (default: 30 days before --end)')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day to export, YYYY-MM-DD (default: today)')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv')
+        parser.add_argument('--columns', help='Comma-separated columns to include (default: all)')
+        parser.add_argument('--list-columns', action='store_true', help='Print the available columns and exit')
+        parser.add_argument('--gzip', action='store_true', help='Gzip the output')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Rows fetched per database round trip')
+        parser.add_argument('--output', '-o', help='File to write to (default: stdout)')
+
+    def handle(self, *args, **options):
+        table = options['table']
+        if options['list_columns']:
+            self.stdout.write('\n'.join(export_columns(table)))
+            return
+
+        end_day = options['end'] or timezone.localdate()
+        start_day = options['start'] or end_day - timedelta(days=30)
+
+        if options['gzip'] and not options['output']:
+            raise CommandError('--gzip needs --output')
+
+        requested = [column.strip() for column in (options['columns'] or '').split(',') if column.strip()]
+        try:
+            columns = clean_columns(table, requested)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        chunks = stream_export(
+            table, start_day, end_day, columns,
+            options['format'], options['gzip'], options['chunk_size'],
+        )
+
+        if options['output']:
+            written = 0
+            with open(options['output'], 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    written += len(chunk)
+            self.stderr.write(self.style.SUCCESS(
+                f'Exported {table} {start_day} to {end_day} to {options["output"]} ({written} bytes)'
+            ))
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk.decode('utf-8'), ending='')
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from analytics.models import UserAgent
+from analytics.ua import user_agent_cache
+
+UA_FIELDS = [
+    'browser', 'browser_version', 'operating_system',
+    'device_type', 'is_mobile', 'is_tablet', 'is_pc', 'is_bot',
+]
+
+class Command(BaseCommand):
+    help = 'Reparse the browser/OS/device fields of stored user agents (e.g. after upgrading the parser)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Reparse every user agent, not only ones missing a browser')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows read and updated per batch')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+
+        # Page views point at these rows, so each distinct string is parsed once
+        queryset = UserAgent.objects.all()
+        if not options['all']:
+            queryset = queryset.filter(browser='')
+
+        updated = 0
+        last_id = 0
+        while True:
+            # Walk the table by primary key so each batch is an index range scan
+            batch = list(
+                queryset.filter(id__gt=last_id).order_by('id').only('id', 'user_agent')[:chunk_size]
+            )
+            if not batch:
+                break
+
+            for user_agent in batch:
+                parsed = user_agent_cache.parse(user_agent.user_agent)
+                for field in UA_FIELDS:
+                    setattr(user_agent, field, getattr(parsed, field))
+            UserAgent.objects.bulk_update(batch, UA_FIELDS)
+
+            updated += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write(f'Reparsed {updated} user agents...')
+
+        stats = user_agent_cache.stats()
+        self.stdout.write(
+            f"User agent cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate'] * 100:.1f}% hit rate), {stats['size']} entries"
+        )
+        self.stdout.write(self.style.SUCCESS(f'Reparsed {updated} user agents'))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from analytics.rollups import fold_events, fold_page_views, rebuild_rollups
+
+class Command(BaseCommand):
+    help = 'Fold new raw page views and events into the daily rollup tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Raw rows folded per transaction')
+        parser.add_argument('--lag', type=int, default=60, help='Skip rows newer than this many seconds')
+        parser.add_argument(
+            '--rebuild', action='store_true',
+            help='Drop the rollups and fold the raw rows again, for the days whose raw rows were not archived',
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            start, views, events = rebuild_rollups(options['chunk_size'])
+            if start is None:
+                self.stdout.write(self.style.WARNING('Rebuilt all rollups'))
+            else:
+                self.stdout.write(self.style.WARNING(
+                    f'Rebuilt rollups from {start}; earlier days were archived and are kept as they are'
+                ))
+            self.stdout.write(f'Refolded {views} page views and {events} events')
+
+        page_views = fold_page_views(options['chunk_size'], options['lag'])
+        self.stdout.write(f'Folded {page_views} page views')
+
+        events = fold_events(options['chunk_size'], options['lag'])
+        self.stdout.write(f'Folded {events} events')
+
+        self.stdout.write(self.style.SUCCESS('Analytics rollups are up to date'))
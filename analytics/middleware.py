@@ -1,32 +1,32 @@
-import uuid
 from django.utils import timezone
-from django.contrib.auth.models import AnonymousUser
-from .models import PageView, Session, UserActivity
+from .buffer import page_view_buffer
+from .context import COUNTED_STATUS_CODES, get_tracked_object, resolve_tracked_target
+from .counters import counter_engine
+from .live import live_feed
+from .sampling import page_view_sampler
+from .sessions import session_tracker
+from .ua import user_agent_cache
 
 class AnalyticsMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
 
     def __call__(self, request):
-        # Generate or get session ID
-        if not request.session.session_key:
-            request.session.create()
-        session_id = request.session.session_key
+        user_id = request.user.pk if request.user.is_authenticated else None
+        user_agent = request.META.get('HTTP_USER_AGENT', '')
         
-        # Get or create session record
-        session, created = Session.objects.get_or_create(
-            session_id=session_id,
-            defaults={
-                'user': request.user if request.user.is_authenticated else None,
-                'start_time': timezone.now(),
-                'last_activity': timezone.now(),
-            }
-        )
+        # Anonymous crawlers never keep the session cookie, so giving them a
+        # session would create a new DB row on every hit
+        is_crawler = not user_id and user_agent_cache.parse(user_agent).is_bot
         
-        if not created:
-            session.last_activity = timezone.now()
-            session.page_views += 1
-            session.save(update_fields=['last_activity', 'page_views'])
+        session_id = ''
+        if not is_crawler:
+            # Get or generate the visitor's session ID (a cookie of our own,
+            # creating a Django session would write to the session store)
+            session_id = session_tracker.get_session_id(request) or session_tracker.new_session_id()
+            
+            # Activity is coalesced in the cache and persisted once per interval
+            session_tracker.touch(session_id, user_id, timezone.now())
         
         # Store session ID in request for later use
         request.analytics_session_id = session_id
@@ -36,36 +36,34 @@ class AnalyticsMiddleware:
         
         # Track page view (excluding static files and API calls)
         if not request.path.startswith('/static/') and not request.path.startswith('/api/'):
-            # Get user agent info
-            user_agent = request.META.get('HTTP_USER_AGENT', '')
-            
-            # Create page view record
-            page_view = PageView(
-                user=request.user if request.user.is_authenticated else None,
-                session_id=session_id,
-                path=request.path,
-                full_path=request.get_full_path(),
-                referer=request.META.get('HTTP_REFERER', ''),
-                ip_address=self.get_client_ip(request),
-                user_agent=user_agent,
-            )
-            page_view.save()
-            
-            # Parse user agent info
-            page_view.parse_user_agent()
+            # Under load only 1 in `weight` page views is recorded, carrying
+            # that weight (see analytics/sampling.py)
+            weight = page_view_sampler.weight_for(request.path)
             
-            # Update or create analytics records for specific pages
-            self.update_analytics_records(request, page_view)
-            
-            # Log user activity
-            if request.user.is_authenticated:
-                UserActivity.objects.create(
-                    user=request.user,
+            if weight:
+                # Queue the page view; the buffer's background flush resolves
+                # path, referer and user agent to dimension ids
+                page_view_buffer.record_page_view(
+                    user_id=user_id,
                     session_id=session_id,
-                    activity_type='page_view',
-                    description=f"Viewed {request.path}",
-                    data={'path': request.path, 'method': request.method}
+                    path=request.path,
+                    query_string=request.META.get('QUERY_STRING', ''),
+                    referer=request.META.get('HTTP_REFERER', ''),
+                    ip_address=self.get_client_ip(request),
+                    user_agent=user_agent,
+                    timestamp=timezone.now(),
+                    weight=weight,
+                    status_code=response.status_code,
                 )
+                live_feed.record('page_views', weight)
+            
+            # Count a view for the offer, store or category this page showed
+            # (signed-in users' page view activity is read from PageView, see
+            # analytics/activity.py)
+            self.update_analytics_records(request, response)
+        
+        if session_id:
+            session_tracker.set_cookie(request, response, session_id)
         
         return response
     
@@ -77,49 +75,17 @@ class AnalyticsMiddleware:
             ip = request.META.get('REMOTE_ADDR')
         return ip
     
-    def update_analytics_records(self, request, page_view):
-        from coupons.models import Coupon, Store, Category
-        # Changed from CouponAnalytics to OfferAnalytics
-        from .models import OfferAnalytics, StoreAnalytics, CategoryAnalytics
-        
-        path = request.path
-        
-        # Track offer views (updated from coupon views)
-        # Updated URL pattern from /coupon/ to /deals/ with section
-        if path.startswith('/deals/') and len(path.split('/')) >= 4:
-            try:
-                section = path.split('/')[2]
-                slug = path.split('/')[3]
-                # Check if the ID is a valid UUID before querying
-                try:
-                    uuid.UUID(slug)
-                    # If it's a valid UUID, try to get the offer
-                    offer = Coupon.objects.get(slug=slug)
-                    # Changed from CouponAnalytics to OfferAnalytics and coupon to offer
-                    offer_analytics, created = OfferAnalytics.objects.get_or_create(offer=offer)
-                    offer_analytics.increment_views()
-                except ValueError:
-                    # Not a valid UUID, skip analytics tracking
-                    pass
-            except (Coupon.DoesNotExist, ValueError):
-                pass
-        
-        # Track store views
-        if path.startswith('/store/') and len(path.split('/')) >= 3:
-            try:
-                store_slug = path.split('/')[2]
-                store = Store.objects.get(slug=store_slug)
-                store_analytics, created = StoreAnalytics.objects.get_or_create(store=store)
-                store_analytics.increment_views()
-            except (Store.DoesNotExist, ValueError):
-                pass
+    def update_analytics_records(self, request, response):
+        # Only responses that showed the object count, the same rule the
+        # recompute in analytics/reconcile.py applies to PageView rows
+        if response.status_code not in COUNTED_STATUS_CODES:
+            return
         
-        # Track category views
-        if path.startswith('/category/') and len(path.split('/')) >= 3:
-            try:
-                category_slug = path.split('/')[2]
-                category = Category.objects.get(slug=category_slug)
-                category_analytics, created = CategoryAnalytics.objects.get_or_create(category=category)
-                category_analytics.increment_views()
-            except (Category.DoesNotExist, ValueError):
-                pass
\ No newline at end of file
+        target = resolve_tracked_target(request)
+        if target:
+            kind, object_id = target
+            counter_engine.incr(kind, object_id, 'views')
+            # The live feed shows offers by title, which the view already loaded
+            obj = get_tracked_object(request)
+            if kind == 'offer' and obj is not None:
+                live_feed.note_title(object_id, obj.title)
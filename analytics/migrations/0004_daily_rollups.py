@@ -0,0 +1,56 @@
+# Generated by Django 5.2.1 on 2026-10-18 04:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0003_event_client_event_id'),
+        ('coupons', '0006_dealsection_dealhighlight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PageViewDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('path', models.CharField(max_length=255)),
+                ('device_class', models.CharField(choices=[('mobile', 'Mobile'), ('tablet', 'Tablet'), ('desktop', 'Desktop'), ('other', 'Other')], max_length=10)),
+                ('browser', models.CharField(blank=True, max_length=100)),
+                ('country', models.CharField(blank=True, max_length=100)),
+                ('views', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Page View Daily Rollups',
+                'indexes': [models.Index(fields=['date'], name='analytics_p_date_77fcb9_idx')],
+                'unique_together': {('date', 'path', 'device_class', 'browser', 'country')},
+            },
+        ),
+        migrations.CreateModel(
+            name='EventDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('event_type', models.CharField(max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('offer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='daily_events', to='coupons.coupon')),
+            ],
+            options={
+                'verbose_name_plural': 'Event Daily Rollups',
+                'indexes': [models.Index(fields=['date'], name='analytics_e_date_fe5145_idx')],
+                'unique_together': {('date', 'event_type', 'offer')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0004_daily_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitorSketchDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('dimension', models.CharField(choices=[('session', 'Sessions'), ('user', 'Users'), ('ip', 'IP addresses')], max_length=10)),
+                ('sketch', models.BinaryField()),
+            ],
+            options={
+                'verbose_name_plural': 'Visitor Sketch Daily Rollups',
+                'unique_together': {('date', 'dimension')},
+            },
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0005_visitor_sketches'),
+        ('coupons', '0006_dealsection_dealhighlight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('offer_clicks', models.PositiveIntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='coupons.category')),
+            ],
+            options={
+                'verbose_name_plural': 'Category Daily Stats',
+                'indexes': [models.Index(fields=['date'], name='analytics_c_date_241912_idx')],
+                'unique_together': {('date', 'category')},
+            },
+        ),
+        migrations.CreateModel(
+            name='StoreDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('offer_clicks', models.PositiveIntegerField(default=0)),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='coupons.store')),
+            ],
+            options={
+                'verbose_name_plural': 'Store Daily Stats',
+                'indexes': [models.Index(fields=['date'], name='analytics_s_date_93ca53_idx')],
+                'unique_together': {('date', 'store')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0006_store_category_daily'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pageview',
+            name='weight',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
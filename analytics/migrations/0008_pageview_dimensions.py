@@ -0,0 +1,65 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0007_pageview_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefererDomain',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Route',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UserAgent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=40, unique=True)),
+                ('user_agent', models.TextField()),
+                ('browser', models.CharField(blank=True, max_length=100)),
+                ('browser_version', models.CharField(blank=True, max_length=50)),
+                ('operating_system', models.CharField(blank=True, max_length=100)),
+                ('device_type', models.CharField(blank=True, max_length=50)),
+                ('is_mobile', models.BooleanField(default=False)),
+                ('is_tablet', models.BooleanField(default=False)),
+                ('is_pc', models.BooleanField(default=False)),
+                ('is_bot', models.BooleanField(default=False)),
+            ],
+        ),
+        # Nullable until 0009 has filled them in; the user agent FK gets its
+        # final name in 0010, once the old text column is gone
+        migrations.AddField(
+            model_name='pageview',
+            name='route',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, related_name='page_views', to='analytics.route'),
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='referer_domain',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='page_views', to='analytics.refererdomain'),
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='user_agent_ref',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='page_views', to='analytics.useragent'),
+        ),
+        migrations.AddField(
+            model_name='pageview',
+            name='query_string',
+            field=models.TextField(blank=True, default=''),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,172 @@
+"""
+Move PageView paths, referers and user agents into the dimension tables,
+one chunk of rows at a time.
+
+The migration is not atomic: every chunk commits on its own and only rows
+without a route are read, so an interrupted run picks up where it stopped.
+"""
+import hashlib
+from urllib.parse import urlsplit
+
+import user_agents
+from django.db import migrations, transaction
+
+CHUNK_SIZE = 5000
+
+# Distinct values remembered across chunks before the local caches reset
+MAX_CACHED = 100000
+
+
+# Frozen copies of the analytics.dimensions and analytics.ua helpers as of
+# this migration, so later changes there cannot change what it writes
+
+def normalize_path(path):
+    return (path or '/')[:255]
+
+
+def referer_domain(referer):
+    if not referer:
+        return ''
+    try:
+        host = urlsplit(referer).hostname or ''
+    except ValueError:
+        return ''
+    return host[:255]
+
+
+def user_agent_hash(user_agent):
+    return hashlib.sha1(user_agent.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def parse_user_agent(ua_string):
+    user_agent_obj = user_agents.parse(ua_string)
+    return {
+        'browser': user_agent_obj.browser.family[:100],
+        'browser_version': user_agent_obj.browser.version_string[:50],
+        'operating_system': user_agent_obj.os.family[:100],
+        'device_type': (user_agent_obj.device.family or '')[:50],
+        'is_mobile': user_agent_obj.is_mobile,
+        'is_tablet': user_agent_obj.is_tablet,
+        'is_pc': user_agent_obj.is_pc,
+        'is_bot': user_agent_obj.is_bot,
+    }
+
+
+def _resolve(model, key_field, cache, values, build):
+    if len(cache) > MAX_CACHED:
+        cache.clear()
+    missing = [key for key in values if key not in cache]
+    if missing:
+        lookup = f'{key_field}__in'
+        cache.update(model.objects.filter(**{lookup: missing}).values_list(key_field, 'id'))
+        new = [key for key in missing if key not in cache]
+        if new:
+            model.objects.bulk_create([build(key, values[key]) for key in new], ignore_conflicts=True)
+            cache.update(model.objects.filter(**{lookup: new}).values_list(key_field, 'id'))
+
+
+def _update_sql(connection, table, columns):
+    quote = connection.ops.quote_name
+    assignments = ', '.join(f'{quote(column)} = %s' for column in columns)
+    return f'UPDATE {quote(table)} SET {assignments} WHERE {quote("id")} = %s'
+
+
+def encode_page_views(apps, schema_editor):
+    PageView = apps.get_model('analytics', 'PageView')
+    Route = apps.get_model('analytics', 'Route')
+    RefererDomain = apps.get_model('analytics', 'RefererDomain')
+    UserAgent = apps.get_model('analytics', 'UserAgent')
+
+    def build_user_agent(key, user_agent):
+        return UserAgent(hash=key, user_agent=user_agent, **parse_user_agent(user_agent))
+
+    connection = schema_editor.connection
+    sql = _update_sql(connection, PageView._meta.db_table, ['route_id', 'referer_domain_id', 'user_agent_ref_id', 'query_string'])
+    routes, domains, agents = {}, {}, {}
+    last_id = 0
+
+    while True:
+        rows = list(
+            PageView.objects.filter(id__gt=last_id, route__isnull=True)
+            .order_by('id')
+            .values_list('id', 'path', 'full_path', 'referer', 'user_agent')[:CHUNK_SIZE]
+        )
+        if not rows:
+            return
+
+        encoded = []
+        paths, chunk_domains, chunk_agents = {}, {}, {}
+        for row_id, path, full_path, referer, user_agent in rows:
+            path = normalize_path(path)
+            domain = referer_domain(referer)
+            agent_key = user_agent_hash(user_agent) if user_agent else None
+            paths[path] = path
+            if domain:
+                chunk_domains[domain] = domain
+            if agent_key:
+                chunk_agents[agent_key] = user_agent
+            encoded.append((row_id, path, domain, agent_key, full_path.partition('?')[2]))
+
+        _resolve(Route, 'path', routes, paths, lambda key, _: Route(path=key))
+        _resolve(RefererDomain, 'domain', domains, chunk_domains, lambda key, _: RefererDomain(domain=key))
+        _resolve(UserAgent, 'hash', agents, chunk_agents, build_user_agent)
+
+        params = [
+            (routes[path], domains.get(domain), agents.get(agent_key), query_string, row_id)
+            for row_id, path, domain, agent_key, query_string in encoded
+        ]
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, params)
+        last_id = rows[-1][0]
+
+
+def decode_page_views(apps, schema_editor):
+    # Referers can only be restored as their domain
+    PageView = apps.get_model('analytics', 'PageView')
+    Route = apps.get_model('analytics', 'Route')
+    RefererDomain = apps.get_model('analytics', 'RefererDomain')
+    UserAgent = apps.get_model('analytics', 'UserAgent')
+
+    routes = dict(Route.objects.values_list('id', 'path'))
+    domains = dict(RefererDomain.objects.values_list('id', 'domain'))
+    ua_fields = ['user_agent', 'browser', 'browser_version', 'operating_system', 'device_type', 'is_mobile', 'is_tablet', 'is_pc']
+    agents = {row[0]: row[1:] for row in UserAgent.objects.values_list('id', *ua_fields)}
+    no_agent = ('', '', '', '', '', False, False, False)
+
+    connection = schema_editor.connection
+    sql = _update_sql(connection, PageView._meta.db_table, ['path', 'full_path', 'referer', *ua_fields])
+    last_id = 0
+
+    while True:
+        rows = list(
+            PageView.objects.filter(id__gt=last_id, route__isnull=False)
+            .order_by('id')
+            .values_list('id', 'route_id', 'query_string', 'referer_domain_id', 'user_agent_ref_id')[:CHUNK_SIZE]
+        )
+        if not rows:
+            return
+
+        params = []
+        for row_id, route_id, query_string, domain_id, agent_id in rows:
+            path = routes[route_id]
+            full_path = f'{path}?{query_string}' if query_string else path
+            referer = f'https://{domains[domain_id]}/' if domain_id else ''
+            params.append((path, full_path, referer, *agents.get(agent_id, no_agent), row_id))
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, params)
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('analytics', '0008_pageview_dimensions'),
+    ]
+
+    operations = [
+        migrations.RunPython(encode_page_views, decode_page_views),
+    ]
@@ -0,0 +1,84 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0009_encode_pageview_dimensions'),
+    ]
+
+    operations = [
+        # State only: gives the reverse of the RemoveFields below a default
+        # to re-add these NOT NULL columns with, before 0009 decodes them
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='pageview',
+                name='path',
+                field=models.CharField(default='', max_length=255),
+            ),
+            migrations.AlterField(
+                model_name='pageview',
+                name='full_path',
+                field=models.TextField(default=''),
+            ),
+        ]),
+        migrations.RemoveIndex(
+            model_name='pageview',
+            name='analytics_p_path_3382b5_idx',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='path',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='full_path',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='referer',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='user_agent',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='browser',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='browser_version',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='operating_system',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='device_type',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='is_mobile',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='is_tablet',
+        ),
+        migrations.RemoveField(
+            model_name='pageview',
+            name='is_pc',
+        ),
+        migrations.RenameField(
+            model_name='pageview',
+            old_name='user_agent_ref',
+            new_name='user_agent',
+        ),
+        migrations.AlterField(
+            model_name='pageview',
+            name='route',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='page_views', to='analytics.route'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_user_page_views(apps, schema_editor):
+    # Page views already folded by rollup_analytics (up to its watermark)
+    # would otherwise never reach the new table
+    PageView = apps.get_model('analytics', 'PageView')
+    RollupWatermark = apps.get_model('analytics', 'RollupWatermark')
+    UserPageViewDaily = apps.get_model('analytics', 'UserPageViewDaily')
+
+    last_id = RollupWatermark.objects.filter(name='page_views').values_list('last_id', flat=True).first()
+    if not last_id:
+        return
+    rows = (
+        PageView.objects.filter(id__lte=last_id, user__isnull=False)
+        .annotate(date=TruncDate('timestamp'))
+        .values_list('date', 'user_id')
+        .annotate(views=Sum('weight'))
+        .order_by()
+    )
+    UserPageViewDaily.objects.bulk_create(
+        (UserPageViewDaily(date=date, user_id=user_id, views=views) for date, user_id, views in rows.iterator()),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0010_remove_pageview_strings'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPageViewDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('views', models.PositiveIntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_page_views', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'User Page View Daily Rollups',
+                'indexes': [models.Index(fields=['date'], name='analytics_u_date_3bffbc_idx')],
+                'unique_together': {('date', 'user')},
+            },
+        ),
+        migrations.RunPython(backfill_user_page_views, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:56
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_counters(apps, schema_editor):
+    # Concurrent first increments could create several counter rows for one
+    # object; fold them into the oldest row before making it unique
+    for model_name, fk, fields in (
+        ('OfferAnalytics', 'offer', ('views', 'saves', 'code_copies', 'uses')),
+        ('StoreAnalytics', 'store', ('views', 'offer_clicks')),
+        ('CategoryAnalytics', 'category', ('views', 'offer_clicks')),
+    ):
+        model = apps.get_model('analytics', model_name)
+        duplicated = (
+            model.objects.values(fk).annotate(rows=Count('id')).filter(rows__gt=1).values_list(fk, flat=True)
+        )
+        for object_id in list(duplicated):
+            rows = list(model.objects.filter(**{fk: object_id}).order_by('id'))
+            keep = rows[0]
+            for field in fields:
+                setattr(keep, field, sum(getattr(row, field) for row in rows))
+            keep.last_viewed = max((row.last_viewed for row in rows if row.last_viewed), default=None)
+            keep.save()
+            model.objects.filter(pk__in=[row.pk for row in rows[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0011_user_page_view_daily'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_counters, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='categoryanalytics',
+            constraint=models.UniqueConstraint(fields=('category',), name='unique_category_analytics'),
+        ),
+        migrations.AddConstraint(
+            model_name='offeranalytics',
+            constraint=models.UniqueConstraint(fields=('offer',), name='unique_offer_analytics'),
+        ),
+        migrations.AddConstraint(
+            model_name='storeanalytics',
+            constraint=models.UniqueConstraint(fields=('store',), name='unique_store_analytics'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analytics', '0012_unique_counter_rows'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pageview',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
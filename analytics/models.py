@@ -2,19 +2,26 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 import json
-import user_agents
+from .counters import counter_engine
 
-class PageView(models.Model):
-    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
-    session_id = models.CharField(max_length=255, blank=True)
-    path = models.CharField(max_length=255)
-    full_path = models.TextField()
-    referer = models.TextField(blank=True)
-    timestamp = models.DateTimeField(default=timezone.now)
+class Route(models.Model):
+    """Normalized request path (no query string), shared by page views."""
+    path = models.CharField(max_length=255, unique=True)
     
-    # Device and browser info
-    ip_address = models.GenericIPAddressField(null=True, blank=True)
-    user_agent = models.TextField(blank=True)
+    def __str__(self):
+        return self.path
+
+class RefererDomain(models.Model):
+    domain = models.CharField(max_length=255, unique=True)
+    
+    def __str__(self):
+        return self.domain
+
+class UserAgent(models.Model):
+    """One row per distinct user agent string, parsed once when first seen."""
+    # SHA-1 of the raw string; TextField values can't be indexed uniquely everywhere
+    hash = models.CharField(max_length=40, unique=True)
+    user_agent = models.TextField()
     browser = models.CharField(max_length=100, blank=True)
     browser_version = models.CharField(max_length=50, blank=True)
     operating_system = models.CharField(max_length=100, blank=True)
@@ -22,39 +29,50 @@ class PageView(models.Model):
     is_mobile = models.BooleanField(default=False)
     is_tablet = models.BooleanField(default=False)
     is_pc = models.BooleanField(default=False)
+    is_bot = models.BooleanField(default=False)
+    
+    def __str__(self):
+        return self.user_agent[:80]
+
+class PageView(models.Model):
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    session_id = models.CharField(max_length=255, blank=True)
+    
+    # Strings are stored once in the dimension tables above and resolved
+    # to ids at ingest (see analytics/dimensions.py)
+    route = models.ForeignKey(Route, on_delete=models.PROTECT, related_name='page_views')
+    query_string = models.TextField(blank=True)
+    referer_domain = models.ForeignKey(RefererDomain, on_delete=models.PROTECT, null=True, blank=True, related_name='page_views')
+    timestamp = models.DateTimeField(default=timezone.now)
+    
+    # Device and browser info
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    user_agent = models.ForeignKey(UserAgent, on_delete=models.PROTECT, null=True, blank=True, related_name='page_views')
     
-    # Location info (optional, would require a geoip service)
+    # Location info, filled from a local GeoIP database when configured (see analytics/geoip.py)
     country = models.CharField(max_length=100, blank=True)
     city = models.CharField(max_length=100, blank=True)
     
+    # Page views this row stands for; above 1 when recorded under sampling
+    weight = models.PositiveIntegerField(default=1)
+    
+    # Response status; null on rows recorded before it was stored
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    
     class Meta:
         ordering = ['-timestamp']
         indexes = [
             models.Index(fields=['timestamp']),
             models.Index(fields=['user']),
-            models.Index(fields=['path']),
         ]
     
     def __str__(self):
-        return f"{self.path} at {self.timestamp}"
-    
-    def parse_user_agent(self):
-        if self.user_agent:
-            ua_string = self.user_agent
-            user_agent_obj = user_agents.parse(ua_string)
-            
-            self.browser = user_agent_obj.browser.family
-            self.browser_version = user_agent_obj.browser.version_string
-            self.operating_system = user_agent_obj.os.family
-            self.device_type = user_agent_obj.device.family
-            self.is_mobile = user_agent_obj.is_mobile
-            self.is_tablet = user_agent_obj.is_tablet
-            self.is_pc = user_agent_obj.is_pc
-            
-            self.save(update_fields=[
-                'browser', 'browser_version', 'operating_system', 
-                'device_type', 'is_mobile', 'is_tablet', 'is_pc'
-            ])
+        return f"{self.route.path} at {self.timestamp}"
+    
+    @property
+    def full_path(self):
+        path = self.route.path
+        return f"{path}?{self.query_string}" if self.query_string else path
 
 class Event(models.Model):
     EVENT_TYPES = [
@@ -77,6 +95,8 @@ class Event(models.Model):
     element = models.CharField(max_length=255, blank=True)
     data = models.JSONField(default=dict, blank=True)
     timestamp = models.DateTimeField(default=timezone.now)
+    # Client-generated ID used to drop retried events from batch uploads
+    client_event_id = models.CharField(max_length=64, unique=True, null=True, blank=True)
     
     class Meta:
         ordering = ['-timestamp']
@@ -124,26 +144,26 @@ class OfferAnalytics(models.Model):
     
     class Meta:
         verbose_name_plural = "Offer Analytics"
+        # One counter row per offer; the counter engine upserts against it
+        constraints = [
+            models.UniqueConstraint(fields=['offer'], name='unique_offer_analytics'),
+        ]
     
     def __str__(self):
         return f"Analytics for {self.offer.title}"
     
+    # Increments are queued in the counter engine and flushed as F() updates
     def increment_views(self):
-        self.views += 1
-        self.last_viewed = timezone.now()
-        self.save(update_fields=['views', 'last_viewed'])
+        counter_engine.incr('offer', self.offer_id, 'views')
     
     def increment_saves(self):
-        self.saves += 1
-        self.save(update_fields=['saves'])
+        counter_engine.incr('offer', self.offer_id, 'saves')
     
     def increment_code_copies(self):
-        self.code_copies += 1
-        self.save(update_fields=['code_copies'])
+        counter_engine.incr('offer', self.offer_id, 'code_copies')
     
     def increment_uses(self):
-        self.uses += 1
-        self.save(update_fields=['uses'])
+        counter_engine.incr('offer', self.offer_id, 'uses')
 
 class StoreAnalytics(models.Model):
     store = models.ForeignKey('coupons.Store', on_delete=models.CASCADE, related_name='analytics')
@@ -153,18 +173,19 @@ class StoreAnalytics(models.Model):
     
     class Meta:
         verbose_name_plural = "Store Analytics"
+        # One counter row per store; the counter engine upserts against it
+        constraints = [
+            models.UniqueConstraint(fields=['store'], name='unique_store_analytics'),
+        ]
     
     def __str__(self):
         return f"Analytics for {self.store.name}"
     
     def increment_views(self):
-        self.views += 1
-        self.last_viewed = timezone.now()
-        self.save(update_fields=['views', 'last_viewed'])
+        counter_engine.incr('store', self.store_id, 'views')
     
     def increment_offer_clicks(self):  # Renamed from increment_coupon_clicks
-        self.offer_clicks += 1
-        self.save(update_fields=['offer_clicks'])
+        counter_engine.incr('store', self.store_id, 'offer_clicks')
 
 class CategoryAnalytics(models.Model):
     category = models.ForeignKey('coupons.Category', on_delete=models.CASCADE, related_name='analytics')
@@ -174,20 +195,56 @@ class CategoryAnalytics(models.Model):
     
     class Meta:
         verbose_name_plural = "Category Analytics"
+        # One counter row per category; the counter engine upserts against it
+        constraints = [
+            models.UniqueConstraint(fields=['category'], name='unique_category_analytics'),
+        ]
     
     def __str__(self):
         return f"Analytics for {self.category.name}"
     
     def increment_views(self):
-        self.views += 1
-        self.last_viewed = timezone.now()
-        self.save(update_fields=['views', 'last_viewed'])
+        counter_engine.incr('category', self.category_id, 'views')
     
     def increment_offer_clicks(self):  # Renamed from increment_coupon_clicks
-        self.offer_clicks += 1
-        self.save(update_fields=['offer_clicks'])
+        counter_engine.incr('category', self.category_id, 'offer_clicks')
+
+class StoreDaily(models.Model):
+    """Store counters per day, written alongside StoreAnalytics"""
+    date = models.DateField()
+    store = models.ForeignKey('coupons.Store', on_delete=models.CASCADE, related_name='daily_stats')
+    views = models.PositiveIntegerField(default=0)
+    offer_clicks = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('date', 'store')
+        verbose_name_plural = "Store Daily Stats"
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.store_id} on {self.date}: {self.views} views"
+
+class CategoryDaily(models.Model):
+    """Category counters per day, written alongside CategoryAnalytics"""
+    date = models.DateField()
+    category = models.ForeignKey('coupons.Category', on_delete=models.CASCADE, related_name='daily_stats')
+    views = models.PositiveIntegerField(default=0)
+    offer_clicks = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('date', 'category')
+        verbose_name_plural = "Category Daily Stats"
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.category_id} on {self.date}: {self.views} views"
 
 class UserActivity(models.Model):
+    """Semantic user actions (saves, uses, subscriptions); page views live in PageView"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='activity')
     session_id = models.CharField(max_length=255, blank=True)
     activity_type = models.CharField(max_length=100)
@@ -203,4 +260,90 @@ class UserActivity(models.Model):
         ]
     
     def __str__(self):
-        return f"{self.user.username} - {self.activity_type} at {self.timestamp}"
\ No newline at end of file
+        return f"{self.user.username} - {self.activity_type} at {self.timestamp}"
+
+# Daily rollups maintained incrementally by the rollup_analytics command
+class PageViewDaily(models.Model):
+    DEVICE_CLASSES = [
+        ('mobile', 'Mobile'),
+        ('tablet', 'Tablet'),
+        ('desktop', 'Desktop'),
+        ('other', 'Other'),
+    ]
+    
+    date = models.DateField()
+    path = models.CharField(max_length=255)
+    device_class = models.CharField(max_length=10, choices=DEVICE_CLASSES)
+    browser = models.CharField(max_length=100, blank=True)
+    country = models.CharField(max_length=100, blank=True)
+    views = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('date', 'path', 'device_class', 'browser', 'country')
+        verbose_name_plural = "Page View Daily Rollups"
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.path} on {self.date}: {self.views}"
+
+class EventDaily(models.Model):
+    date = models.DateField()
+    event_type = models.CharField(max_length=50)
+    offer = models.ForeignKey('coupons.Coupon', on_delete=models.CASCADE, null=True, blank=True, related_name='daily_events')
+    count = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('date', 'event_type', 'offer')
+        verbose_name_plural = "Event Daily Rollups"
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.event_type} on {self.date}: {self.count}"
+
+class UserPageViewDaily(models.Model):
+    """Page views per signed-in user and day; page view activity is read from here"""
+    date = models.DateField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_page_views')
+    views = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('date', 'user')
+        verbose_name_plural = "User Page View Daily Rollups"
+        indexes = [
+            models.Index(fields=['date']),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} on {self.date}: {self.views} views"
+
+class RollupWatermark(models.Model):
+    """Highest raw row id already folded into a rollup table"""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name} @ {self.last_id}"
+
+class VisitorSketchDaily(models.Model):
+    """HyperLogLog sketch of the distinct sessions/users/IPs seen on one day"""
+    DIMENSIONS = [
+        ('session', 'Sessions'),
+        ('user', 'Users'),
+        ('ip', 'IP addresses'),
+    ]
+    
+    date = models.DateField()
+    dimension = models.CharField(max_length=10, choices=DIMENSIONS)
+    sketch = models.BinaryField()
+    
+    class Meta:
+        unique_together = ('date', 'dimension')
+        verbose_name_plural = "Visitor Sketch Daily Rollups"
+    
+    def __str__(self):
+        return f"{self.dimension} sketch on {self.date}"
@@ -0,0 +1,143 @@
+"""
+Recompute offer counters from raw history.
+
+Views are offer detail page views in PageView with a status the
+middleware counts (context.COUNTED_STATUS_CODES), expired offers' 410
+pages included. Saves, code copies and uses are the matching Event rows
+(see events.OFFER_COUNTER_EVENTS).
+
+The recomputed numbers are lower bounds of the true counters: rows
+moved out by archive_analytics are not counted, and only history older
+than SETTLE_TIME is, since the matching increments of recent rows may
+still be pending in some worker's counter engine. Applying drift
+therefore only ever raises a stored counter to its recomputed value.
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .context import COUNTED_STATUS_CODES
+from .events import OFFER_COUNTER_EVENTS
+from .funnels import DETAIL_PATH
+from .models import Event, OfferAnalytics, PageView, Route
+
+COUNTER_FIELDS = ('views', 'saves', 'code_copies', 'uses')
+
+# Sections an offer detail URL can live under (Coupon.section)
+OFFER_SECTIONS = ('special', 'amazon', 'coupons', 'deals')
+
+# History newer than this is left out; by then every worker has flushed
+# the counter increments for it
+SETTLE_TIME = timedelta(minutes=15)
+
+
+def recompute_offer_counters(offers, before=None):
+    """
+    {offer pk: {field: count}} recomputed for a list of (pk, slug) from
+    the history recorded before `before` (default: SETTLE_TIME ago).
+    """
+    before = before or timezone.now() - SETTLE_TIME
+    by_slug = {slug: pk for pk, slug in offers}
+    truth = {pk: Counter() for pk, _ in offers}
+
+    paths = [f'/deals/{section}/{slug}/' for slug in by_slug for section in OFFER_SECTIONS]
+    routes = dict(Route.objects.filter(path__in=paths).values_list('id', 'path'))
+    views = (
+        PageView.objects.filter(route_id__in=list(routes), timestamp__lt=before)
+        # Counted like the middleware does; older rows have no status
+        .filter(Q(status_code__in=COUNTED_STATUS_CODES) | Q(status_code__isnull=True))
+        .values_list('route_id')
+        .annotate(count=Sum('weight'))
+        .order_by()
+    )
+    for route_id, count in views:
+        truth[by_slug[DETAIL_PATH.match(routes[route_id]).group(1)]]['views'] += count
+
+    events = (
+        Event.objects.filter(event_type__in=list(OFFER_COUNTER_EVENTS), data__slug__in=list(by_slug), timestamp__lt=before)
+        .values_list('data__slug', 'event_type')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    for slug, event_type, count in events:
+        if slug in by_slug:
+            truth[by_slug[slug]][OFFER_COUNTER_EVENTS[event_type]] += count
+
+    return truth
+
+
+def apply_counters(pk, counts):
+    """
+    Raise an offer's stored counters to at least `counts`. Counters are
+    never lowered, and increments flushed meanwhile are kept.
+    """
+    counts = {field: counts[field] for field in COUNTER_FIELDS if counts.get(field)}
+    if not counts:
+        return
+    raised = {field: Greatest(F(field), count) for field, count in counts.items()}
+    if OfferAnalytics.objects.filter(offer_id=pk).update(**raised):
+        return
+    try:
+        with transaction.atomic():
+            OfferAnalytics.objects.create(offer_id=pk, **counts)
+    except IntegrityError:
+        # Created by a counter flush since the UPDATE
+        OfferAnalytics.objects.filter(offer_id=pk).update(**raised)
+
+
+def _reconcile_chunk(offers, before):
+    try:
+        truth = recompute_offer_counters(offers, before)
+        stored = {
+            row['offer_id']: Counter({field: row[field] for field in COUNTER_FIELDS})
+            for row in OfferAnalytics.objects.filter(offer_id__in=list(truth)).values('offer_id', *COUNTER_FIELDS)
+        }
+
+        drift = []
+        for pk, counts in truth.items():
+            current = stored.get(pk, Counter())
+            delta = {field: counts[field] - current[field] for field in COUNTER_FIELDS}
+            if any(delta.values()):
+                drift.append((pk, dict(current), dict(counts), delta))
+        return len(offers), drift
+    finally:
+        close_old_connections()
+
+
+def reconcile_offers(chunk_size=1000, workers=4, apply=False):
+    """
+    Compare stored offer counters with recomputed ones, chunk by chunk
+    on a thread pool. Yields (offers checked, drift rows) per chunk, where
+    a drift row is (offer pk, stored, recomputed, recomputed - stored).
+    With apply=True stored counters below their recomputed value are
+    raised to it (see apply_counters); workers only read, the writes
+    happen here in the calling thread.
+    """
+    from coupons.models import Coupon
+
+    def chunks():
+        chunk = []
+        for offer in Coupon.objects.order_by('pk').values_list('pk', 'slug').iterator(chunk_size=chunk_size):
+            chunk.append(offer)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    # One cutoff for every chunk, so the report is consistent
+    before = timezone.now() - SETTLE_TIME
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_reconcile_chunk, chunk, before) for chunk in chunks()]
+        for future in futures:
+            checked, drift = future.result()
+            if apply:
+                with transaction.atomic():
+                    for pk, _, recomputed, delta in drift:
+                        apply_counters(pk, {field: recomputed[field] for field in COUNTER_FIELDS if delta[field] > 0})
+            yield checked, drift
@@ -0,0 +1,506 @@
+"""
+Daily rollups of PageView and Event.
+
+fold_page_views() / fold_events() add raw rows above the stored watermark
+to PageViewDaily / EventDaily. The *_counts() readers answer closed days
+from the rollups and only read raw rows for today (plus anything above
+the watermark that has not been folded yet), so results stay exact no
+matter how often the rollup command runs.
+
+Page view counts sum PageView.weight, so rows recorded under adaptive
+sampling (see analytics/sampling.py) count for the views they stand for.
+
+Distinct sessions, users and IPs are kept as one HyperLogLog sketch per
+day and dimension in VisitorSketchDaily, built by the same fold;
+unique_counts() merges them for any date range.
+"""
+from collections import Counter
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, CharField, Count, F, Max, Min, Q, Sum, Value, When
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .hll import DEFAULT_PRECISION, HyperLogLog
+from .models import (
+    Event, EventDaily, PageView, PageViewDaily, RollupWatermark, Route, UserAgent, UserPageViewDaily,
+    VisitorSketchDaily,
+)
+
+PAGE_VIEW_WATERMARK = 'page_views'
+EVENT_WATERMARK = 'events'
+
+
+
+def _device_class(prefix=''):
+    return Case(
+        When(**{f'{prefix}is_mobile': True}, then=Value('mobile')),
+        When(**{f'{prefix}is_tablet': True}, then=Value('tablet')),
+        When(**{f'{prefix}is_pc': True}, then=Value('desktop')),
+        default=Value('other'),
+        output_field=CharField(),
+    )
+
+
+# On UserAgent rows, and through PageView.user_agent
+DEVICE_CLASS = _device_class()
+PAGE_VIEW_DEVICE_CLASS = _device_class('user_agent__')
+
+NO_USER_AGENT = ('other', '')
+
+PAGE_VIEW_DIMENSIONS = ('date', 'path', 'device_class', 'browser', 'country')
+
+# PageViewDaily fields that live in a dimension table for raw PageView rows
+RAW_FILTER_FIELDS = {
+    'path': 'route__path',
+    'browser': 'user_agent__browser',
+}
+
+# Ids per query when decoding dimension keys
+DECODE_BATCH_SIZE = 5000
+EVENT_DIMENSIONS = ('date', 'event_type', 'offer_id')
+
+# Sketch dimension -> PageView field
+SKETCH_FIELDS = {
+    'session': 'session_id',
+    'user': 'user_id',
+    'ip': 'ip_address',
+}
+
+DEFAULT_SKETCH_SETTINGS = {
+    'PRECISION': DEFAULT_PRECISION,  # 2**p registers; standard error 1.04 / sqrt(2**p)
+    'EXACT_DAYS': 1,                 # Windows this short are counted exactly from raw rows
+}
+
+
+def get_sketch_settings():
+    conf = dict(DEFAULT_SKETCH_SETTINGS)
+    conf.update(getattr(settings, 'ANALYTICS_VISITOR_SKETCHES', {}))
+    return conf
+
+
+def get_watermark(name):
+    return RollupWatermark.objects.filter(name=name).values_list('last_id', flat=True).first() or 0
+
+
+def _set_watermark(name, last_id):
+    RollupWatermark.objects.update_or_create(name=name, defaults={'last_id': last_id})
+
+
+def _fold_upper_bound(model, lag):
+    # Leave the most recent rows alone so transactions that are still
+    # committing lower ids are not skipped by the watermark
+    cutoff = timezone.now() - timedelta(seconds=lag)
+    return model.objects.filter(timestamp__lte=cutoff).aggregate(max_id=Max('id'))['max_id'] or 0
+
+
+def _upsert(model, dimensions, amount_field, amount):
+    updated = model.objects.filter(**dimensions).update(**{amount_field: F(amount_field) + amount})
+    if not updated:
+        model.objects.create(**dimensions, **{amount_field: amount})
+
+
+def _decode(model, ids, *fields):
+    """{id: value (or tuple of values)} for dimension rows, in batches."""
+    ids = [row_id for row_id in ids if row_id is not None]
+    queryset = model.objects.all()
+    if model is UserAgent and 'device_class' in fields:
+        queryset = queryset.annotate(device_class=DEVICE_CLASS)
+    decoded = {}
+    for start in range(0, len(ids), DECODE_BATCH_SIZE):
+        for row in queryset.filter(id__in=ids[start:start + DECODE_BATCH_SIZE]).values_list('id', *fields):
+            decoded[row[0]] = row[1] if len(fields) == 1 else row[1:]
+    return decoded
+
+
+def route_paths(route_ids):
+    return _decode(Route, route_ids, 'path')
+
+
+def user_agent_dimensions(user_agent_ids):
+    """{user agent id: (device_class, browser)}; rows without one map from None."""
+    decoded = _decode(UserAgent, user_agent_ids, 'device_class', 'browser')
+    decoded[None] = NO_USER_AGENT
+    return decoded
+
+
+def _fold_page_view_chunk(rows, watermark=None):
+    """
+    Add one chunk of PageView rows to the rollups, moving the watermark
+    to `watermark` in the same transaction. Returns views folded.
+    """
+    # Group by the integer keys, then decode the (few) distinct ids
+    groups = list(
+        rows.annotate(date=TruncDate('timestamp'))
+        .values_list('date', 'route_id', 'user_agent_id', 'country')
+        .annotate(views=Sum('weight'))
+        .order_by()
+    )
+    paths = route_paths({group[1] for group in groups})
+    agents = user_agent_dimensions({group[2] for group in groups})
+    totals = Counter()
+    for date, route_id, user_agent_id, country, views in groups:
+        device_class, browser = agents.get(user_agent_id, NO_USER_AGENT)
+        totals[(date, paths[route_id], device_class, browser, country)] += views
+
+    users = (
+        rows.filter(user__isnull=False)
+        .annotate(date=TruncDate('timestamp'))
+        .values_list('date', 'user_id')
+        .annotate(views=Sum('weight'))
+        .order_by()
+    )
+
+    folded = 0
+    with transaction.atomic():
+        for key, views in totals.items():
+            folded += views
+            _upsert(PageViewDaily, dict(zip(PAGE_VIEW_DIMENSIONS, key)), 'views', views)
+        for date, user_id, views in users:
+            _upsert(UserPageViewDaily, {'date': date, 'user_id': user_id}, 'views', views)
+        _fold_sketches(rows)
+        if watermark is not None:
+            _set_watermark(PAGE_VIEW_WATERMARK, watermark)
+    return folded
+
+
+def fold_page_views(chunk_size=50000, lag=60):
+    """Fold new PageView rows into PageViewDaily. Returns rows folded."""
+    last_id = get_watermark(PAGE_VIEW_WATERMARK)
+    upper = _fold_upper_bound(PageView, lag)
+    folded = 0
+
+    while last_id < upper:
+        chunk_end = min(last_id + chunk_size, upper)
+        rows = PageView.objects.filter(id__gt=last_id, id__lte=chunk_end)
+        folded += _fold_page_view_chunk(rows, watermark=chunk_end)
+        last_id = chunk_end
+
+    return folded
+
+
+def _add_to_sketches(sketches, row):
+    for dimension, value in zip(SKETCH_FIELDS, row):
+        if value not in (None, ''):
+            sketches[dimension].add(value)
+
+
+def _fold_sketches(rows):
+    precision = get_sketch_settings()['PRECISION']
+    sketches = {}
+    rows = (
+        rows.annotate(date=TruncDate('timestamp'))
+        .values_list('date', *SKETCH_FIELDS.values())
+        .order_by()
+        .iterator(chunk_size=5000)
+    )
+    for date, *row in rows:
+        if date not in sketches:
+            sketches[date] = {dimension: HyperLogLog(precision) for dimension in SKETCH_FIELDS}
+        _add_to_sketches(sketches[date], row)
+
+    stored = VisitorSketchDaily.objects.filter(date__in=list(sketches))
+    for existing in stored:
+        sketches[existing.date][existing.dimension].merge(
+            HyperLogLog.from_bytes(existing.sketch).reduce(precision)
+        )
+
+    for date, by_dimension in sketches.items():
+        for dimension, sketch in by_dimension.items():
+            VisitorSketchDaily.objects.update_or_create(
+                date=date, dimension=dimension, defaults={'sketch': sketch.to_bytes()}
+            )
+
+
+def _fold_event_chunk(rows, watermark=None):
+    """Add one chunk of Event rows to EventDaily, like _fold_page_view_chunk()."""
+    from .events import resolve_offers
+
+    groups = list(
+        rows.annotate(date=TruncDate('timestamp'), slug=KeyTextTransform('slug', 'data'))
+        .values('date', 'event_type', 'slug')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    offer_ids = resolve_offers(group['slug'] for group in groups)
+
+    totals = Counter()
+    for group in groups:
+        slug = group['slug']
+        offer_id = offer_ids.get(slug) if isinstance(slug, str) else None
+        totals[(group['date'], group['event_type'], offer_id)] += group['count']
+
+    folded = 0
+    with transaction.atomic():
+        for (date, event_type, offer_id), count in totals.items():
+            folded += count
+            _upsert(EventDaily, {'date': date, 'event_type': event_type, 'offer_id': offer_id}, 'count', count)
+        if watermark is not None:
+            _set_watermark(EVENT_WATERMARK, watermark)
+    return folded
+
+
+def fold_events(chunk_size=50000, lag=60):
+    """Fold new Event rows into EventDaily. Returns rows folded."""
+    last_id = get_watermark(EVENT_WATERMARK)
+    upper = _fold_upper_bound(Event, lag)
+    folded = 0
+
+    while last_id < upper:
+        chunk_end = min(last_id + chunk_size, upper)
+        rows = Event.objects.filter(id__gt=last_id, id__lte=chunk_end)
+        folded += _fold_event_chunk(rows, watermark=chunk_end)
+        last_id = chunk_end
+
+    return folded
+
+
+# Rebuilding
+
+def _incomplete_days(model, watermark_name, rollup, amount, rolled_amount):
+    """Days the rollup counts more for than the folded raw rows still hold."""
+    raw = dict(
+        model.objects.filter(id__lte=get_watermark(watermark_name))
+        .annotate(date=TruncDate('timestamp'))
+        .values_list('date').annotate(total=amount).order_by()
+    )
+    rolled = rollup.objects.values_list('date').annotate(total=Sum(rolled_amount)).order_by()
+    return {date for date, total in rolled if raw.get(date, 0) < total}
+
+
+def rebuild_start():
+    """
+    First day the rollups can be rebuilt from: archive_analytics deletes
+    raw rows once they are folded, so days it has touched can only be kept
+    as they are. None when no raw rows were archived, i.e. every day can be
+    rebuilt.
+    """
+    incomplete = (
+        _incomplete_days(PageView, PAGE_VIEW_WATERMARK, PageViewDaily, Sum('weight'), 'views')
+        | _incomplete_days(Event, EVENT_WATERMARK, EventDaily, Count('id'), 'count')
+    )
+    if not incomplete:
+        return None
+    return max(incomplete) + timedelta(days=1)
+
+
+def _refold(model, watermark_name, start, chunk_size, fold_chunk):
+    # Rows already folded, from `start` on; newer ones are left to the
+    # regular fold
+    rows = model.objects.filter(id__lte=get_watermark(watermark_name))
+    if start is not None:
+        rows = rows.filter(timestamp__gte=_day_start(start))
+    last_id = (rows.aggregate(min_id=Min('id'))['min_id'] or 1) - 1
+    upper = rows.aggregate(max_id=Max('id'))['max_id'] or 0
+    folded = 0
+    while last_id < upper:
+        chunk_end = min(last_id + chunk_size, upper)
+        folded += fold_chunk(rows.filter(id__gt=last_id, id__lte=chunk_end))
+        last_id = chunk_end
+    return folded
+
+
+def rebuild_rollups(chunk_size=50000):
+    """
+    Drop the rollups from rebuild_start() on and fold the raw rows of those
+    days again. Returns (start day or None for all days, views, events).
+    """
+    start = rebuild_start()
+    rollups = (PageViewDaily, EventDaily, UserPageViewDaily, VisitorSketchDaily)
+    with transaction.atomic():
+        for rollup in rollups:
+            stale = rollup.objects.all() if start is None else rollup.objects.filter(date__gte=start)
+            stale.delete()
+
+    views = _refold(PageView, PAGE_VIEW_WATERMARK, start, chunk_size, _fold_page_view_chunk)
+    events = _refold(Event, EVENT_WATERMARK, start, chunk_size, _fold_event_chunk)
+    return start, views, events
+
+
+# Readers
+
+def window_start(days):
+    """First calendar day of a window of `days` days ending today."""
+    return timezone.localdate() - timedelta(days=days)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def _unfolded(model, watermark_name, start_day):
+    today = _day_start(timezone.localdate())
+    return model.objects.filter(timestamp__gte=_day_start(start_day)).filter(
+        Q(timestamp__gte=today) | Q(id__gt=get_watermark(watermark_name))
+    )
+
+
+def _merge(*sources):
+    totals = Counter()
+    for rows in sources:
+        for key, count in rows:
+            totals[key] += count
+    return totals
+
+
+def _filter_raw(queryset, filters):
+    # Filters are PageViewDaily lookups; translate them for PageView
+    lookups = {}
+    for lookup, value in filters.items():
+        field, _, rest = lookup.partition('__')
+        if field == 'device_class':
+            queryset = queryset.annotate(device_class=PAGE_VIEW_DEVICE_CLASS)
+        field = RAW_FILTER_FIELDS.get(field, field)
+        lookups[f'{field}__{rest}' if rest else field] = value
+    return queryset.filter(**lookups)
+
+
+def page_view_counts(start_day, dimension=None, **filters):
+    """
+    Page views since start_day, as a Counter keyed by `dimension`
+    (one of PAGE_VIEW_DIMENSIONS), or the plain total when dimension is None.
+    """
+    rolled = PageViewDaily.objects.filter(date__gte=start_day, date__lt=timezone.localdate(), **filters)
+    raw = _filter_raw(_unfolded(PageView, PAGE_VIEW_WATERMARK, start_day), filters)
+
+    if dimension is None:
+        return (
+            (rolled.aggregate(total=Sum('views'))['total'] or 0)
+            + (raw.aggregate(total=Sum('weight'))['total'] or 0)
+        )
+
+    # Raw rows are grouped by dimension ids and decoded afterwards
+    if dimension == 'path':
+        groups = list(raw.values_list('route_id').annotate(count=Sum('weight')).order_by())
+        paths = route_paths({route_id for route_id, _ in groups})
+        raw_rows = [(paths[route_id], count) for route_id, count in groups]
+    elif dimension in ('device_class', 'browser'):
+        groups = list(raw.values_list('user_agent_id').annotate(count=Sum('weight')).order_by())
+        agents = user_agent_dimensions({user_agent_id for user_agent_id, _ in groups})
+        index = 0 if dimension == 'device_class' else 1
+        raw_rows = [(agents.get(user_agent_id, NO_USER_AGENT)[index], count) for user_agent_id, count in groups]
+    else:
+        if dimension == 'date':
+            raw = raw.annotate(date=TruncDate('timestamp'))
+        raw_rows = raw.values_list(dimension).annotate(count=Sum('weight')).order_by()
+
+    return _merge(
+        rolled.values_list(dimension).annotate(count=Sum('views')).order_by(),
+        raw_rows,
+    )
+
+
+def user_page_view_counts(start_day):
+    """Page views per signed-in user since start_day, as a Counter keyed by user id."""
+    rolled = UserPageViewDaily.objects.filter(date__gte=start_day, date__lt=timezone.localdate())
+    raw = _unfolded(PageView, PAGE_VIEW_WATERMARK, start_day).filter(user__isnull=False)
+    return _merge(
+        rolled.values_list('user_id').annotate(count=Sum('views')).order_by(),
+        raw.values_list('user_id').annotate(count=Sum('weight')).order_by(),
+    )
+
+
+def event_counts(start_day, dimension='event_type', **filters):
+    """Events since start_day as a Counter keyed by `dimension` (one of EVENT_DIMENSIONS)."""
+    from .events import resolve_offers
+
+    rolled = EventDaily.objects.filter(date__gte=start_day, date__lt=timezone.localdate(), **filters)
+    raw = _unfolded(Event, EVENT_WATERMARK, start_day).filter(**filters)
+
+    if dimension == 'offer_id':
+        slugs = Counter(dict(
+            raw.annotate(slug=KeyTextTransform('slug', 'data')).values_list('slug').annotate(count=Count('id')).order_by()
+        ))
+        offer_ids = resolve_offers(slugs)
+        raw_rows = Counter()
+        for slug, count in slugs.items():
+            raw_rows[offer_ids.get(slug) if isinstance(slug, str) else None] += count
+        raw_rows = raw_rows.items()
+    else:
+        if dimension == 'date':
+            raw = raw.annotate(date=TruncDate('timestamp'))
+        raw_rows = raw.values_list(dimension).annotate(count=Count('id')).order_by()
+
+    return _merge(
+        rolled.values_list(dimension).annotate(count=Sum('count')).order_by(),
+        raw_rows,
+    )
+
+
+def unique_counts(start_day):
+    """
+    Distinct sessions, users and IPs since start_day, keyed by sketch
+    dimension. Windows of up to EXACT_DAYS days are counted exactly;
+    longer ones merge the daily sketches with the rows not folded yet, so
+    they carry the HyperLogLog error bound (~0.81% standard error at the
+    default precision, see analytics/hll.py).
+    """
+    conf = get_sketch_settings()
+    today = timezone.localdate()
+
+    if (today - start_day).days <= conf['EXACT_DAYS']:
+        return PageView.objects.filter(timestamp__gte=_day_start(start_day)).aggregate(
+            session=Count('session_id', distinct=True, filter=~Q(session_id='')),
+            user=Count('user', distinct=True),
+            ip=Count('ip_address', distinct=True),
+        )
+
+    stored = [
+        (dimension, HyperLogLog.from_bytes(data))
+        for dimension, data in VisitorSketchDaily.objects.filter(
+            date__gte=start_day, date__lt=today,
+        ).values_list('dimension', 'sketch').iterator()
+    ]
+    # Days kept from before a PRECISION change (archived, so never rebuilt)
+    # bring the whole window down to their precision
+    precision = min([conf['PRECISION']] + [sketch.precision for _, sketch in stored])
+    sketches = {dimension: HyperLogLog(precision) for dimension in SKETCH_FIELDS}
+    for dimension, sketch in stored:
+        sketches[dimension].merge(sketch.reduce(precision))
+
+    # Adding a value twice does not change a sketch, so overlap with the
+    # stored sketches is harmless
+    unfolded = _unfolded(PageView, PAGE_VIEW_WATERMARK, start_day).values_list(*SKETCH_FIELDS.values())
+    for row in unfolded.iterator(chunk_size=5000):
+        _add_to_sketches(sketches, row)
+
+    return {dimension: sketch.count() for dimension, sketch in sketches.items()}
+
+
+def headline_metrics(start_day):
+    """
+    Dashboard headline numbers since start_day: total page views, device
+    class split and distinct sessions/users. Views come from one aggregate
+    over the rollups and one grouped query over the raw rows;
+    distinct counts come from unique_counts().
+    """
+    today = timezone.localdate()
+    rolled = PageViewDaily.objects.filter(date__gte=start_day, date__lt=today).aggregate(
+        total=Sum('views'),
+        mobile=Sum('views', filter=Q(device_class='mobile')),
+        tablet=Sum('views', filter=Q(device_class='tablet')),
+        desktop=Sum('views', filter=Q(device_class='desktop')),
+    )
+
+    metrics = {key: rolled[key] or 0 for key in ('total', 'mobile', 'tablet', 'desktop')}
+
+    # Raw rows grouped by user agent id; the device class comes from the
+    # user agent table, the same way the fold assigns it
+    raw = list(
+        _unfolded(PageView, PAGE_VIEW_WATERMARK, start_day)
+        .values_list('user_agent_id').annotate(views=Sum('weight')).order_by()
+    )
+    agents = user_agent_dimensions({user_agent_id for user_agent_id, _ in raw})
+    for user_agent_id, views in raw:
+        metrics['total'] += views
+        device_class = agents.get(user_agent_id, NO_USER_AGENT)[0]
+        if device_class in metrics:
+            metrics[device_class] += views
+    uniques = unique_counts(start_day)
+    metrics['unique_visitors'] = uniques['session']
+    metrics['unique_users'] = uniques['user']
+    metrics['unique_ips'] = uniques['ip']
+    return metrics
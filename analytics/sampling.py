@@ -0,0 +1,124 @@
+"""
+Adaptive page view sampling.
+
+Under normal load every page view is recorded. When the ingestion buffer
+backs up (its queue depth, smoothed over WINDOW seconds, rises above
+TARGET_QUEUE_DEPTH) page views are recorded with probability p = 1/k and
+stored with weight k, so rollups and dashboard totals that sum weights
+stay unbiased. k grows with the backlog up to MAX_WEIGHT.
+
+Paths matching OVERRIDES use a fixed rate instead (1.0 keeps them at
+100%, e.g. offer detail pages, whose views also feed funnels and counter
+reconciliation).
+
+Distinct session/user/IP counts only see the recorded rows, so they are
+undercounted while sampling is active.
+"""
+import math
+import random
+import re
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_SAMPLING_SETTINGS = {
+    'ENABLED': True,
+    'TARGET_QUEUE_DEPTH': 1000,  # Smoothed queue depth that still records everything
+    'WINDOW': 5.0,               # Seconds the queue depth is averaged over
+    'MAX_WEIGHT': 20,            # Never record fewer than 1 in this many page views
+    'OVERRIDES': [
+        # (path regex, fixed sampling rate)
+        (r'^/deals/[^/]+/[^/]+/$', 1.0),
+    ],
+}
+
+
+def get_sampling_settings():
+    conf = dict(DEFAULT_SAMPLING_SETTINGS)
+    conf.update(getattr(settings, 'ANALYTICS_SAMPLING', {}))
+    return conf
+
+
+def rate_to_weight(rate):
+    """Weight k for a sampling rate, so that the rate actually used is 1/k."""
+    if rate >= 1:
+        return 1
+    return max(1, math.ceil(1 / max(rate, 1e-6)))
+
+
+class AdaptiveSampler:
+    def __init__(self, depth=None):
+        self._depth = depth
+        self._lock = threading.Lock()
+        self._average = 0.0
+        self._updated = time.monotonic()
+        self._overrides = None
+        self._override_source = None
+        self.sampled = 0
+        self.skipped = 0
+
+    @property
+    def conf(self):
+        return get_sampling_settings()
+
+    def _queue_depth(self):
+        if self._depth is not None:
+            return self._depth()
+        from .buffer import page_view_buffer
+        return page_view_buffer.qsize()
+
+    def _observe(self, window):
+        # Exponential moving average over `window` seconds, in wall time
+        depth = self._queue_depth()
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._updated
+            self._updated = now
+            alpha = 1 - math.exp(-elapsed / window) if window > 0 else 1
+            self._average += alpha * (depth - self._average)
+            return self._average
+
+    def _path_rate(self, path, overrides):
+        if self._override_source is not overrides:
+            self._overrides = [(re.compile(pattern), rate) for pattern, rate in overrides]
+            self._override_source = overrides
+        for pattern, rate in self._overrides:
+            if pattern.search(path):
+                return rate
+        return None
+
+    def current_weight(self):
+        """Weight for paths without an override, from the smoothed queue depth."""
+        conf = self.conf
+        average = self._observe(conf['WINDOW'])
+        if average <= conf['TARGET_QUEUE_DEPTH']:
+            return 1
+        return min(rate_to_weight(conf['TARGET_QUEUE_DEPTH'] / average), conf['MAX_WEIGHT'])
+
+    def weight_for(self, path):
+        """
+        Weight to store a page view of `path` with, or None when this
+        view should not be recorded.
+        """
+        conf = self.conf
+        if not conf['ENABLED']:
+            return 1
+
+        rate = self._path_rate(path, conf['OVERRIDES'])
+        weight = rate_to_weight(rate) if rate is not None else self.current_weight()
+        if weight > 1 and random.random() * weight >= 1:
+            self.skipped += 1
+            return None
+        self.sampled += 1
+        return weight
+
+    def stats(self):
+        return {
+            'queue_depth_average': round(self._average, 1),
+            'sampled': self.sampled,
+            'skipped': self.skipped,
+        }
+
+
+page_view_sampler = AdaptiveSampler()
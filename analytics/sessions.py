@@ -0,0 +1,176 @@
+import secrets
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+
+from .buffer import get_buffer_settings, page_view_buffer
+
+DEFAULT_PERSIST_INTERVAL = 60  # seconds
+DEFAULT_COOKIE_NAME = 'analytics_sid'
+
+
+class SessionActivityTracker:
+    """
+    Coalesces per-request session activity in the cache.
+
+    Every request only bumps a hit counter (cache.incr, so concurrent
+    requests of a session never lose hits) and its last activity. The hits
+    accumulated since the last write are handed to the ingestion buffer
+    (and so written to analytics.Session) on the first request of a
+    session and then at most once per ANALYTICS_SESSION_PERSIST_INTERVAL
+    seconds; whoever wins cache.add on the persist key takes the hits,
+    with a decr that gives them back if another writer got there first.
+
+    Hits left pending when a session goes quiet are written through
+    flush_idle() once the session has been idle for an interval: by the
+    buffer's flush thread, or by later requests when the buffer is
+    synchronous. The flush thread writes what is left when the process
+    exits.
+
+    Visitors are told apart by their own cookie rather than a Django
+    session, which would write a row to the session store for every new
+    visitor.
+    """
+
+    cache_prefix = 'analytics_session:'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # session_id -> (monotonic time of the last request, user_id), for
+        # the sessions this process holds unwritten hits for
+        self._pending = {}
+
+    @property
+    def interval(self):
+        return getattr(settings, 'ANALYTICS_SESSION_PERSIST_INTERVAL', DEFAULT_PERSIST_INTERVAL)
+
+    @property
+    def cookie_name(self):
+        return getattr(settings, 'ANALYTICS_SESSION_COOKIE', DEFAULT_COOKIE_NAME)
+
+    def _keys(self, session_id):
+        return {
+            name: f'{self.cache_prefix}{name}:{session_id}'
+            for name in ('start', 'hits', 'seen', 'persisted')
+        }
+
+    # Request side
+
+    def get_session_id(self, request):
+        """The visitor's analytics session id, or '' if they have none yet."""
+        # Visitors from before the cookie keep their Django session's id
+        return request.COOKIES.get(self.cookie_name) or request.session.session_key or ''
+
+    def set_cookie(self, request, response, session_id):
+        """Hand a new session id to the visitor's browser."""
+        if request.COOKIES.get(self.cookie_name) == session_id:
+            return
+        response.set_cookie(
+            self.cookie_name,
+            session_id,
+            max_age=settings.SESSION_COOKIE_AGE,
+            secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True,
+            samesite='Lax',
+        )
+        # The id is this visitor's; no shared cache may keep the response
+        patch_cache_control(response, private=True)
+
+    def new_session_id(self):
+        return secrets.token_urlsafe(24)
+
+    def touch(self, session_id, user_id=None, now=None):
+        now = now or timezone.now()
+        keys = self._keys(session_id)
+        timeout = settings.SESSION_COOKIE_AGE
+
+        try:
+            cache.incr(keys['hits'])
+        except ValueError:
+            # First hit, or the counter expired; add() loses to a concurrent
+            # first hit, which then has to be counted with incr after all
+            if not cache.add(keys['hits'], 1, timeout):
+                cache.incr(keys['hits'])
+        cache.set(keys['seen'], now, timeout)
+
+        if cache.add(keys['persisted'], now, self.interval):
+            self._persist(session_id, user_id, keys)
+            with self._lock:
+                self._pending.pop(session_id, None)
+        else:
+            with self._lock:
+                self._pending[session_id] = (time.monotonic(), user_id)
+
+        if not get_buffer_settings()['ASYNC']:
+            # No flush thread to write sessions gone idle; requests do
+            self.flush_idle()
+
+    def _persist(self, session_id, user_id, keys):
+        values = cache.get_many([keys['start'], keys['hits'], keys['seen']])
+        hits = values.get(keys['hits'], 0)
+        if not hits:
+            return
+        # Hits that arrive meanwhile stay in the counter for the next write
+        try:
+            remaining = cache.decr(keys['hits'], hits)
+        except ValueError:
+            # The counter expired or was evicted since it was read; the
+            # hits read are still written
+            remaining = 0
+        if remaining < 0:
+            # Another writer took these hits between our read and decr
+            try:
+                cache.incr(keys['hits'], hits)
+            except ValueError:
+                pass
+            return
+
+        last_activity = values.get(keys['seen']) or timezone.now()
+        start_time = values.get(keys['start'])
+        if start_time is None:
+            start_time = last_activity
+            cache.add(keys['start'], start_time, settings.SESSION_COOKIE_AGE)
+
+        page_view_buffer.touch_session(
+            session_id,
+            user_id=user_id,
+            start_time=start_time,
+            last_activity=last_activity,
+            hits=hits,
+        )
+
+    def flush_idle(self, force=False):
+        """
+        Write the pending hits of sessions this process has not seen for an
+        interval, or of all of them with force=True. Returns how many
+        sessions were written.
+        """
+        cutoff = time.monotonic() - self.interval
+        with self._lock:
+            idle = [
+                (session_id, seen, user_id)
+                for session_id, (seen, user_id) in self._pending.items()
+                if force or seen <= cutoff
+            ]
+
+        written = 0
+        for session_id, seen, user_id in idle:
+            keys = self._keys(session_id)
+            # Another request is writing this session; the hits it leaves
+            # are picked up on a later pass. On shutdown there is no later
+            # pass, and _persist() never takes hits twice anyway
+            if not cache.add(keys['persisted'], timezone.now(), self.interval) and not force:
+                continue
+            self._persist(session_id, user_id, keys)
+            written += 1
+            with self._lock:
+                if self._pending.get(session_id, (None, None))[0] == seen:
+                    del self._pending[session_id]
+        return written
+
+
+session_tracker = SessionActivityTracker()
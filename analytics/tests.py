@@ -1,3 +1,913 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import ipaddress
+import json
+import os
+import random
+import shutil
+import statistics
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, time as dt_time, timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer
+from django.core.cache import caches
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Sum
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+
+from coupons.models import Category, Coupon, Store
+
+from .archive import archive_table, retention_cutoff
+from .buffer import PageViewBuffer, page_view_buffer
+from .counters import CounterEngine, counter_engine
+from .dimensions import DimensionCache
+from .events import clean_event, ingest_events
+from .export import stream_export
+from .funnels import FUNNEL_STEPS, compute_funnel, funnel_report
+from .geoip import GeoIPResolver
+from .hll import HyperLogLog
+from .live import LiveFeed
+from .models import (
+    Event, OfferAnalytics, PageView, PageViewDaily, Route, StoreAnalytics, StoreDaily, VisitorSketchDaily,
+)
+from .reconcile import recompute_offer_counters
+from .rollups import (
+    event_counts, fold_events, fold_page_views, get_watermark, page_view_counts, unique_counts,
+)
+from .sessions import SessionActivityTracker
+
+
+def _control(type_number, size):
+    # Types above 7 are extended: type 0 in the control byte, the rest after it
+    if size < 29:
+        size_bits, size_bytes = size, b''
+    else:
+        size_bits, size_bytes = 29, bytes([size - 29])
+    if type_number <= 7:
+        return bytes([(type_number << 5) | size_bits]) + size_bytes
+    return bytes([size_bits, type_number - 7]) + size_bytes
+
+
+def _encode(value):
+    """MaxMind DB data section encoding of str, int, list and dict values."""
+    if isinstance(value, str):
+        data = value.encode()
+        return _control(2, len(data)) + data
+    if isinstance(value, int):
+        data = value.to_bytes(8, 'big').lstrip(b'\0')
+        return _control(6 if value < 2 ** 32 else 9, len(data)) + data
+    if isinstance(value, list):
+        return _control(11, len(value)) + b''.join(_encode(item) for item in value)
+    if isinstance(value, dict):
+        return _control(7, len(value)) + b''.join(_encode(k) + _encode(v) for k, v in value.items())
+    raise TypeError(value)
+
+
+def write_mmdb(path, network, record):
+    """
+    Write an IPv4 MaxMind DB that maps `network` to `record` and finds
+    nothing for any other address.
+    """
+    network = ipaddress.ip_network(network)
+    prefix_length = network.prefixlen
+    bits = int(network.network_address)
+    node_count = prefix_length
+    data_pointer = node_count + 16  # The first record of the data section
+
+    tree = b''
+    for depth in range(prefix_length):
+        bit = (bits >> (31 - depth)) & 1
+        follow = depth + 1 if depth + 1 < prefix_length else data_pointer
+        records = [node_count, node_count]  # node_count means not found
+        records[bit] = follow
+        tree += b''.join(struct.pack('>I', r)[1:] for r in records)
+
+    metadata = {
+        'binary_format_major_version': 2,
+        'binary_format_minor_version': 0,
+        'build_epoch': 1700000000,
+        'database_type': 'Test-City',
+        'description': {'en': 'Test database'},
+        'ip_version': 4,
+        'languages': ['en'],
+        'node_count': node_count,
+        'record_size': 24,
+    }
+    with open(path, 'wb') as f:
+        f.write(tree + b'\0' * 16 + _encode(record))
+        f.write(b'\xab\xcd\xefMaxMind.com' + _encode(metadata))
+
+
+LONDON = {
+    'city': {'names': {'en': 'London'}},
+    'country': {'iso_code': 'GB', 'names': {'en': 'United Kingdom'}},
+}
+PARIS = {
+    'city': {'names': {'en': 'Paris'}},
+    'country': {'iso_code': 'FR', 'names': {'en': 'France'}},
+}
+
+
+class GeoIPResolverTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'test.mmdb')
+        write_mmdb(self.path, '81.2.69.0/24', LONDON)
+
+    def resolver(self, **kwargs):
+        resolver = GeoIPResolver(database=self.path, **kwargs)
+        self.addCleanup(resolver.close)
+        return resolver
+
+    def test_lookup_hit(self):
+        resolver = self.resolver()
+        self.assertEqual(resolver.lookup('81.2.69.142'), ('United Kingdom', 'London'))
+        self.assertEqual(resolver.lookup('::ffff:81.2.69.1'), ('United Kingdom', 'London'))
+
+    def test_lookup_is_cached_per_prefix(self):
+        resolver = self.resolver()
+        resolver.lookup('81.2.69.1')
+        resolver.lookup('81.2.69.200')
+        self.assertEqual((resolver.hits, resolver.misses), (1, 1))
+
+    def test_lookup_miss_and_private_addresses(self):
+        resolver = self.resolver()
+        self.assertEqual(resolver.lookup('8.8.8.8'), ('', ''))
+        self.assertEqual(resolver.lookup('10.0.0.1'), ('', ''))
+        self.assertEqual(resolver.lookup('not an ip'), ('', ''))
+        # IPv6 against an IPv4-only database
+        self.assertEqual(resolver.lookup('2001:db8::1'), ('', ''))
+
+    def test_enrich_fills_unset_locations(self):
+        resolver = self.resolver()
+        located = PageView(ip_address='81.2.69.10')
+        unknown = PageView(ip_address='8.8.8.8')
+        preset = PageView(ip_address='81.2.69.11', country='Elsewhere')
+        resolver.enrich([located, unknown, preset])
+        self.assertEqual((located.country, located.city), ('United Kingdom', 'London'))
+        self.assertEqual((unknown.country, unknown.city), ('', ''))
+        self.assertEqual((preset.country, preset.city), ('Elsewhere', ''))
+
+    @override_settings(ANALYTICS_GEOIP={'DATABASE': None})
+    def test_not_configured_is_a_noop(self):
+        resolver = GeoIPResolver()
+        page_view = PageView(ip_address='81.2.69.10')
+        resolver.enrich([page_view])
+        self.assertFalse(resolver.enabled)
+        self.assertEqual(resolver.lookup('81.2.69.10'), ('', ''))
+        self.assertEqual((page_view.country, page_view.city), ('', ''))
+
+    def test_missing_file_is_a_noop(self):
+        resolver = GeoIPResolver(database=os.path.join(self.tmp.name, 'missing.mmdb'))
+        with self.assertLogs('analytics.geoip', 'WARNING'):
+            self.assertFalse(resolver.enabled)
+        self.assertEqual(resolver.lookup('81.2.69.10'), ('', ''))
+
+    def test_reopens_after_file_changes(self):
+        resolver = self.resolver(reload_interval=0)
+        self.assertEqual(resolver.lookup('81.2.69.10'), ('United Kingdom', 'London'))
+
+        # Replaced the way geoipupdate does it, by renaming a new file over it
+        update = os.path.join(self.tmp.name, 'update.mmdb')
+        write_mmdb(update, '81.2.69.0/24', PARIS)
+        os.replace(update, self.path)
+
+        self.assertEqual(resolver.lookup('81.2.69.10'), ('France', 'Paris'))
+
+    def test_unchanged_file_is_checked_once_per_interval(self):
+        resolver = self.resolver(reload_interval=3600)
+        self.assertEqual(resolver.lookup('81.2.69.10'), ('United Kingdom', 'London'))
+        update = os.path.join(self.tmp.name, 'update.mmdb')
+        write_mmdb(update, '81.2.69.0/24', PARIS)
+        os.replace(update, self.path)
+        # Still within the interval, the cached prefix and reader are kept
+        self.assertEqual(resolver.lookup('81.2.69.10'), ('United Kingdom', 'London'))
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'session-tests'}},
+    ANALYTICS_SESSION_PERSIST_INTERVAL=60,
+)
+class SessionActivityTrackerTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.tracker = SessionActivityTracker()
+        patcher = mock.patch.object(page_view_buffer, 'touch_session')
+        self.touch_session = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def written_hits(self):
+        return sum(call.kwargs['hits'] for call in self.touch_session.call_args_list)
+
+    def test_first_hit_is_written_then_coalesced(self):
+        for _ in range(5):
+            self.tracker.touch('abc', user_id=7)
+        self.assertEqual(self.touch_session.call_count, 1)
+        self.assertEqual(self.written_hits(), 1)
+        self.assertEqual(self.touch_session.call_args.kwargs['user_id'], 7)
+
+    def test_idle_sessions_are_flushed(self):
+        for _ in range(3):
+            self.tracker.touch('abc')
+        # Not idle for an interval yet
+        self.assertEqual(self.tracker.flush_idle(), 0)
+
+        caches['default'].delete(f'{self.tracker.cache_prefix}persisted:abc')
+        with mock.patch('analytics.sessions.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(self.tracker.flush_idle(), 1)
+        self.assertEqual(self.written_hits(), 3)
+        # Nothing is left pending
+        self.assertEqual(self.tracker.flush_idle(force=True), 0)
+
+    def test_concurrent_hits_are_not_lost(self):
+        threads = [
+            threading.Thread(target=lambda: [self.tracker.touch('abc') for _ in range(50)])
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        caches['default'].delete(f'{self.tracker.cache_prefix}persisted:abc')
+        self.tracker.flush_idle(force=True)
+        self.assertEqual(self.written_hits(), 200)
+
+    def test_evicted_counter_does_not_fail_the_request(self):
+        self.tracker.touch('abc')
+        self.tracker.touch('abc')
+        caches['default'].delete(f'{self.tracker.cache_prefix}persisted:abc')
+        keys = self.tracker._keys('abc')
+        # The counter goes between the read and the decr
+        with mock.patch('analytics.sessions.cache.decr', side_effect=ValueError):
+            self.tracker._persist('abc', None, keys)
+        self.assertEqual(self.written_hits(), 2)
+
+    def test_hits_taken_by_another_writer_are_given_back(self):
+        self.tracker.touch('abc')
+        self.tracker.touch('abc')
+        keys = self.tracker._keys('abc')
+        cache = caches['default']
+        real_decr = cache.decr
+
+        def racing_decr(key, delta):
+            # Another writer takes the same hit first
+            real_decr(key, delta)
+            return real_decr(key, delta)
+
+        with mock.patch('analytics.sessions.cache.decr', side_effect=racing_decr):
+            self.tracker._persist('abc', None, keys)
+        self.assertEqual(self.written_hits(), 1)
+        self.assertEqual(cache.get(keys['hits']), 0)
+
+    @override_settings(ANALYTICS_BUFFER={'ASYNC': False})
+    def test_requests_flush_idle_sessions_without_the_thread(self):
+        for _ in range(8):
+            self.tracker.touch('abc')
+        self.assertEqual(self.written_hits(), 1)
+
+        # A request from anyone, an interval later, writes the idle session
+        with mock.patch('analytics.sessions.time.monotonic', return_value=time.monotonic() + 61):
+            caches['default'].delete(f'{self.tracker.cache_prefix}persisted:abc')
+            self.tracker.touch('other')
+        self.assertEqual(
+            sum(call.kwargs['hits'] for call in self.touch_session.call_args_list if call.args[0] == 'abc'),
+            8,
+        )
+
+    def test_shutdown_writes_sessions_whose_persist_key_is_held(self):
+        for _ in range(3):
+            self.tracker.touch('abc')
+        self.assertEqual(self.tracker.flush_idle(force=True), 1)
+        self.assertEqual(self.written_hits(), 3)
+
+    def test_new_visitors_get_a_cookie_not_a_django_session(self):
+        request = RequestFactory().get('/')
+        request.session = mock.Mock(session_key=None)
+        request.COOKIES = {}
+        self.assertEqual(self.tracker.get_session_id(request), '')
+
+        session_id = self.tracker.new_session_id()
+        response = HttpResponse()
+        patch_cache_control(response, public=True, s_maxage=300)
+        self.tracker.set_cookie(request, response, session_id)
+        self.assertEqual(response.cookies['analytics_sid'].value, session_id)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('public', response['Cache-Control'])
+        request.session.create.assert_not_called()
+
+        request.COOKIES = {'analytics_sid': session_id}
+        self.assertEqual(self.tracker.get_session_id(request), session_id)
+
+
+class LiveFeedTests(SimpleTestCase):
+    def setUp(self):
+        self.feed = LiveFeed()
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+        patcher = mock.patch('analytics.live._get_channel_layer', return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sent(self):
+        return [call.args[1]['data'] for call in self.layer.group_send.call_args_list]
+
+    def test_publishes_noted_titles_without_queries(self):
+        # SimpleTestCase fails any database query
+        self.feed.record('page_views', 3)
+        self.feed.record_offer(5, 2)
+        self.feed.note_title(5, 'Half price')
+        with mock.patch('analytics.live.time.monotonic', return_value=time.monotonic() + 10):
+            self.feed.publish()
+        [message] = self.sent()
+        self.assertEqual(message['page_views'], 3)
+        self.assertEqual(message['offers'], [{'id': '5', 'title': 'Half price', 'count': 2}])
+
+    def test_publishes_once_per_interval(self):
+        self.feed.record('page_views')
+        self.feed.publish()
+        self.assertEqual(self.sent(), [])
+        with mock.patch('analytics.live.time.monotonic', return_value=time.monotonic() + 10):
+            self.feed.publish()
+            self.feed.record('page_views')
+            self.feed.publish()
+        self.assertEqual(len(self.sent()), 1)
+
+    def test_flush_thread_leaves_an_in_memory_layer_to_consumers(self):
+        layer = InMemoryChannelLayer()
+        layer.group_send = mock.AsyncMock()
+        self.feed.record('page_views', 2)
+        with mock.patch('analytics.live._get_channel_layer', return_value=layer), \
+                mock.patch('analytics.live.time.monotonic', return_value=time.monotonic() + 10):
+            with self.assertLogs('analytics.live', 'WARNING') as logs:
+                self.feed.publish()
+                self.feed.publish()
+            self.assertEqual(len(logs.records), 1)
+            layer.group_send.assert_not_called()
+
+            # A consumer on the server loop still sends the deltas
+            async_to_sync(self.feed.apublish)()
+        self.assertEqual(layer.group_send.call_args.args[1]['data']['page_views'], 2)
+
+
+@override_settings(ANALYTICS_BUFFER={'ASYNC': True, 'MAX_QUEUE_SIZE': 2})
+class PageViewBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.buffer = PageViewBuffer()
+        patcher = mock.patch.object(self.buffer, 'ensure_started')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stats_count_dropped_items(self):
+        for _ in range(2):
+            self.buffer.record_activity(activity_type='subscribe')
+        with self.assertLogs('analytics.buffer', 'WARNING'):
+            self.buffer.record_activity(activity_type='subscribe')
+        self.buffer.record_activity(activity_type='subscribe')
+        self.assertEqual(self.buffer.stats(), {'queued': 2, 'flushed': 0, 'dropped': 2})
+
+    def test_forked_worker_starts_over(self):
+        self.buffer.record_activity(activity_type='subscribe')
+        lock = self.buffer._lock
+        with mock.patch('analytics.buffer.os.getpid', return_value=os.getpid() + 1):
+            # The parent writes what it had queued, the child only its own
+            self.assertEqual(self.buffer.qsize(), 0)
+            self.assertIsNot(self.buffer._lock, lock)
+            self.buffer.record_activity(activity_type='subscribe')
+            self.assertEqual(self.buffer.stats()['queued'], 1)
+
+
+def days_ago(days, hour=12):
+    day = timezone.localdate() - timedelta(days=days)
+    return timezone.make_aware(datetime.combine(day, dt_time(hour)))
+
+
+def add_page_views(path, timestamp, count=1, **fields):
+    route, _ = Route.objects.get_or_create(path=path)
+    PageView.objects.bulk_create([PageView(route=route, timestamp=timestamp, **fields) for _ in range(count)])
+
+
+class DimensionCacheTests(TestCase):
+    def test_ids_are_remembered_once_committed(self):
+        routes = DimensionCache('Route', 'path', lambda path, _: Route(path=path))
+        with self.captureOnCommitCallbacks(execute=False):
+            route_id = routes.resolve({'/a/': '/a/'})['/a/']
+        # Rolled back with the transaction; the next batch creates it again
+        Route.objects.filter(pk=route_id).delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            route_id = routes.resolve({'/a/': '/a/'})['/a/']
+        self.assertEqual(Route.objects.get(path='/a/').pk, route_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(routes.resolve({'/a/': '/a/'}), {'/a/': route_id})
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.offer = make_offer()
+        add_page_views('/a/', days_ago(3), 2, session_id='s1', country='DE')
+        add_page_views('/b/', days_ago(3), 1, session_id='s2', weight=10)
+        add_page_views('/a/', days_ago(1), 3, session_id='s1', country='FR')
+        for days in (3, 1, 1):
+            Event.objects.create(event_type='copy_code', data={'slug': self.offer.slug}, timestamp=days_ago(days))
+
+    def counts(self):
+        start = timezone.localdate() - timedelta(days=7)
+        return (
+            page_view_counts(start),
+            page_view_counts(start, 'path'),
+            page_view_counts(start, 'date'),
+            page_view_counts(start, 'country', path='/a/'),
+            event_counts(start, 'offer_id'),
+        )
+
+    def test_readers_agree_before_and_after_folding(self):
+        expected = (
+            15,
+            Counter({'/b/': 10, '/a/': 5}),
+            Counter({days_ago(3).date(): 12, days_ago(1).date(): 3}),
+            Counter({'FR': 3, 'DE': 2}),
+            Counter({self.offer.pk: 3}),
+        )
+        self.assertEqual(self.counts(), expected)
+        # Folded a few rows at a time, and then nothing left to fold
+        self.assertEqual(fold_page_views(chunk_size=2, lag=0), 15)
+        self.assertEqual(fold_events(chunk_size=2, lag=0), 3)
+        self.assertEqual(self.counts(), expected)
+        self.assertEqual((fold_page_views(lag=0), fold_events(lag=0)), (0, 0))
+
+    def test_watermark_moves_with_the_fold(self):
+        fold_page_views(lag=0)
+        self.assertEqual(get_watermark('page_views'), PageView.objects.latest('id').id)
+        # Later rows are folded on top of the existing rollups
+        add_page_views('/a/', days_ago(1), 2)
+        self.assertEqual(fold_page_views(lag=0), 2)
+        self.assertEqual(PageViewDaily.objects.get(date=days_ago(1).date(), path='/a/', country='FR').views, 3)
+        self.assertEqual(PageViewDaily.objects.filter(date=days_ago(1).date(), path='/a/').aggregate(
+            views=Sum('views'))['views'], 5)
+
+    def test_recent_rows_wait_out_the_lag(self):
+        fold_page_views(lag=0)
+        watermark = get_watermark('page_views')
+        add_page_views('/a/', timezone.now(), 4)
+        self.assertEqual(fold_page_views(lag=60), 0)
+        self.assertEqual(get_watermark('page_views'), watermark)
+        # Still counted from the raw rows meanwhile
+        self.assertEqual(page_view_counts(timezone.localdate() - timedelta(days=7)), 19)
+
+
+class HyperLogLogTests(SimpleTestCase):
+    def test_estimates_stay_within_the_error_bound(self):
+        for precision, n in ((14, 100000), (10, 20000)):
+            sketch = HyperLogLog(precision)
+            sketch.update(range(n))
+            # Three standard errors; the hash is fixed, so this is deterministic
+            self.assertLess(abs(sketch.count() - n) / n, 3 * sketch.standard_error, (precision, n))
+
+    def test_small_counts_are_near_exact(self):
+        sketch = HyperLogLog()
+        sketch.update(f'session-{i}' for i in range(200))
+        self.assertLessEqual(abs(sketch.count() - 200), 1)
+
+    def test_duplicates_and_merges(self):
+        a, b = HyperLogLog(12), HyperLogLog(12)
+        a.update(range(0, 6000))
+        b.update(range(4000, 10000))
+        union = HyperLogLog(12)
+        union.update(range(10000))
+        before = a.count()
+        a.update(range(0, 6000))
+        self.assertEqual(a.count(), before)
+        self.assertEqual(a.merge(b).registers, union.registers)
+
+    def test_round_trip_and_reduce(self):
+        sketch = HyperLogLog(14)
+        sketch.update(range(5000))
+        self.assertEqual(HyperLogLog.from_bytes(sketch.to_bytes()).registers, sketch.registers)
+
+        built_low = HyperLogLog(10)
+        built_low.update(range(5000))
+        self.assertEqual(sketch.reduce(10).registers, built_low.registers)
+        with self.assertRaises(ValueError):
+            sketch.merge(built_low)
+        with self.assertRaises(ValueError):
+            built_low.reduce(14)
+
+
+class UniqueCountsTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username='visitor')
+        add_page_views('/a/', days_ago(3), 2, session_id='s1', ip_address='10.0.0.1')
+        add_page_views('/a/', days_ago(3), 1, session_id='', ip_address='10.0.0.2')
+        add_page_views('/a/', days_ago(0, hour=0), 2, session_id='s2', user=user, ip_address='10.0.0.1')
+        add_page_views('/a/', timezone.now(), 1, session_id='s3', ip_address='10.0.0.3')
+
+    def sketch_queries(self, start_day):
+        with CaptureQueriesContext(connection) as queries:
+            counts = unique_counts(start_day)
+        return counts, [query for query in queries if 'analytics_visitorsketchdaily' in query['sql']]
+
+    def test_short_windows_are_exact(self):
+        counts, sketch_queries = self.sketch_queries(timezone.localdate())
+        self.assertEqual(counts, {'session': 2, 'user': 1, 'ip': 2})
+        self.assertEqual(sketch_queries, [])
+
+    def test_long_windows_merge_sketches_with_unfolded_rows(self):
+        start = timezone.localdate() - timedelta(days=7)
+        expected = {'session': 3, 'user': 1, 'ip': 3}
+        self.assertEqual(unique_counts(start), expected)
+
+        fold_page_views(lag=0)
+        # Folded days no longer need their raw rows
+        PageView.objects.filter(timestamp__lt=days_ago(0, hour=0)).delete()
+        counts, sketch_queries = self.sketch_queries(start)
+        self.assertEqual(counts, expected)
+        self.assertTrue(sketch_queries)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        add_page_views('/a/', days_ago(10), 3)
+        add_page_views('/a/', days_ago(9), 2)
+        fold_page_views(lag=0)
+        # Old but not folded yet
+        add_page_views('/a/', days_ago(9), 1)
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+
+    def archived_ids(self):
+        ids = []
+        for root, _, files in os.walk(self.archive_dir):
+            self.assertFalse([name for name in files if name.endswith('.tmp')])
+            for name in files:
+                with gzip.open(os.path.join(root, name), 'rt') as f:
+                    ids.extend(json.loads(line)['id'] for line in f)
+        return sorted(ids)
+
+    def test_resumes_after_a_partial_run(self):
+        folded = list(PageView.objects.order_by('id').values_list('id', flat=True)[:5])
+        cutoff = retention_cutoff(7)
+
+        # Stopped after the first chunk
+        chunks = archive_table('page_views', cutoff, self.archive_dir, chunk_size=2)
+        self.assertEqual(next(chunks), 2)
+        chunks.close()
+        # Killed between writing a chunk's files and deleting its rows
+        with mock.patch('analytics.archive.transaction.atomic', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                list(archive_table('page_views', cutoff, self.archive_dir, chunk_size=2))
+        self.assertEqual(PageView.objects.count(), 4)
+
+        self.assertEqual(list(archive_table('page_views', cutoff, self.archive_dir, chunk_size=2)), [2, 1])
+        # Every folded row is archived exactly once; the unfolded one stays
+        self.assertEqual(self.archived_ids(), folded)
+        self.assertEqual(PageView.objects.count(), 1)
+
+
+def reference_funnel(rows, offer_groups, n_groups):
+    """compute_funnel() one (session, offer) pair at a time."""
+    by_pair = {}
+    for session, offer, step, timestamp in rows:
+        if offer >= 0:
+            by_pair.setdefault((session, offer), []).append((step, timestamp))
+
+    reached = [[0] * len(FUNNEL_STEPS) for _ in range(n_groups)]
+    deltas = [[[] for _ in FUNNEL_STEPS[1:]] for _ in range(n_groups)]
+    for (session, offer), events in by_pair.items():
+        group = offer_groups[offer]
+        previous = None
+        for step in range(len(FUNNEL_STEPS)):
+            times = [t for s, t in events if s == step and (previous is None or t >= previous)]
+            if not times:
+                break
+            reached[group][step] += 1
+            if previous is not None:
+                deltas[group][step - 1].append(min(times) - previous)
+            previous = min(times)
+    medians = [[statistics.median(values) if values else None for values in group] for group in deltas]
+    return reached, medians
+
+
+class FunnelTests(TestCase):
+    def run_funnel(self, rows, offer_groups, n_groups):
+        columns = [np.array(column, dtype=dtype) for column, dtype in zip(
+            zip(*rows), (np.int64, np.int64, np.int8, np.float64))]
+        result = compute_funnel(*columns, np.array(offer_groups), n_groups)
+        medians = [[None if np.isnan(value) else value for value in group] for group in result['medians']]
+        return result['reached'].tolist(), medians
+
+    def test_hand_computed_funnel(self):
+        rows = [
+            # Session 0, offer 0: view, copy 10s later, use 30s after that
+            (0, 0, 0, 0), (0, 0, 1, 10), (0, 0, 2, 40),
+            # Session 0, offer 1: copied before viewing, so only viewed
+            (0, 1, 1, 5), (0, 1, 0, 20),
+            # Session 1, offer 0: out of order; first view 50, first copy
+            # after it 60, the use came before the copy
+            (1, 0, 0, 100), (1, 0, 0, 50), (1, 0, 1, 70), (1, 0, 1, 60), (1, 0, 2, 55),
+            # Session 1, offer 2: used without a view
+            (1, 2, 2, 10),
+            # Unknown offer
+            (2, -1, 0, 0),
+        ]
+        reached, medians = self.run_funnel(rows, [0, 1, 1], 2)
+        self.assertEqual(reached, [[2, 2, 1], [1, 0, 0]])
+        self.assertEqual(medians, [[10, 30], [None, None]])
+
+    def test_matches_the_reference_on_random_sessions(self):
+        rng = random.Random(7)
+        rows = [
+            (rng.randrange(40), rng.randrange(-1, 6), rng.randrange(3), rng.randrange(1000))
+            for _ in range(2000)
+        ]
+        offer_groups = [0, 1, 2, 0, 1, 2]
+        self.assertEqual(self.run_funnel(rows, offer_groups, 3), reference_funnel(rows, offer_groups, 3))
+
+    def test_report_from_page_views_and_events(self):
+        offer = make_offer()
+        path = f'/deals/{offer.store.slug}/{offer.slug}/'
+        add_page_views(path, days_ago(1), session_id='s1')
+        add_page_views(path, days_ago(1), session_id='s2')
+        add_page_views('/deals/', days_ago(1), session_id='s3')
+        for event_type, seconds in (('copy_code', 30), ('use_offer', 90)):
+            Event.objects.create(
+                event_type=event_type, session_id='s1', data={'slug': offer.slug},
+                timestamp=days_ago(1) + timedelta(seconds=seconds),
+            )
+
+        report = funnel_report(timezone.localdate() - timedelta(days=7))
+        self.assertEqual([row['label'] for row in report['rows']], ['Store'])
+        total = report['total']
+        self.assertEqual((total['viewed'], total['copied'], total['used']), (2, 1, 1))
+        self.assertEqual((total['view_to_copy'], total['overall']), (50, 50))
+        self.assertEqual((total['median_view_to_copy'], total['median_copy_to_use']), (30, 60))
+
+
+class RollupRebuildTests(TestCase):
+    def setUp(self):
+        add_page_views('/a/', days_ago(5), 3, session_id='s1')
+        add_page_views('/a/', days_ago(2), 2, session_id='s2')
+        add_page_views('/b/', days_ago(1), 4, session_id='s3')
+        fold_page_views(lag=0)
+        fold_events(lag=0)
+
+    def daily_views(self):
+        return dict(PageViewDaily.objects.values_list('date').annotate(views=Sum('views')).order_by())
+
+    def test_rebuild_without_archives_refolds_everything(self):
+        before = self.daily_views()
+        PageViewDaily.objects.update(views=0)
+        out = StringIO()
+        call_command('rollup_analytics', '--rebuild', '--lag=0', stdout=out)
+        self.assertIn('Rebuilt all rollups', out.getvalue())
+        self.assertEqual(self.daily_views(), before)
+        self.assertEqual(VisitorSketchDaily.objects.filter(dimension='session').count(), 3)
+
+    def test_rebuild_keeps_archived_days(self):
+        before = self.daily_views()
+        with tempfile.TemporaryDirectory() as archive_dir:
+            list(archive_table('page_views', retention_cutoff(3), archive_dir))
+        self.assertEqual(PageView.objects.count(), 6)
+
+        out = StringIO()
+        with override_settings(ANALYTICS_VISITOR_SKETCHES={'PRECISION': 10, 'EXACT_DAYS': 1}):
+            call_command('rollup_analytics', '--rebuild', '--lag=0', stdout=out)
+            # Old sketches of the archived day merge with the rebuilt ones
+            self.assertEqual(unique_counts(timezone.localdate() - timedelta(days=6))['session'], 3)
+
+        self.assertIn(f'Rebuilt rollups from {timezone.localdate() - timedelta(days=4)}', out.getvalue())
+        # The archived day's views survive the rebuild
+        self.assertEqual(self.daily_views(), before)
+        precisions = dict(
+            (date, HyperLogLog.from_bytes(sketch).precision)
+            for date, sketch in VisitorSketchDaily.objects.filter(dimension='session').values_list('date', 'sketch')
+        )
+        self.assertEqual(sorted(precisions.values()), [10, 10, 14])
+
+
+def make_offer(title='Half price', **fields):
+    user, _ = User.objects.get_or_create(username='owner')
+    store, _ = Store.objects.get_or_create(slug='store', defaults={'name': 'Store', 'website': 'http://store.example'})
+    category, _ = Category.objects.get_or_create(slug='category', defaults={'name': 'Category'})
+    return Coupon.objects.create(title=title, description='d', store=store, category=category, created_by=user, **fields)
+
+
+@override_settings(ANALYTICS_BUFFER={'ASYNC': True})
+class CounterEngineTests(TestCase):
+    def setUp(self):
+        self.offer = make_offer()
+        self.engine = CounterEngine()
+        patcher = mock.patch.object(page_view_buffer, 'ensure_started')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def counts(self):
+        return OfferAnalytics.objects.values('views', 'saves').get(offer=self.offer)
+
+    def test_deltas_are_coalesced_into_one_row(self):
+        for _ in range(3):
+            self.engine.incr('offer', self.offer.pk, 'views')
+        self.engine.incr('offer', self.offer.pk, 'saves', 2)
+        self.assertEqual(self.engine.flush(), 1)
+        self.assertEqual(self.counts(), {'views': 3, 'saves': 2})
+        self.assertEqual(self.engine.flush(), 0)
+
+    def test_flush_adds_to_concurrent_writes(self):
+        self.engine.incr('offer', self.offer.pk, 'views')
+        self.engine.flush()
+        # Another worker's flush lands in between
+        OfferAnalytics.objects.filter(offer=self.offer).update(views=10)
+        self.engine.incr('offer', self.offer.pk, 'views', 2)
+        self.engine.flush()
+        self.assertEqual(self.counts()['views'], 12)
+        self.assertEqual(OfferAnalytics.objects.filter(offer=self.offer).count(), 1)
+
+    def test_row_created_by_another_worker_is_added_to(self):
+        real_filter = OfferAnalytics.objects.filter
+        raced = []
+
+        def racing_filter(**key):
+            if raced:
+                return real_filter(**key)
+            raced.append(True)
+            # Our UPDATE finds no row, then the other worker's insert lands
+            OfferAnalytics.objects.create(offer=self.offer, views=5)
+            return OfferAnalytics.objects.none()
+
+        self.engine.incr('offer', self.offer.pk, 'views')
+        with mock.patch.object(OfferAnalytics.objects, 'filter', side_effect=racing_filter):
+            self.assertEqual(self.engine.flush(), 1)
+        self.assertEqual(self.counts()['views'], 6)
+
+    def test_store_deltas_reach_the_daily_table(self):
+        store_id = self.offer.store_id
+        self.engine.incr('store', store_id, 'views', 4)
+        self.engine.flush()
+        self.assertEqual(StoreAnalytics.objects.get(store_id=store_id).views, 4)
+        self.assertEqual(StoreDaily.objects.get(store_id=store_id, date=timezone.localdate()).views, 4)
+
+    def test_pending_deltas_are_merged_into_reads(self):
+        self.engine.incr('offer', self.offer.pk, 'views')
+        self.engine.flush()
+        self.engine.incr('offer', self.offer.pk, 'views', 2)
+
+        row = OfferAnalytics.objects.get(offer=self.offer)
+        values = OfferAnalytics.objects.values('offer_id', 'views').get(offer=self.offer)
+        self.engine.merge('offer', [row, values])
+        self.assertEqual((row.views, values['views']), (3, 3))
+        self.assertEqual(self.engine.get_counts('offer', self.offer.pk)['views'], 3)
+
+    def test_unknown_fields_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.engine.incr('offer', self.offer.pk, 'offer_clicks')
+
+
+@override_settings(ANALYTICS_BUFFER={'ASYNC': False})
+class IngestEventsTests(TestCase):
+    def setUp(self):
+        self.offer = make_offer()
+
+    def event(self, event_id, event_type='copy_code'):
+        return clean_event({'event_type': event_type, 'event_id': event_id, 'data': {'slug': self.offer.slug}})
+
+    def copies(self):
+        counter_engine.flush()
+        return OfferAnalytics.objects.get(offer=self.offer).code_copies
+
+    def test_duplicate_within_a_batch(self):
+        stored, duplicates = ingest_events([self.event('e1'), self.event('e1'), self.event('e2')])
+        self.assertEqual((stored, duplicates), (2, 1))
+        self.assertEqual(Event.objects.count(), 2)
+        self.assertEqual(self.copies(), 2)
+
+    def test_retried_batch(self):
+        self.assertEqual(ingest_events([self.event('e1'), self.event('e2')]), (2, 0))
+        # The client did not see the response and sends the batch again, with a new event
+        self.assertEqual(ingest_events([self.event('e1'), self.event('e2'), self.event('e3')]), (1, 2))
+        self.assertEqual(Event.objects.count(), 3)
+        self.assertEqual(self.copies(), 3)
+
+    def test_race_lost_to_another_request(self):
+        # Stored by a concurrent request after this one cleaned its batch
+        Event.objects.create(event_type='copy_code', client_event_id='e1', data={'slug': self.offer.slug})
+        self.assertEqual(ingest_events([self.event('e1'), self.event('e2')]), (1, 1))
+        self.assertEqual(self.copies(), 1)
+
+    def test_events_without_ids_are_always_stored(self):
+        self.assertEqual(ingest_events([self.event(None), self.event(None)]), (2, 0))
+        self.assertEqual(Event.objects.count(), 2)
+
+    def test_one_insert_per_batch(self):
+        with CaptureQueriesContext(connection) as queries:
+            ingest_events([self.event(f'e{i}', 'scroll') for i in range(20)])
+        inserts = [query for query in queries if query['sql'].startswith('INSERT') and '"analytics_event"' in query['sql']]
+        self.assertEqual(len(inserts), 1)
+
+    def test_retried_beacon_is_stored_once(self):
+        body = json.dumps([
+            {'event_type': 'copy_code', 'event_id': 'b1', 'data': {'slug': self.offer.slug}},
+            {'event_type': 'copy_code', 'event_id': 'b2', 'data': {'slug': self.offer.slug}},
+            {'event_type': 'copy_code', 'event_id': 'b1', 'data': {'slug': self.offer.slug}},
+        ])
+        url = reverse('analytics:track_events')
+        first = self.client.post(url, body, content_type='text/plain').json()
+        retry = self.client.post(url, body, content_type='text/plain').json()
+        self.assertEqual((first['stored'], first['duplicates']), (2, 1))
+        self.assertEqual((retry['stored'], retry['duplicates']), (0, 3))
+        self.assertEqual(self.copies(), 2)
+
+    def test_retried_single_event_is_stored_once(self):
+        body = json.dumps({'event_type': 'copy_code', 'event_id': 's1', 'data': {'slug': self.offer.slug}})
+        for _ in range(2):
+            response = self.client.post(reverse('analytics:track_event'), body, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(Event.objects.filter(client_event_id='s1').count(), 1)
+        self.assertEqual(self.copies(), 1)
+
+
+@override_settings(ANALYTICS_BUFFER={'ASYNC': False})
+class AnalyticsViewsTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+
+    def test_days_parameter_falls_back_and_is_clamped(self):
+        views = ('dashboard', 'store_analytics', 'category_analytics', 'funnel_analytics', 'user_analytics')
+        for name in views:
+            for days, expected in (('abc', 30), ('0', 1), ('-5', 1), ('100000', 365), ('7', 7)):
+                with self.subTest(view=name, days=days):
+                    response = self.client.get(reverse(f'analytics:{name}'), {'days': days})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response.context['days'], expected)
+
+    def test_offer_analytics_has_no_time_range(self):
+        make_offer()
+        response = self.client.get(reverse('analytics:offer_analytics'), {'days': 'abc'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'name="days"')
+
+
+class ExportTests(TestCase):
+    def test_csv_writes_json_and_iso_dates(self):
+        timestamp = timezone.make_aware(datetime(2026, 3, 1, 12, 30, 5))
+        Event.objects.create(event_type='copy_code', data={'slug': 't-1', 'position': 2}, timestamp=timestamp)
+        columns = ['event_type', 'data', 'timestamp', 'client_event_id']
+        body = b''.join(stream_export('events', timestamp.date(), timestamp.date(), columns)).decode()
+        [header, row] = list(csv.reader(io.StringIO(body)))
+        self.assertEqual(header, columns)
+        self.assertEqual(json.loads(row[1]), {'slug': 't-1', 'position': 2})
+        self.assertEqual(row[2], '2026-03-01T12:30:05Z')
+        self.assertEqual(row[3], '')
+
+    def test_csv_and_ndjson_agree(self):
+        timestamp = timezone.make_aware(datetime(2026, 3, 1, 12, 30, 5))
+        Event.objects.create(event_type='search', data={'q': 'shoes'}, timestamp=timestamp)
+        columns = ['data', 'timestamp']
+        csv_row = list(csv.reader(io.StringIO(
+            b''.join(stream_export('events', timestamp.date(), timestamp.date(), columns)).decode()
+        )))[1]
+        ndjson_row = json.loads(b''.join(stream_export('events', timestamp.date(), timestamp.date(), columns, 'ndjson')))
+        self.assertEqual(json.loads(csv_row[0]), ndjson_row['data'])
+        self.assertEqual(csv_row[1], ndjson_row['timestamp'])
+
+
+@override_settings(ANALYTICS_BUFFER={'ASYNC': False}, ANALYTICS_SAMPLING={'ENABLED': False})
+class ReconcileTests(TestCase):
+    def views_after(self, path):
+        response = self.client.get(path)
+        counter_engine.flush()
+        return response.status_code
+
+    def test_expired_offer_views_are_counted_on_both_sides(self):
+        live = make_offer('Live')
+        expired = make_offer('Gone', expiry_date=timezone.now() - timedelta(days=1))
+        self.assertEqual(self.views_after(live.get_absolute_url()), 200)
+        self.assertEqual(self.views_after(expired.get_absolute_url()), 410)
+        self.assertEqual(self.views_after(expired.get_absolute_url()), 410)
+
+        stored = dict(OfferAnalytics.objects.values_list('offer_id', 'views'))
+        self.assertEqual(stored, {live.pk: 1, expired.pk: 2})
+
+        truth = recompute_offer_counters(
+            [(live.pk, live.slug), (expired.pk, expired.slug)],
+            before=timezone.now() + timedelta(minutes=1),
+        )
+        self.assertEqual({pk: counts['views'] for pk, counts in truth.items()}, stored)
+
+    def test_missing_offer_page_is_not_counted(self):
+        offer = make_offer()
+        self.assertEqual(self.views_after(f'/deals/{offer.section}/missing-offer/'), 404)
+        self.assertFalse(OfferAnalytics.objects.filter(views__gt=0).exists())
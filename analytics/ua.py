@@ -0,0 +1,101 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import user_agents
+from django.conf import settings
+
+ParsedUserAgent = namedtuple('ParsedUserAgent', [
+    'browser', 'browser_version', 'operating_system', 'device_type',
+    'is_mobile', 'is_tablet', 'is_pc', 'is_bot',
+])
+
+EMPTY_USER_AGENT = ParsedUserAgent('', '', '', '', False, False, False, False)
+
+DEFAULT_UA_CACHE_SETTINGS = {
+    'MAX_SIZE': 5000,      # Distinct user agent strings kept in memory
+    'TTL': 60 * 60 * 24,   # Seconds before an entry is parsed again
+}
+
+
+class UserAgentCache:
+    """
+    Bounded LRU cache from raw user agent string to ParsedUserAgent.
+
+    user_agents.parse() runs a long list of regexes, while real traffic
+    only carries a few thousand distinct strings a day, so each one is
+    parsed once per TTL per process. Shared by the ingestion buffer and
+    the reparse command.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        conf = dict(DEFAULT_UA_CACHE_SETTINGS)
+        conf.update(getattr(settings, 'ANALYTICS_UA_CACHE', {}))
+        self.max_size = max_size or conf['MAX_SIZE']
+        self.ttl = ttl or conf['TTL']
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def parse(self, ua_string):
+        if not ua_string:
+            return EMPTY_USER_AGENT
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(ua_string)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(ua_string)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Parse outside the lock; a duplicate parse on a race is harmless
+        parsed = _parse(ua_string)
+
+        with self._lock:
+            self._entries[ua_string] = (parsed, now + self.ttl)
+            self._entries.move_to_end(ua_string)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return parsed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+def _parse(ua_string):
+    user_agent_obj = user_agents.parse(ua_string)
+    return ParsedUserAgent(
+        browser=user_agent_obj.browser.family[:100],
+        browser_version=user_agent_obj.browser.version_string[:50],
+        operating_system=user_agent_obj.os.family[:100],
+        device_type=(user_agent_obj.device.family or '')[:50],
+        is_mobile=user_agent_obj.is_mobile,
+        is_tablet=user_agent_obj.is_tablet,
+        is_pc=user_agent_obj.is_pc,
+        is_bot=user_agent_obj.is_bot,
+    )
+
+
+user_agent_cache = UserAgentCache()
+
+
+def parse_user_agent(ua_string):
+    return user_agent_cache.parse(ua_string)
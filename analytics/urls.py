@@ -9,5 +9,8 @@ urlpatterns = [
     path('stores/', views.store_analytics, name='store_analytics'),
     path('categories/', views.category_analytics, name='category_analytics'),
     path('users/', views.user_analytics, name='user_analytics'),
+    path('funnels/', views.funnel_analytics, name='funnel_analytics'),
+    path('export/<str:table>/', views.export_data, name='export_data'),
     path('track-event/', views.track_event, name='track_event'),
+    path('track-events/', views.track_events, name='track_events'),
 ]
\ No newline at end of file
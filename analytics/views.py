@@ -1,14 +1,34 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
-from django.db.models import Count, Sum, Avg, F, ExpressionWrapper, DurationField
+from django.db.models import Count, Sum, Avg, F, ExpressionWrapper, DurationField, Case, When, Value, FloatField
+from django.db.models import FilteredRelation, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Round
+from django.core.paginator import Paginator
 from django.utils import timezone
-from datetime import timedelta
+from datetime import date, timedelta
 from django.db.models.functions import TruncDate, TruncHour, TruncWeek, TruncMonth
-from .models import PageView, Event, Session, OfferAnalytics, StoreAnalytics, CategoryAnalytics, UserActivity
+from .models import PageView, Event, Session, OfferAnalytics, StoreAnalytics, CategoryAnalytics
+from .activity import active_users
+from .counters import counter_engine
+from .events import MAX_BATCH_SIZE, InvalidEvent, clean_event, ingest_events
+from .rollups import event_counts, headline_metrics, page_view_counts, window_start
+from coupons.hot_cache import get_or_build
+from .export import EXPORT_FORMATS, EXPORT_TABLES, clean_columns, stream_export
+from .funnels import FUNNEL_DIMENSIONS, funnel_report
 from coupons.models import Coupon, Store, Category
 import json
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+
+OFFER_ANALYTICS_PAGE_SIZE = 50
+ENTITY_ANALYTICS_PAGE_SIZE = 50
+MAX_WINDOW_DAYS = 365
+OFFER_SORT_FIELDS = ('views', 'saves', 'code_copies', 'uses', 'conversion_rate', 'title', 'store_name')
+
+# Dashboard numbers are memoized per `days` window, fresh for TTL seconds
+# and then served stale for up to STALE_TTL more while rebuilt
+DASHBOARD_CACHE_TTL = 60
+DASHBOARD_CACHE_STALE_TTL = 300
 
 def is_admin_user(user):
     return user.is_authenticated and user.is_staff
@@ -17,90 +37,81 @@ def is_admin_user(user):
 @user_passes_test(is_admin_user)
 def analytics_dashboard(request):
     # Get date range (default: last 30 days)
-    days = int(request.GET.get('days', 30))
+    days = _window_days(request)
+    
+    # Served from the cache and rebuilt in the background once stale
+    context = get_or_build(
+        f'analytics_dashboard:{days}',
+        lambda: build_dashboard_context(days),
+        DASHBOARD_CACHE_TTL,
+        DASHBOARD_CACHE_STALE_TTL,
+        background=True,
+    )
+    
+    return render(request, 'analytics/dashboard.html', context)
+
+def build_dashboard_context(days):
     end_date = timezone.now()
     start_date = end_date - timedelta(days=days)
     
-    # Basic metrics
-    total_page_views = PageView.objects.filter(timestamp__gte=start_date, timestamp__lte=end_date).count()
-    unique_visitors = PageView.objects.filter(timestamp__gte=start_date, timestamp__lte=end_date).values('session_id').distinct().count()
-    unique_users = PageView.objects.filter(timestamp__gte=start_date, timestamp__lte=end_date).exclude(user__isnull=True).values('user').distinct().count()
+    # Closed days come from the daily rollups; only today's rows are read raw
+    start_day = window_start(days)
+    
+    # Basic metrics and device split, in a single pass over the raw rows
+    headline = headline_metrics(start_day)
+    total_page_views = headline['total']
+    unique_visitors = headline['unique_visitors']
+    unique_users = headline['unique_users']
     
     # Page views by day
-    page_views_by_day = PageView.objects.filter(
-        timestamp__gte=start_date, 
-        timestamp__lte=end_date
-    ).annotate(
-        date=TruncDate('timestamp')
-    ).values('date').annotate(
-        count=Count('id')
-    ).order_by('date')
+    page_views_by_day = [
+        {'date': date, 'count': count}
+        for date, count in sorted(page_view_counts(start_day, 'date').items())
+    ]
     
     # Top pages
-    top_pages = PageView.objects.filter(
-        timestamp__gte=start_date, 
-        timestamp__lte=end_date
-    ).values('path').annotate(
-        count=Count('id')
-    ).order_by('-count')[:10]
+    top_pages = [
+        {'path': path, 'count': count}
+        for path, count in page_view_counts(start_day, 'path').most_common(10)
+    ]
     
     # Device types
     device_stats = {
-        'mobile': PageView.objects.filter(
-            timestamp__gte=start_date, 
-            timestamp__lte=end_date,
-            is_mobile=True
-        ).count(),
-        'tablet': PageView.objects.filter(
-            timestamp__gte=start_date, 
-            timestamp__lte=end_date,
-            is_tablet=True
-        ).count(),
-        'desktop': PageView.objects.filter(
-            timestamp__gte=start_date, 
-            timestamp__lte=end_date,
-            is_pc=True
-        ).count(),
+        'mobile': headline['mobile'],
+        'tablet': headline['tablet'],
+        'desktop': headline['desktop'],
     }
     
     # Browser stats
-    browser_stats = PageView.objects.filter(
-        timestamp__gte=start_date, 
-        timestamp__lte=end_date
-    ).exclude(browser__isnull=True).exclude(browser='').values('browser').annotate(
-        count=Count('id')
-    ).order_by('-count')[:10]
+    browser_stats = [
+        {'browser': browser, 'count': count}
+        for browser, count in page_view_counts(start_day, 'browser').most_common(11)
+        if browser
+    ][:10]
     
     # Event stats
-    event_stats = Event.objects.filter(
-        timestamp__gte=start_date, 
-        timestamp__lte=end_date
-    ).values('event_type').annotate(
-        count=Count('id')
-    ).order_by('-count')
-    
-    # Top offers (renamed from coupons)
-    top_offers = OfferAnalytics.objects.annotate(
+    event_stats = [
+        {'event_type': event_type, 'count': count}
+        for event_type, count in event_counts(start_day, 'event_type').most_common()
+    ]
+    
+    # Top offers (renamed from coupons), including counter deltas not flushed yet
+    top_offers = counter_engine.merge('offer', list(OfferAnalytics.objects.annotate(
         offer_title=F('offer__title')
-    ).order_by('-views')[:10]
+    ).order_by('-views')[:10]))
     
     # Top stores
-    top_stores = StoreAnalytics.objects.annotate(
+    top_stores = counter_engine.merge('store', list(StoreAnalytics.objects.annotate(
         store_name=F('store__name')
-    ).order_by('-views')[:10]
+    ).order_by('-views')[:10]))
     
     # Top categories
-    top_categories = CategoryAnalytics.objects.annotate(
+    top_categories = counter_engine.merge('category', list(CategoryAnalytics.objects.annotate(
         category_name=F('category__name')
-    ).order_by('-views')[:10]
+    ).order_by('-views')[:10]))
     
-    # User activity
-    active_users = UserActivity.objects.filter(
-        timestamp__gte=start_date, 
-        timestamp__lte=end_date
-    ).values('user__username').annotate(
-        activity_count=Count('id')
-    ).order_by('-activity_count')[:10]
+    # User activity: page views (from the rollups) plus semantic actions
+    most_active_users = active_users(start_day, limit=10)
     
     # Session stats
     avg_session_duration = Session.objects.filter(
@@ -144,113 +155,148 @@ def analytics_dashboard(request):
         'top_offers': top_offers,  # Renamed from top_coupons
         'top_stores': top_stores,
         'top_categories': top_categories,
-        'active_users': active_users,
+        'active_users': most_active_users,
         'avg_session_duration': avg_session_duration,
     }
     
-    return render(request, 'analytics/dashboard.html', context)
+    return context
 
 @login_required
 @user_passes_test(is_admin_user)
 def offer_analytics(request):  # Renamed from coupon_analytics
-    # Get date range (default: last 30 days)
-    days = int(request.GET.get('days', 30))
-    end_date = timezone.now()
-    start_date = end_date - timedelta(days=days)
+    # The figures are the lifetime counters; there is no per-offer daily
+    # rollup to window them by
+    
+    # Server-side sorting on an annotated column
+    sort = request.GET.get('sort', '-views')
+    if sort.lstrip('-') not in OFFER_SORT_FIELDS:
+        sort = '-views'
+    
+    # One LEFT JOIN over the analytics rows; offers without one count as zero
+    offers = Coupon.objects.annotate(
+        store_name=F('store__name'),
+        views=Coalesce(Sum('analytics__views'), 0),
+        saves=Coalesce(Sum('analytics__saves'), 0),
+        code_copies=Coalesce(Sum('analytics__code_copies'), 0),
+        uses=Coalesce(Sum('analytics__uses'), 0),
+    ).annotate(
+        conversion_rate=Case(
+            When(views__gt=0, then=Round(F('saves') * 100.0 / F('views'), 2)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+    )
     
-    # Get all offers with their analytics
-    offer_stats = []
-    offers = Coupon.objects.all()  # Still using Coupon model
+    store_slug = request.GET.get('store')
+    if store_slug:
+        offers = offers.filter(store__slug=store_slug)
+    category_slug = request.GET.get('category')
+    if category_slug:
+        offers = offers.filter(category__slug=category_slug)
     
-    for offer in offers:
-        try:
-            analytics = OfferAnalytics.objects.get(offer=offer)  # Changed from coupon to offer
-            stats = {
-                'id': offer.slug,
-                'title': offer.title,
-                'store': offer.store.name,
-                'views': analytics.views,
-                'saves': analytics.saves,
-                'code_copies': analytics.code_copies,
-                'uses': analytics.uses,
-                'conversion_rate': 0,
-            }
-            
-            # Calculate conversion rate (saves / views)
-            if stats['views'] > 0:
-                stats['conversion_rate'] = round((stats['saves'] / stats['views']) * 100, 2)
-            
-            offer_stats.append(stats)
-        except OfferAnalytics.DoesNotExist:  # Changed from CouponAnalytics
-            # If no analytics record exists, create one with default values
-            analytics = OfferAnalytics.objects.create(offer=offer)  # Changed from coupon to offer
-            stats = {
-                'id': offer.slug,
-                'title': offer.title,
-                'store': offer.store.name,
-                'views': 0,
-                'saves': 0,
-                'code_copies': 0,
-                'uses': 0,
-                'conversion_rate': 0,
-            }
-            offer_stats.append(stats)
-    
-    # Sort by views
-    offer_stats.sort(key=lambda x: x['views'], reverse=True)
+    offers = offers.order_by(sort, 'pk')
+    
+    paginator = Paginator(offers, OFFER_ANALYTICS_PAGE_SIZE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    
+    # Add counter deltas that have not been flushed yet to this page only
+    offer_stats = counter_engine.merge('offer', list(page_obj), id_attr='pk')
+    
+    # Filters and sorting carried over to the pagination links
+    params = request.GET.copy()
+    params.pop('page', None)
     
     context = {
-        'days': days,
         'offer_stats': offer_stats,  # Renamed from coupon_stats
+        'page_obj': page_obj,
+        'is_paginated': page_obj.has_other_pages(),
+        'querystring': params.urlencode(),
+        'sort': sort,
+        'store_slug': store_slug or '',
+        'category_slug': category_slug or '',
+        'stores': Store.objects.order_by('name').values('slug', 'name'),
+        'categories': Category.objects.order_by('name').values('slug', 'name'),
     }
     
     return render(request, 'analytics/offer_analytics.html', context)  # Updated template name
 
+def build_entity_stats(model, offer_fk, days, page_number):
+    """
+    One page of per-store or per-category stats for the `days` window:
+    views and offer clicks summed from the daily stats, CTR, and the
+    offers active at some point in the window.
+    """
+    end_date = timezone.now()
+    start_date = end_date - timedelta(days=days)
+    start_day = window_start(days)
+    
+    # Offers live at some point during the window
+    active_offers = Coupon.objects.filter(
+        **{offer_fk: OuterRef('pk')},
+        is_active=True,
+        start_date__lte=end_date,
+    ).filter(
+        Q(expiry_date__isnull=True) | Q(expiry_date__gte=start_date)
+    ).order_by().values(offer_fk).annotate(count=Count('pk')).values('count')
+    
+    # Only the window's daily rows are joined
+    stats = model.objects.annotate(
+        window_stats=FilteredRelation('daily_stats', condition=Q(daily_stats__date__gte=start_day)),
+    ).annotate(
+        views=Coalesce(Sum('window_stats__views'), 0),
+        offer_clicks=Coalesce(Sum('window_stats__offer_clicks'), 0),
+        offer_count=Coalesce(Subquery(active_offers), 0),
+    ).annotate(
+        ctr=Case(
+            When(views__gt=0, then=Round(F('offer_clicks') * 100.0 / F('views'), 2)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        )
+    ).values('id', 'slug', 'name', 'views', 'offer_clicks', 'offer_count', 'ctr').order_by('-views', 'name')
+    
+    paginator = Paginator(stats, ENTITY_ANALYTICS_PAGE_SIZE)
+    page_obj = paginator.get_page(page_number)
+    return {
+        'rows': list(page_obj),
+        'number': page_obj.number,
+        'num_pages': paginator.num_pages,
+        'count': paginator.count,
+    }
+
+def _window_days(request):
+    """The ?days= window, 30 by default, clamped to 1..MAX_WINDOW_DAYS."""
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        return 30
+    return min(max(days, 1), MAX_WINDOW_DAYS)
+
+def _page_number(request):
+    try:
+        return max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return 1
+
 @login_required
 @user_passes_test(is_admin_user)
 def store_analytics(request):
-    stores = Store.objects.all()
-    
     # Get date range (default: last 30 days)
-    days = int(request.GET.get('days', 30))
-    end_date = timezone.now()
-    start_date = end_date - timedelta(days=days)
-    
-    store_stats = []
-    for store in stores:
-        try:
-            analytics = StoreAnalytics.objects.get(store=store)
-            stats = {
-                'id': store.id,
-                'name': store.name,
-                'views': analytics.views,
-                'offer_clicks': analytics.offer_clicks,  # Changed from coupon_clicks
-                'offer_count': store.coupons.count(),  # Renamed from coupon_count
-            }
-            
-            # Calculate click-through rate
-            if stats['views'] > 0:
-                stats['ctr'] = round((stats['offer_clicks'] / stats['views']) * 100, 2)  # Changed from coupon_clicks
-            else:
-                stats['ctr'] = 0
-            
-            store_stats.append(stats)
-        except StoreAnalytics.DoesNotExist:
-            store_stats.append({
-                'id': store.id,
-                'name': store.name,
-                'views': 0,
-                'offer_clicks': 0,  # Changed from coupon_clicks
-                'offer_count': store.coupons.count(),  # Renamed from coupon_count
-                'ctr': 0,
-            })
-    
-    # Sort by views
-    store_stats.sort(key=lambda x: x['views'], reverse=True)
+    days = _window_days(request)
+    page_number = _page_number(request)
+    
+    # Cached per window and page
+    stats_page = get_or_build(
+        f'analytics_store_stats:{days}:{page_number}',
+        lambda: build_entity_stats(Store, 'store', days, page_number),
+        DASHBOARD_CACHE_TTL,
+        DASHBOARD_CACHE_STALE_TTL,
+        background=True,
+    )
     
     context = {
         'days': days,
-        'store_stats': store_stats,
+        'store_stats': stats_page['rows'],
+        'stats_page': stats_page,
     }
     
     return render(request, 'analytics/store_analytics.html', context)
@@ -258,67 +304,66 @@ def store_analytics(request):
 @login_required
 @user_passes_test(is_admin_user)
 def category_analytics(request):
-    categories = Category.objects.all()
-    
     # Get date range (default: last 30 days)
-    days = int(request.GET.get('days', 30))
-    end_date = timezone.now()
-    start_date = end_date - timedelta(days=days)
-    
-    category_stats = []
-    for category in categories:
-        try:
-            analytics = CategoryAnalytics.objects.get(category=category)
-            stats = {
-                'id': category.id,
-                'name': category.name,
-                'views': analytics.views,
-                'offer_clicks': analytics.offer_clicks,  # Changed from coupon_clicks
-                'offer_count': category.coupons.count(),  # Renamed from coupon_count
-            }
-            
-            # Calculate click-through rate
-            if stats['views'] > 0:
-                stats['ctr'] = round((stats['offer_clicks'] / stats['views']) * 100, 2)  # Changed from coupon_clicks
-            else:
-                stats['ctr'] = 0
-            
-            category_stats.append(stats)
-        except CategoryAnalytics.DoesNotExist:
-            category_stats.append({
-                'id': category.id,
-                'name': category.name,
-                'views': 0,
-                'offer_clicks': 0,  # Changed from coupon_clicks
-                'offer_count': category.coupons.count(),  # Renamed from coupon_count
-                'ctr': 0,
-            })
-    
-    # Sort by views
-    category_stats.sort(key=lambda x: x['views'], reverse=True)
+    days = _window_days(request)
+    page_number = _page_number(request)
+    
+    # Cached per window and page
+    stats_page = get_or_build(
+        f'analytics_category_stats:{days}:{page_number}',
+        lambda: build_entity_stats(Category, 'category', days, page_number),
+        DASHBOARD_CACHE_TTL,
+        DASHBOARD_CACHE_STALE_TTL,
+        background=True,
+    )
     
     context = {
         'days': days,
-        'category_stats': category_stats,
+        'category_stats': stats_page['rows'],
+        'stats_page': stats_page,
     }
     
     return render(request, 'analytics/category_analytics.html', context)
 
+@login_required
+@user_passes_test(is_admin_user)
+def funnel_analytics(request):
+    # Get date range (default: last 30 days)
+    days = _window_days(request)
+    dimension = request.GET.get('by', 'store')
+    if dimension not in FUNNEL_DIMENSIONS:
+        dimension = 'store'
+    
+    # Cached per window and grouping
+    report = get_or_build(
+        f'analytics_funnel:{days}:{dimension}',
+        lambda: funnel_report(window_start(days), dimension),
+        DASHBOARD_CACHE_TTL,
+        DASHBOARD_CACHE_STALE_TTL,
+        background=True,
+    )
+    
+    context = {
+        'days': days,
+        'dimension': dimension,
+        'dimension_label': FUNNEL_DIMENSIONS[dimension][0],
+        'dimensions': [(key, label) for key, (label, _) in FUNNEL_DIMENSIONS.items()],
+        'funnel_rows': report['rows'],
+        'funnel_total': report['total'],
+    }
+    
+    return render(request, 'analytics/funnel_analytics.html', context)
+
 @login_required
 @user_passes_test(is_admin_user)
 def user_analytics(request):
     # Get date range (default: last 30 days)
-    days = int(request.GET.get('days', 30))
+    days = _window_days(request)
     end_date = timezone.now()
     start_date = end_date - timedelta(days=days)
     
-    # User activity stats
-    user_activity = UserActivity.objects.filter(
-        timestamp__gte=start_date,
-        timestamp__lte=end_date
-    ).values('user__username', 'user__id').annotate(
-        activity_count=Count('id')
-    ).order_by('-activity_count')
+    # User activity stats, derived from page views and semantic actions
+    user_activity = active_users(window_start(days))
     
     # User session stats
     user_sessions = Session.objects.filter(
@@ -341,6 +386,57 @@ def user_analytics(request):
 
 from django.views.decorators.csrf import csrf_exempt
 
+@login_required
+@user_passes_test(is_admin_user)
+def export_data(request, table):
+    """
+    Stream raw PageView/Event/Session rows for a date range.
+    
+    ?start=YYYY-MM-DD&end=YYYY-MM-DD (inclusive, default: last 30 days),
+    ?format=csv|ndjson, ?columns=a,b,c and ?gzip=1.
+    """
+    if table not in EXPORT_TABLES:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Unknown table: {table}'
+        }, status=404)
+    
+    try:
+        end_day = date.fromisoformat(request.GET['end']) if request.GET.get('end') else timezone.localdate()
+        start_day = date.fromisoformat(request.GET['start']) if request.GET.get('start') else end_day - timedelta(days=30)
+    except ValueError:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'start and end must be YYYY-MM-DD dates'
+        }, status=400)
+    
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({
+            'status': 'error',
+            'message': f"format must be one of: {', '.join(EXPORT_FORMATS)}"
+        }, status=400)
+    
+    requested = [column.strip() for column in request.GET.get('columns', '').split(',') if column.strip()]
+    try:
+        columns = clean_columns(table, requested)
+    except ValueError as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': str(e)
+        }, status=400)
+    
+    compress = request.GET.get('gzip') in ('1', 'true')
+    filename = f'{table}-{start_day:%Y%m%d}-{end_day:%Y%m%d}.{fmt}' + ('.gz' if compress else '')
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    
+    response = StreamingHttpResponse(
+        stream_export(table, start_day, end_day, columns, fmt, compress),
+        content_type='application/gzip' if compress else content_type,
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
 @csrf_exempt
 def track_event(request):
     if request.method == 'POST':
@@ -355,94 +451,16 @@ def track_event(request):
                 }, status=400)
             
             # Validate required fields
-            if not isinstance(data, dict):
+            try:
+                event = clean_event(data)
+            except InvalidEvent as e:
                 return JsonResponse({
                     'status': 'error',
-                    'message': 'Invalid data format'
+                    'message': str(e)
                 }, status=400)
-                
-            event_type = data.get('event_type')
-            page = data.get('page', '')
-            element = data.get('element', '')
-            event_data = data.get('data', {})
-            
-            # Make sure event_data is a dictionary
-            if not isinstance(event_data, dict):
-                event_data = {}
-            
-            # Get session ID
-            session_id = getattr(request, 'analytics_session_id', '')
-            
-            # Create the event record
-            Event.objects.create(
-                user=request.user if request.user.is_authenticated else None,
-                session_id=session_id,
-                event_type=event_type,
-                page=page,
-                element=element,
-                data=event_data
-            )
             
-            # Update specific analytics based on event type
-            if event_type == 'copy_code':
-                slug = event_data.get('slug')
-                coupon_code = event_data.get('coupon_code')
-                
-                if slug:
-                    try:
-                        # Try to find coupon by ID
-                        try:
-                            import uuid
-                            uuid.UUID(slug)
-                            offer = Coupon.objects.get(slug=slug)
-                        except (ValueError, TypeError):
-                            # If not a valid UUID, try to find by code
-                            offer = Coupon.objects.get(code=slug)
-                        
-                        if offer:
-                            analytics, created = OfferAnalytics.objects.get_or_create(offer=offer)  # Changed from CouponAnalytics and coupon
-                            analytics.increment_code_copies()
-                    except Exception as e:
-                        print(f"Error updating offer analytics: {e}")
-            
-            # Handle other event types
-            elif event_type == 'save_offer':  # Changed from save_coupon
-                slug = event_data.get('slug')
-                if slug:
-                    try:
-                        # Try to find coupon by ID
-                        try:
-                            import uuid
-                            uuid.UUID(slug)
-                            offer = Coupon.objects.get(slug=slug)
-                        except (ValueError, TypeError):
-                            # If not a valid UUID, try to find by code
-                            offer = Coupon.objects.get(code=slug)
-                        
-                        if offer:
-                            analytics, created = OfferAnalytics.objects.get_or_create(offer=offer)  # Changed from CouponAnalytics and coupon
-                            analytics.increment_saves()
-                    except Exception as e:
-                        print(f"Error updating offer analytics: {e}")
-            
-            elif event_type == 'use_offer':  # Changed from use_coupon
-                slug = event_data.get('slug')
-                if slug:
-                    try:
-                        # Try to find coupon by ID
-                        try:
-                            import uuid
-                            uuid.UUID(slug)
-                            offer = Coupon.objects.get(slug=slug)
-                        except (ValueError, TypeError):
-                            # If not a valid UUID, try to find by code
-                            offer = Coupon.objects.get(code=slug)
-                        
-                        if offer:
-                            analytics, created = OfferAnalytics.objects.get_or_create(offer=offer)  # Changed from CouponAnalytics and coupon
-                            analytics.increment_uses()
-                    except Exception as e:
-                        print(f"Error updating offer analytics: {e}")
+            # Store the event and update offer analytics
+            ingest_events([event], request.user, getattr(request, 'analytics_session_id', ''))
             
             return JsonResponse({'status': 'success'})
         
@@ -455,4 +473,56 @@ def track_event(request):
     return JsonResponse({
         'status': 'error',
         'message': 'Invalid request method'
-    }, status=400)
\ No newline at end of file
+    }, status=400)
+
+@csrf_exempt
+def track_events(request):
+    """
+    Batch variant of track_event.
+    
+    Accepts a JSON array of events (or {"events": [...]}), including
+    navigator.sendBeacon payloads, which arrive as text/plain.
+    """
+    if request.method != 'POST':
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Invalid request method'
+        }, status=400)
+    
+    try:
+        payload = json.loads(request.body)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Invalid JSON: {str(e)}'
+        }, status=400)
+    
+    if isinstance(payload, dict):
+        payload = payload.get('events')
+    if not isinstance(payload, list):
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Expected a list of events'
+        }, status=400)
+    if len(payload) > MAX_BATCH_SIZE:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'At most {MAX_BATCH_SIZE} events per batch'
+        }, status=400)
+    
+    events = []
+    rejected = []
+    for index, raw in enumerate(payload):
+        try:
+            events.append(clean_event(raw))
+        except InvalidEvent as e:
+            rejected.append({'index': index, 'message': str(e)})
+    
+    stored, duplicates = ingest_events(events, request.user, getattr(request, 'analytics_session_id', ''))
+    
+    return JsonResponse({
+        'status': 'success',
+        'stored': stored,
+        'duplicates': duplicates,
+        'rejected': rejected,
+    })
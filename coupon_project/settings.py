@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sitemaps',  
     'rest_framework',
     'corsheaders',
+    'channels',
     'coupons',
     'analytics',
     'admin_panel',
@@ -55,6 +56,8 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'analytics.middleware.AnalyticsMiddleware',  
+    # Serves store and category pages from the page cache, last so analytics still sees hits
+    'coupons.page_cache.PageCacheMiddleware',
 ]
 
 ROOT_URLCONF = 'coupon_project.urls'
@@ -71,6 +74,8 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'coupons.context_processors.app_settings',
+                # Renders CSRF tokens as a placeholder in pages being page-cached
+                'coupons.page_cache.csrf_placeholder',
                 # 'coupons.context_processors.seo_data', 
             ],
         },
@@ -183,6 +188,21 @@ if cache_backend == 'django_redis.cache.RedisCache':
             }
         }
     }
+    
+    # Per-process LRU in front of Redis for hot keys, invalidated across
+    # workers through Redis pub/sub (see coupons/tiered_cache.py)
+    if os.environ.get('CACHE_L1', 'True').lower() == 'true':
+        CACHES['shared'] = CACHES['default']
+        CACHES['default'] = {
+            'BACKEND': 'coupons.tiered_cache.TwoTierCache',
+            'LOCATION': 'shared',
+            'OPTIONS': {
+                'BUS': 'redis',
+                'REDIS_URL': redis_url,
+                'L1_MAX_ENTRIES': int(os.environ.get('CACHE_L1_MAX_ENTRIES', 1000)),
+                'L1_TIMEOUT': int(os.environ.get('CACHE_L1_TIMEOUT', 5)),
+            }
+        }
 else:
     CACHES = {
         'default': {
@@ -198,6 +218,99 @@ CACHE_TIMEOUT = {
     'long': 60 * 60,      # 1 hour
 }
 
+# Analytics ingestion buffer (see analytics/buffer.py)
+ANALYTICS_BUFFER = {
+    'ASYNC': os.environ.get('ANALYTICS_BUFFER_ASYNC', 'True').lower() == 'true',
+    'FLUSH_INTERVAL_MS': int(os.environ.get('ANALYTICS_FLUSH_INTERVAL_MS', 500)),
+    'MAX_ROWS': int(os.environ.get('ANALYTICS_FLUSH_MAX_ROWS', 200)),
+    'MAX_QUEUE_SIZE': int(os.environ.get('ANALYTICS_MAX_QUEUE_SIZE', 10000)),
+}
+
+# Adaptive page view sampling under load (see analytics/sampling.py)
+ANALYTICS_SAMPLING = {
+    'ENABLED': os.environ.get('ANALYTICS_SAMPLING', 'True').lower() == 'true',
+    'TARGET_QUEUE_DEPTH': 1000,  # Smoothed buffer depth that still records every view
+    'WINDOW': 5.0,
+    'MAX_WEIGHT': 20,
+    'OVERRIDES': [
+        (r'^/deals/[^/]+/[^/]+/$', 1.0),  # Offer detail pages always recorded
+    ],
+}
+
+# Persist analytics.Session activity at most once per this many seconds per session
+ANALYTICS_SESSION_PERSIST_INTERVAL = int(os.environ.get('ANALYTICS_SESSION_PERSIST_INTERVAL', 60))
+# Cookie carrying the analytics session id (see analytics/sessions.py)
+ANALYTICS_SESSION_COOKIE = 'analytics_sid'
+
+# Per-process user agent parse cache (see analytics/ua.py)
+ANALYTICS_UA_CACHE = {
+    'MAX_SIZE': 5000,
+    'TTL': 60 * 60 * 24,  # 24 hours
+}
+
+# Local GeoIP enrichment of page views (see analytics/geoip.py). Point
+# ANALYTICS_GEOIP_DATABASE at a GeoLite2/GeoIP2 City or Country .mmdb file;
+# without it country and city are left blank.
+ANALYTICS_GEOIP = {
+    'DATABASE': os.environ.get('ANALYTICS_GEOIP_DATABASE'),
+    'CACHE_SIZE': 50000,  # IP prefixes (/24, /48) cached per process
+}
+
+# Per-process route / referer domain / user agent id caches (see analytics/dimensions.py)
+ANALYTICS_DIMENSION_CACHE = {
+    'MAX_SIZE': 20000,
+}
+
+# Daily HyperLogLog sketches for unique visitor counts (see analytics/hll.py).
+# After changing PRECISION, run `rollup_analytics --rebuild`. It only rebuilds
+# days whose raw rows were not archived yet; archived days keep their sketches
+# and windows over them are counted at the lower of the two precisions.
+ANALYTICS_VISITOR_SKETCHES = {
+    'PRECISION': 14,  # ~0.81% standard error, 16 KB per sketch
+    'EXACT_DAYS': 1,  # Windows this short are counted exactly
+}
+
+# Channels (live analytics feed). Without CHANNEL_REDIS_URL the in-memory
+# layer is used, which only works within a single process and only from
+# the server's event loop, so the analytics flush thread does not publish
+# to it (see analytics/live.py). Set CHANNEL_REDIS_URL in production.
+ASGI_APPLICATION = 'coupon_project.asgi.application'
+
+# Daphne replaces the runserver command with an ASGI server, which the live
+# feed's websocket needs in development. Off by default so runserver stays
+# Django's own; deployments run daphne/uvicorn directly either way.
+ASGI_RUNSERVER = os.environ.get('ASGI_RUNSERVER', 'False').lower() == 'true'
+if ASGI_RUNSERVER:
+    INSTALLED_APPS.insert(0, 'daphne')
+
+channel_redis_url = os.environ.get('CHANNEL_REDIS_URL')
+if channel_redis_url:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [channel_redis_url]},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        }
+    }
+
+# Live analytics feed (see analytics/live.py)
+ANALYTICS_LIVE_FEED = {
+    'ENABLED': os.environ.get('ANALYTICS_LIVE_FEED', 'True').lower() == 'true',
+    'INTERVAL': 1.0,
+    'TOP_OFFERS': 10,
+}
+
+# Raw analytics retention (see analytics/archive.py and `manage.py archive_analytics`)
+ANALYTICS_ARCHIVE = {
+    'DIR': os.environ.get('ANALYTICS_ARCHIVE_DIR', BASE_DIR / 'analytics_archive'),
+    'RETENTION_DAYS': int(os.environ.get('ANALYTICS_RETENTION_DAYS', 90)),
+}
+
 # App Settings
 APP_NAME = "CouPradise"
 APP_TAGLINE = "Discover Amazing Deals, Save Big Every Day"
@@ -10,4 +10,5 @@ class CouponsConfig(AppConfig):
         # Explicitly reference the signals to avoid "unused import" warnings
         coupons.signals.invalidate_coupon_cache
         coupons.signals.invalidate_store_cache
-        coupons.signals.invalidate_category_cache
\ No newline at end of file
+        coupons.signals.invalidate_category_cache
+        coupons.signals.invalidate_tag_cache
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+Generation-based cache keys.
+
+Cached values are keyed on a name plus the current generation of every
+scope they depend on: 'offers' for listings of all offers, 'store:<id>',
+'category:<id>', 'section:<name>' and 'tag:<id>' for filtered listings,
+and 'stores' / 'categories' for anything showing store or category
+details. Signal handlers bump the generations an edit touches, which
+makes every dependent key stale at once without knowing what was cached;
+stale entries are never read again and expire on their own timeout.
+
+Generations start at the current time in milliseconds rather than 0, so
+a counter evicted from the cache and recreated cannot reuse a generation
+older entries were stored under.
+"""
+import time
+
+from django.core.cache import cache
+
+GENERATION_PREFIX = 'generation:'
+
+
+def _initial_generation():
+    return int(time.time() * 1000)
+
+
+def get_generations(scopes):
+    """Current generation of each scope, as {scope: generation}."""
+    keys = {scope: GENERATION_PREFIX + scope for scope in scopes}
+    found = cache.get_many(list(keys.values()))
+
+    generations = {}
+    for scope, key in keys.items():
+        generation = found.get(key)
+        if generation is None:
+            generation = _initial_generation()
+            if not cache.add(key, generation, None):
+                # Another request created it first
+                generation = cache.get(key, generation)
+        generations[scope] = generation
+    return generations
+
+
+def bump(*scopes):
+    """Make every key depending on any of `scopes` stale."""
+    for scope in set(scopes):
+        key = GENERATION_PREFIX + scope
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Nothing was cached under this scope's current generation
+            cache.add(key, _initial_generation(), None)
+
+
+def cache_key(name, *scopes):
+    """`name` namespaced by the current generations of `scopes`."""
+    if not scopes:
+        return name
+    generations = get_generations(scopes)
+    return f"{name}:{'.'.join(str(generations[scope]) for scope in scopes)}"
@@ -0,0 +1,155 @@
+"""
+Stampede protection for hot cache entries.
+
+With plain cache.get/cache.set, every request that misses an expired
+entry such as the homepage listings, all_stores or a dashboard report
+runs the same queries at once. get_or_build() stores the value together
+with the time it goes stale and keeps it in the cache `stale_timeout`
+seconds longer:
+
+- Single flight: a per-key lock (cache.add) lets one request rebuild an
+  expired entry; the others keep serving the stale value meanwhile. The
+  rebuild runs inline, or on a background thread with background=True
+  for slow builders such as the analytics reports.
+- Probabilistic early refresh: a request may rebuild an entry shortly
+  before it goes stale, more likely the closer it is and the longer the
+  entry took to build (Vattani et al., "Optimal Probabilistic Cache
+  Stampede Prevention"), so hot entries are usually refreshed before any
+  request sees them expired.
+- Hard TTL: past `timeout + stale_timeout` an entry is never served, even
+  if the cache still holds it (e.g. in the TwoTierCache L1).
+
+A cold or hard-expired miss has nothing to serve, so it takes the same
+lock: its holder builds the entry while the other requests poll the cache
+for up to LOCK_WAIT seconds, and only build it themselves if that runs
+out (the holder is slow or died).
+
+Locks live under 'lock:' keys, which TwoTierCache keeps out of its L1, so
+taking one is a single round trip to the shared cache and publishes no
+invalidation.
+"""
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+STALE_TIMEOUT = 60
+LOCK_TIMEOUT = 30  # Seconds, frees the lock if its holder died mid-build
+LOCK_WAIT = 5  # Seconds a miss waits for another request's build
+POLL_INTERVAL = 0.05
+EARLY_REFRESH_BETA = 1.0  # Above 1 favours earlier refreshes
+
+
+def _lock_key(key):
+    return f'lock:{key}'
+
+
+def _acquire(key):
+    """Token of the rebuild lock for `key`, or None if it is held."""
+    token = uuid.uuid4().hex
+    return token if cache.add(_lock_key(key), token, LOCK_TIMEOUT) else None
+
+
+def _release(key, token):
+    # Past LOCK_TIMEOUT another request may hold the lock; leave theirs
+    if cache.get(_lock_key(key)) == token:
+        cache.delete(_lock_key(key))
+
+
+def _usable(entry, now):
+    return entry is not None and entry['hard_expires_at'] > now
+
+
+def _needs_refresh(entry, now):
+    # XFetch: refresh once now - delta * beta * ln(rand) passes the soft
+    # expiry, ln(rand) being negative
+    early = entry['delta'] * EARLY_REFRESH_BETA * math.log(1 - random.random())
+    return now - early >= entry['expires_at']
+
+
+def _build(key, builder, timeout, stale_timeout):
+    started = time.time()
+    value = builder()
+    now = time.time()
+    cache.set(key, {
+        'value': value,
+        'delta': now - started,
+        'expires_at': now + timeout,
+        'hard_expires_at': now + timeout + stale_timeout,
+    }, timeout + stale_timeout)
+    return value
+
+
+def _build_on_miss(key, builder, timeout, stale_timeout):
+    token = _acquire(key)
+    if token is None:
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(POLL_INTERVAL)
+            entry = cache.get(key)
+            if _usable(entry, time.time()):
+                return entry['value']
+        logger.warning('Gave up waiting for the build of %s', key)
+        return _build(key, builder, timeout, stale_timeout)
+
+    try:
+        # The previous holder may have stored it between our get and add
+        entry = cache.get(key)
+        if _usable(entry, time.time()):
+            return entry['value']
+        return _build(key, builder, timeout, stale_timeout)
+    finally:
+        _release(key, token)
+
+
+def _rebuild_in_background(key, builder, timeout, stale_timeout, token):
+    try:
+        _build(key, builder, timeout, stale_timeout)
+    except Exception:
+        logger.exception('Background rebuild of %s failed', key)
+    finally:
+        _release(key, token)
+        close_old_connections()
+
+
+def get_or_build(key, builder, timeout, stale_timeout=STALE_TIMEOUT, background=False):
+    """
+    Return the value cached under `key`, calling builder() to build it.
+    It is fresh for `timeout` seconds and then served stale for up to
+    `stale_timeout` more while one request rebuilds it, inline or, with
+    `background`, on a thread of its own.
+    """
+    entry = cache.get(key)
+    now = time.time()
+    if not _usable(entry, now):
+        return _build_on_miss(key, builder, timeout, stale_timeout)
+    if not _needs_refresh(entry, now):
+        return entry['value']
+
+    token = _acquire(key)
+    if token is None:
+        # Another request is rebuilding it
+        return entry['value']
+
+    if background:
+        threading.Thread(
+            target=_rebuild_in_background,
+            args=(key, builder, timeout, stale_timeout, token),
+            daemon=True,
+        ).start()
+        return entry['value']
+
+    try:
+        return _build(key, builder, timeout, stale_timeout)
+    except Exception:
+        logger.exception('Rebuilding %s failed, serving the stale value', key)
+        return entry['value']
+    finally:
+        _release(key, token)
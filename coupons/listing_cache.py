@@ -0,0 +1,185 @@
+"""
+Materialized offer listings.
+
+Listing views used to cache their QuerySets. Pickling a QuerySet stores
+every row of the whole listing as full model instances, which were
+unpickled on each request only to show twelve of them, and each card then
+loaded its store and category with two more queries.
+
+A listing page is now cached as one entry per (listing, filter, sort,
+page) holding the listing's total count and the compact card payloads of
+the offers on that page, in order. Rendering a page is a single cache
+read; building a missing page costs a COUNT and one select_related query
+whatever the number of cards. Pages go through hot_cache.get_or_build, so
+an expiring page is rebuilt by one request, not by all of them.
+"""
+import hashlib
+from types import SimpleNamespace
+
+from django.utils import timezone
+from django.utils.text import Truncator
+
+from .cache_keys import cache_key
+from .hot_cache import get_or_build
+
+LISTING_TIMEOUT = 60 * 5
+
+# Cards show store and category details, so every listing depends on them
+CARD_SCOPES = ('stores', 'categories')
+
+# offer_card.html shows at most this many words of the description, cut
+# the way its truncatewords filter does
+CARD_DESCRIPTION_WORDS = 15
+
+
+def offer_card(offer):
+    """Card payload for a Coupon loaded with its store and category."""
+    store = offer.store
+    return {
+        'id': offer.pk,
+        'slug': offer.slug,
+        'title': offer.title,
+        'description': Truncator(offer.description).words(CARD_DESCRIPTION_WORDS, truncate=' …'),
+        'code': offer.code,
+        'affiliate_link': offer.affiliate_link,
+        'coupon_type': offer.coupon_type,
+        'coupon_type_display': offer.get_coupon_type_display(),
+        'discount_display': offer.discount_display,
+        'section': offer.section,
+        'start_date': offer.start_date,
+        'expiry_date': offer.expiry_date,
+        'is_active': offer.is_active,
+        'is_featured': offer.is_featured,
+        'is_verified': offer.is_verified,
+        'store': {
+            'name': store.name,
+            'slug': store.slug,
+            'website': store.website,
+            'logo_url': store.logo.url if store.logo else '',
+        },
+        'category': {
+            'name': offer.category.name,
+            'slug': offer.category.slug,
+        },
+    }
+
+
+class OfferCard:
+    """Stands in for a Coupon in offer_card.html, built from a card payload."""
+
+    def __init__(self, card):
+        self.__dict__.update(card)
+        store = dict(card['store'])
+        logo_url = store.pop('logo_url')
+        self.store = SimpleNamespace(logo=SimpleNamespace(url=logo_url) if logo_url else None, **store)
+        self.category = SimpleNamespace(**card['category'])
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def is_expired(self):
+        # Computed when rendered, cards outlive the moment they were built
+        if self.expiry_date:
+            return timezone.now() > self.expiry_date
+        return False
+
+    def get_coupon_type_display(self):
+        return self.coupon_type_display
+
+    def get_absolute_url(self):
+        return f"/deals/{self.section}/{self.slug}/"
+
+
+def _page_number(page):
+    try:
+        return max(int(page), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+class OfferListing:
+    """
+    Sequence of OfferCards for an offer QuerySet that Paginator and the
+    templates accept in place of the QuerySet.
+
+    `name` identifies the listing with its filter and sort. With `per_page`
+    the listing is cached page by page and `page` is the page the request
+    asked for, so its count and cards come from the same entry; without it
+    the whole listing is one entry.
+
+    `scopes` are the cache generations (see cache_keys) the listing's
+    membership depends on, e.g. 'offers' or 'store:<id>'.
+    """
+
+    def __init__(self, name, queryset, scopes=('offers',), per_page=None, page=1, timeout=LISTING_TIMEOUT):
+        self.name = name
+        self.queryset = queryset
+        self.scopes = tuple(scopes) + CARD_SCOPES
+        self.per_page = per_page
+        self.page = _page_number(page) if per_page else 1
+        self.timeout = timeout
+        self._entries = {}
+        self._prefix = None
+
+    def cache_key(self, page):
+        if self._prefix is None:
+            digest = hashlib.md5(self.name.encode()).hexdigest()
+            # Generations are read once per listing, not per page
+            self._prefix = cache_key(f'offer_listing_{digest}', *self.scopes)
+        return f'{self._prefix}_{self.per_page or "all"}_{page}'
+
+    def _build(self, page):
+        offers = self.queryset.select_related('store', 'category')
+        if not self.per_page:
+            cards = [offer_card(offer) for offer in offers]
+            return {'count': len(cards), 'cards': cards}
+
+        count = self.queryset.count()
+        bottom = (page - 1) * self.per_page
+        if bottom >= count:
+            return {'count': count, 'cards': []}
+        return {
+            'count': count,
+            'cards': [offer_card(offer) for offer in offers[bottom:bottom + self.per_page]],
+        }
+
+    def _entry(self, page):
+        if page not in self._entries:
+            # One request rebuilds an expired page while the others serve it stale
+            self._entries[page] = get_or_build(self.cache_key(page), lambda: self._build(page), self.timeout)
+        return self._entries[page]
+
+    def _cards(self, start, stop):
+        if not self.per_page:
+            return self._entry(1)['cards'][start:stop]
+        # Paginator asks for one whole page, iteration walks them all
+        cards = []
+        page = start // self.per_page + 1
+        while start < stop:
+            bottom = (page - 1) * self.per_page
+            page_cards = self._entry(page)['cards'][start - bottom:stop - bottom]
+            if not page_cards:
+                break
+            cards.extend(page_cards)
+            start = bottom + self.per_page
+            page += 1
+        return cards
+
+    def __len__(self):
+        return self._entry(self.page)['count']
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return [OfferCard(card) for card in self._cards(start, stop)][::step]
+        if index < 0:
+            index += len(self)
+        cards = self[index:index + 1] if index >= 0 else []
+        if not cards:
+            raise IndexError('offer listing index out of range')
+        return cards[0]
+
+    def __iter__(self):
+        return iter(self[:len(self)])
@@ -0,0 +1,178 @@
+"""
+Full-page cache with surrogate-key purging.
+
+Views opt in with the page_cache decorator and tag what they rendered with
+add_surrogate_keys(): 'store:<slug>', 'category:<slug>', 'offer:<id>',
+'section:<name>', and 'stores' for pages listing stores. PageCacheMiddleware
+stores the rendered page for anonymous GET requests under the path and the
+query parameters the view declared, so tracking parameters do not split the
+cache. Each entry remembers the generation of its surrogate keys
+(coupons/cache_keys.py). purge() bumps those generations from the signal
+handlers, so every page tagged with a key is stale at once.
+
+Pages cached here are rendered with a placeholder instead of the visitor's
+CSRF token (see csrf_placeholder, a context processor). The middleware
+fills in the current visitor's token with get_token() on the way out, for
+fresh renders and cache hits alike. Pages holding a token are per-visitor
+for any other cache, so they are sent as Cache-Control: private. Token-free
+pages carry Surrogate-Key and s-maxage headers so an upstream proxy can
+cache them too; connecting to surrogate_keys_purged lets it be purged with
+the same keys.
+"""
+import hashlib
+
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.dispatch import Signal
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import patch_cache_control
+
+from analytics.context import get_tracked_target, track_target
+from .cache_keys import bump, get_generations
+
+# Sent with the purged keys, e.g. to forward purges to a CDN
+surrogate_keys_purged = Signal()
+
+CSRF_PLACEHOLDER = '__page_cache_csrf_token__'
+
+
+def page_cache(timeout, params=()):
+    """
+    Let PageCacheMiddleware cache a view for `timeout` seconds. `params`
+    are the query parameters the page depends on; others are ignored.
+    Works on function views and on view classes.
+    """
+    def decorator(view):
+        view.page_cache = {'timeout': timeout, 'params': tuple(params)}
+        return view
+    return decorator
+
+
+def add_surrogate_keys(request, *keys):
+    """Tag the page being rendered for `request` with surrogate keys."""
+    if not hasattr(request, 'surrogate_keys'):
+        request.surrogate_keys = set()
+    request.surrogate_keys.update(keys)
+
+
+def offer_surrogate_keys(offers):
+    """Surrogate keys for the offer cards a page shows."""
+    keys = set()
+    for offer in offers:
+        keys.update([f'offer:{offer.pk}', f'store:{offer.store.slug}', f'category:{offer.category.slug}'])
+    return keys
+
+
+def purge(*keys):
+    """Make every cached page tagged with any of `keys` stale."""
+    bump(*[f'page:{key}' for key in keys])
+    surrogate_keys_purged.send(sender=None, keys=set(keys))
+
+
+def csrf_placeholder(request):
+    """
+    Context processor rendering the CSRF token as a placeholder in pages
+    PageCacheMiddleware is about to store. Must come after Django's csrf
+    processor, which is always first.
+    """
+    if getattr(request, 'page_cache', None) is None:
+        return {}
+    return {'csrf_token': CSRF_PLACEHOLDER}
+
+
+def _page_generations(keys):
+    return get_generations([f'page:{key}' for key in sorted(keys)])
+
+
+def _view_config(view_func):
+    view = getattr(view_func, 'view_class', view_func)
+    return getattr(view, 'page_cache', None)
+
+
+def _page_key(request, params):
+    query = '&'.join(
+        f'{name}={value}'
+        for name in sorted(params)
+        for value in request.GET.getlist(name)
+    )
+    digest = hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+    return f'page_cache_{digest}'
+
+
+def _fill_csrf_token(request, response):
+    """Put the visitor's token in place of the placeholder; True if there was one."""
+    placeholder = CSRF_PLACEHOLDER.encode()
+    if placeholder not in response.content:
+        return False
+    response.content = response.content.replace(placeholder, get_token(request).encode())
+    return True
+
+
+def _cache_headers(response, keys, timeout, has_token):
+    if has_token:
+        # The token is this visitor's; no shared cache may keep the page
+        patch_cache_control(response, private=True, max_age=0)
+        return
+    if keys:
+        response['Surrogate-Key'] = ' '.join(sorted(keys))
+    # Browsers revalidate, shared caches keep the page until purged
+    patch_cache_control(response, public=True, max_age=0, s_maxage=timeout)
+
+
+class PageCacheMiddleware:
+    """
+    Serves and stores pages of views decorated with page_cache. Must come
+    after the CSRF, authentication and message middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        conf = getattr(request, 'page_cache', None)
+        if conf is None or response.streaming:
+            return response
+        response['X-Page-Cache'] = 'MISS'
+        keys = getattr(request, 'surrogate_keys', set())
+
+        # Only plain renders that show nothing specific to this visitor
+        cacheable = (
+            request.method == 'GET' and response.status_code == 200
+            and not response.cookies and not get_messages(request).used
+        )
+        if cacheable:
+            cache.set(conf['key'], {
+                'content': response.content,
+                'content_type': response['Content-Type'],
+                'keys': keys,
+                'generations': _page_generations(keys),
+                'tracked': get_tracked_target(request),
+            }, conf['timeout'])
+
+        has_token = _fill_csrf_token(request, response)
+        if response.status_code == 200:
+            _cache_headers(response, keys, conf['timeout'], has_token)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        conf = _view_config(view_func)
+        if conf is None or request.method not in ('GET', 'HEAD') or request.user.is_authenticated:
+            return None
+
+        key = _page_key(request, conf['params'])
+        entry = cache.get(key)
+        if entry is not None and entry['generations'] == _page_generations(entry['keys']):
+            # The view does not run, register what it showed for analytics
+            if entry['tracked'] is not None:
+                track_target(request, *entry['tracked'])
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+            response['X-Page-Cache'] = 'HIT'
+            has_token = _fill_csrf_token(request, response)
+            _cache_headers(response, entry['keys'], conf['timeout'], has_token)
+            return response
+
+        request.page_cache = {'key': key, 'timeout': conf['timeout']}
+        return None
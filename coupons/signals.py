@@ -1,47 +1,85 @@
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, m2m_changed
 from django.dispatch import receiver
-from django.core.cache import cache
-from .models import Coupon, Store, Category
+from .cache_keys import bump
+from .models import Coupon, Store, Category, Tag, HomePageSEO
+from .page_cache import purge
+
+def _coupon_scopes(store_id, category_id, section):
+    return ['offers', f'store:{store_id}', f'category:{category_id}', f'section:{section}']
+
+def _coupon_surrogate_keys(coupon):
+    return [f'offer:{coupon.pk}', f'store:{coupon.store.slug}', f'category:{coupon.category.slug}', f'section:{coupon.section}']
+
+@receiver(pre_save, sender=Coupon)
+def remember_coupon_scopes(sender, instance, **kwargs):
+    # An edit can move the offer to another store, category or section,
+    # whose listings must go stale as well
+    instance._previous_cache_scopes = []
+    instance._previous_surrogate_keys = []
+    if instance._state.adding:
+        return
+    try:
+        previous = Coupon.objects.select_related('store', 'category').only(
+            'store__slug', 'category__slug', 'is_special', 'source', 'coupon_type', 'expiry_date'
+        ).get(pk=instance.pk)
+    except Coupon.DoesNotExist:
+        return
+    instance._previous_cache_scopes = _coupon_scopes(previous.store_id, previous.category_id, previous.section)
+    instance._previous_surrogate_keys = _coupon_surrogate_keys(previous)
+
+@receiver(pre_delete, sender=Coupon)
+def remember_coupon_tags(sender, instance, **kwargs):
+    # The tag links are gone by the time post_delete runs
+    instance._cache_tag_ids = list(instance.tags.values_list('pk', flat=True))
 
 @receiver(post_save, sender=Coupon)
 @receiver(post_delete, sender=Coupon)
 def invalidate_coupon_cache(sender, instance, **kwargs):
-    # Invalidate homepage sections
-    cache.delete('homepage_featured_coupons')
-    cache.delete('homepage_expiring_soon')
-    cache.delete('homepage_latest_coupons')
-    cache.delete('homepage_stores')
-    cache.delete('homepage_categories')
-    
-    # Invalidate store page
-    cache.delete(f'store_detail_{instance.store.slug}')
-    
-    # Invalidate category page
-    cache.delete(f'category_detail_{instance.category.slug}')
-    
-    # Invalidate coupon detail page
-    cache.delete(f'coupon_detail_{instance.id}')
+    tag_ids = getattr(instance, '_cache_tag_ids', None)
+    if tag_ids is None:
+        tag_ids = instance.tags.values_list('pk', flat=True)
+    bump(
+        *_coupon_scopes(instance.store_id, instance.category_id, instance.section),
+        *getattr(instance, '_previous_cache_scopes', []),
+        *[f'tag:{tag_id}' for tag_id in tag_ids],
+    )
+    purge(*_coupon_surrogate_keys(instance), *getattr(instance, '_previous_surrogate_keys', []))
+
+@receiver(m2m_changed, sender=Coupon.tags.through)
+def invalidate_tag_listings(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # Remember the tags being removed for post_clear
+        if reverse:
+            instance._cleared_cache_scopes = [f'tag:{instance.pk}']
+        else:
+            instance._cleared_cache_scopes = [f'tag:{tag_id}' for tag_id in instance.tags.values_list('pk', flat=True)]
+    elif action == 'post_clear':
+        bump(*getattr(instance, '_cleared_cache_scopes', []))
+    elif action in ('post_add', 'post_remove'):
+        if reverse:
+            bump(f'tag:{instance.pk}')
+        else:
+            bump(*[f'tag:{tag_id}' for tag_id in pk_set])
 
 @receiver(post_save, sender=Store)
 @receiver(post_delete, sender=Store)
 def invalidate_store_cache(sender, instance, **kwargs):
-    # Invalidate store detail page
-    cache.delete(f'store_detail_{instance.slug}')
-    
-    # Invalidate homepage stores section
-    cache.delete('homepage_stores')
-    
-    # Invalidate all stores page
-    cache.delete('all_stores')
+    # Store details appear on offer cards everywhere, not only on its page
+    bump(f'store:{instance.pk}', 'stores')
+    purge(f'store:{instance.slug}', 'stores')
 
 @receiver(post_save, sender=Category)
 @receiver(post_delete, sender=Category)
 def invalidate_category_cache(sender, instance, **kwargs):
-    # Invalidate category detail page
-    cache.delete(f'category_detail_{instance.slug}')
-    
-    # Invalidate homepage categories section
-    cache.delete('homepage_categories')
-    
-    # Invalidate all categories page
-    cache.delete('all_categories')
\ No newline at end of file
+    bump(f'category:{instance.pk}', 'categories')
+    purge(f'category:{instance.slug}')
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tag_cache(sender, instance, **kwargs):
+    bump(f'tag:{instance.pk}')
+
+@receiver(post_save, sender=HomePageSEO)
+@receiver(post_delete, sender=HomePageSEO)
+def invalidate_homepage_seo_cache(sender, instance, **kwargs):
+    bump('homepage_seo')
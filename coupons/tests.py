@@ -1,3 +1,392 @@
-from django.test import TestCase
+import re
+import threading
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.paginator import Paginator
+from django.middleware.csrf import _does_token_match
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import hot_cache
+from .cache_keys import bump, get_generations
+from .listing_cache import OfferListing
+from .models import Category, Coupon, Store, Tag
+from .tiered_cache import LocalBus, LocalTier, TwoTierCache
+from .views import record_activity
+
+TIERED_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tier-default'},
+    'tier_l2': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tier-l2'},
+}
+
+
+class LocalTierTests(SimpleTestCase):
+    def test_evicts_least_recently_used(self):
+        tier = LocalTier(max_entries=2, timeout=60)
+        tier.set('a', 1)
+        tier.set('b', 2)
+        tier.get('a')
+        tier.set('c', 3)
+        self.assertEqual(tier.get('a'), 1)
+        self.assertIsNot(tier.get('c'), None)
+        self.assertEqual(tier.stats()['size'], 2)
+        self.assertNotEqual(tier.get('b'), 2)
+
+    def test_entries_expire(self):
+        tier = LocalTier(max_entries=10, timeout=5)
+        with mock.patch('coupons.tiered_cache.time.monotonic', return_value=100):
+            tier.set('a', 1)
+        with mock.patch('coupons.tiered_cache.time.monotonic', return_value=104):
+            self.assertEqual(tier.get('a'), 1)
+        with mock.patch('coupons.tiered_cache.time.monotonic', return_value=106):
+            self.assertNotEqual(tier.get('a'), 1)
+        self.assertEqual((tier.hits, tier.misses), (1, 1))
+
+
+@override_settings(CACHES=TIERED_CACHES)
+class TwoTierCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches['tier_l2'].clear()
+
+    def worker(self, **options):
+        # Each name gets its own L1 and bus origin, like a separate process
+        options = {'NAME': uuid.uuid4().hex, 'L1_TIMEOUT': 60, **options}
+        return TwoTierCache('tier_l2', {'OPTIONS': options})
+
+    def test_l1_serves_repeated_reads(self):
+        cache = self.worker()
+        cache.set('homepage_stores', ['a'])
+        self.assertEqual(cache.get('homepage_stores'), ['a'])
+        self.assertEqual(cache.get('homepage_stores'), ['a'])
+        stats = cache.stats()
+        self.assertEqual(stats['l1']['hits'], 1)
+        self.assertEqual(stats['l2']['hits'], 1)
+
+    def test_other_keys_skip_l1(self):
+        cache = self.worker()
+        cache.set('session_state', {'hits': 1})
+        cache.get('session_state')
+        cache.get('session_state')
+        self.assertEqual(cache.stats()['l1']['size'], 0)
+        self.assertEqual(cache.stats()['l2']['hits'], 2)
+
+    def test_writes_invalidate_other_workers(self):
+        first, second = self.worker(), self.worker()
+        first.set('homepage_stores', ['a'])
+        self.assertEqual(second.get('homepage_stores'), ['a'])
+
+        first.set('homepage_stores', ['b'])
+        self.assertEqual(second.get('homepage_stores'), ['b'])
+
+        first.set('generation:offers', 1)
+        self.assertEqual(second.get('generation:offers'), 1)
+        first.incr('generation:offers')
+        self.assertEqual(second.get('generation:offers'), 2)
+
+        first.delete('homepage_stores')
+        self.assertIsNone(second.get('homepage_stores'))
+
+    def test_clear_invalidates_other_workers(self):
+        first, second = self.worker(), self.worker()
+        first.set('homepage_stores', ['a'])
+        second.get('homepage_stores')
+        first.clear()
+        self.assertIsNone(second.get('homepage_stores'))
+
+    def test_add_does_not_publish(self):
+        cache = self.worker()
+        with mock.patch.object(LocalBus, 'publish') as publish:
+            self.assertTrue(cache.add('generation:stores', 1))
+            self.assertFalse(cache.add('generation:stores', 2))
+            cache.set('generation:stores', 3)
+        self.assertEqual(publish.call_count, 1)
+
+    def test_get_many(self):
+        first, second = self.worker(), self.worker()
+        first.set_many({'homepage_stores': ['a'], 'generation:offers': 5, 'other': 'o'})
+        self.assertEqual(
+            second.get_many(['homepage_stores', 'generation:offers', 'other', 'missing']),
+            {'homepage_stores': ['a'], 'generation:offers': 5, 'other': 'o'},
+        )
+        # The L1 keys are now local, the rest still come from L2
+        with mock.patch.object(caches['tier_l2'], 'get_many', wraps=caches['tier_l2'].get_many) as l2_get_many:
+            second.get_many(['homepage_stores', 'generation:offers', 'other'])
+        l2_get_many.assert_called_once_with(['other'], version=None)
+
+        first.set('homepage_stores', ['b'])
+        self.assertEqual(second.get_many(['homepage_stores']), {'homepage_stores': ['b']})
+
+    def test_invalidation_racing_a_read_is_not_cached(self):
+        first, second = self.worker(), self.worker()
+        first.set('homepage_stores', ['old'])
+        l2 = caches['tier_l2']
+        read = l2.get
+
+        def read_then_invalidate(*args, **kwargs):
+            # The value changes after second read it, before it fills its L1
+            value = read(*args, **kwargs)
+            first.set('homepage_stores', ['new'])
+            return value
+
+        with mock.patch.object(l2, 'get', side_effect=read_then_invalidate):
+            self.assertEqual(second.get('homepage_stores'), ['old'])
+        self.assertEqual(second.get('homepage_stores'), ['new'])
+
+
+class RecordActivityTests(SimpleTestCase):
+    def test_failures_are_logged_not_raised(self):
+        request = RequestFactory().post('/')
+        with mock.patch('analytics.activity.record_user_activity', side_effect=RuntimeError('buffer down')):
+            with self.assertLogs('coupons.views', 'ERROR') as logs:
+                record_activity(request, 'use_offer', 'Used "Half price"', slug='half-price')
+        self.assertIn('use_offer', logs.output[0])
+
+
+class GetOrBuildTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.calls = 0
+        self.calls_lock = threading.Lock()
+
+    def builder(self, value='built', delay=0.2):
+        def build():
+            with self.calls_lock:
+                self.calls += 1
+            time.sleep(delay)
+            return value
+        return build
+
+    def concurrently(self, target, count=8):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(target())) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_cold_miss_builds_once(self):
+        results = self.concurrently(lambda: hot_cache.get_or_build('hot', self.builder(), 60))
+        self.assertEqual(results, ['built'] * 8)
+        self.assertEqual(self.calls, 1)
+
+    def test_hard_expired_miss_builds_once(self):
+        hot_cache.get_or_build('hot', self.builder('old', delay=0), 60)
+        later = time.time() + 60 + hot_cache.STALE_TIMEOUT + 1
+        with mock.patch('coupons.hot_cache.time.time', return_value=later):
+            results = self.concurrently(lambda: hot_cache.get_or_build('hot', self.builder('new'), 60))
+        # The expired value is never served
+        self.assertEqual(results, ['new'] * 8)
+        self.assertEqual(self.calls, 2)
+
+    def later(self, seconds):
+        return mock.patch('coupons.hot_cache.time.time', return_value=time.time() + seconds)
+
+    def test_stale_value_is_served_while_one_request_rebuilds(self):
+        hot_cache.get_or_build('hot', self.builder('old', delay=0), 60)
+        building, finish = threading.Event(), threading.Event()
+
+        def slow_build():
+            building.set()
+            finish.wait(5)
+            return 'new'
+
+        results = []
+        holder = threading.Thread(target=lambda: results.append(hot_cache.get_or_build('hot', slow_build, 60)))
+        with self.later(61):
+            holder.start()
+            building.wait(5)
+            others = [hot_cache.get_or_build('hot', self.builder('other', delay=0), 60) for _ in range(7)]
+            finish.set()
+            holder.join()
+        self.assertEqual((results, others), (['new'], ['old'] * 7))
+        self.assertEqual(self.calls, 1)
+        self.assertIsNone(caches['default'].get('lock:hot'))
+
+    def test_early_refresh_before_the_entry_goes_stale(self):
+        hot_cache.get_or_build('hot', self.builder('old', delay=0), 60)
+        entry = caches['default'].get('hot')
+        entry['delta'] = 2
+        caches['default'].set('hot', entry)
+        with self.later(50):
+            # ln(1 - 0) = 0: no head start, still fresh
+            with mock.patch('coupons.hot_cache.random.random', return_value=0):
+                self.assertEqual(hot_cache.get_or_build('hot', self.builder('new', delay=0), 60), 'old')
+            # A draw whose head start of delta * -ln(1 - r) covers the 10s left
+            with mock.patch('coupons.hot_cache.random.random', return_value=1 - 1e-3):
+                self.assertEqual(hot_cache.get_or_build('hot', self.builder('new', delay=0), 60), 'new')
+        self.assertEqual(self.calls, 2)
+
+    def test_background_rebuild_serves_stale_at_once(self):
+        hot_cache.get_or_build('hot', self.builder('old', delay=0), 60)
+        with self.later(61), mock.patch('coupons.hot_cache.threading.Thread') as thread:
+            self.assertEqual(hot_cache.get_or_build('hot', self.builder('new'), 60, background=True), 'old')
+            target, args = thread.call_args.kwargs['target'], thread.call_args.kwargs['args']
+            target(*args)
+        self.assertEqual(caches['default'].get('hot')['value'], 'new')
+        self.assertIsNone(caches['default'].get('lock:hot'))
+
+    def test_failed_rebuild_serves_stale(self):
+        hot_cache.get_or_build('hot', self.builder('old', delay=0), 60)
+
+        def broken():
+            raise RuntimeError('database down')
+
+        with self.later(61), self.assertLogs('coupons.hot_cache', 'ERROR'):
+            self.assertEqual(hot_cache.get_or_build('hot', broken, 60), 'old')
+        self.assertIsNone(caches['default'].get('lock:hot'))
+
+    def test_waiters_build_when_the_holder_is_gone(self):
+        # A lock left behind by a request that died mid-build
+        caches['default'].add('lock:hot', 'dead', 30)
+        with mock.patch.object(hot_cache, 'LOCK_WAIT', 0.1), self.assertLogs('coupons.hot_cache', 'WARNING'):
+            self.assertEqual(hot_cache.get_or_build('hot', self.builder(delay=0), 60), 'built')
+        self.assertEqual(self.calls, 1)
+
+
+def make_offer(title, store_slug='store', category_slug='category', **fields):
+    user, _ = User.objects.get_or_create(username='owner')
+    store, _ = Store.objects.get_or_create(
+        slug=store_slug, defaults={'name': store_slug.title(), 'website': 'http://store.example'})
+    category, _ = Category.objects.get_or_create(slug=category_slug, defaults={'name': category_slug.title()})
+    return Coupon.objects.create(title=title, description='d', store=store, category=category, created_by=user, **fields)
+
+
+class OfferListingTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.offers = [make_offer(f'Offer {i}') for i in range(5)]
+
+    def listing(self, page=1):
+        return OfferListing('test', Coupon.objects.order_by('title'), per_page=2, page=page)
+
+    def titles(self, cards):
+        return [card.title for card in cards]
+
+    def test_warm_page_is_one_cache_read(self):
+        page = Paginator(self.listing(page=2), 2).page(2)
+        self.assertEqual(self.titles(page), ['Offer 2', 'Offer 3'])
+        with self.assertNumQueries(0):
+            page = Paginator(self.listing(page=2), 2).page(2)
+            self.assertEqual(page.paginator.count, 5)
+            self.assertEqual(self.titles(page), ['Offer 2', 'Offer 3'])
+
+    def test_iteration_walks_every_page(self):
+        self.assertEqual(self.titles(self.listing()), [f'Offer {i}' for i in range(5)])
+        self.assertEqual(self.listing()[-1].title, 'Offer 4')
+        with self.assertRaises(IndexError):
+            self.listing()[5]
+
+    def test_cards_stand_in_for_offers(self):
+        offer = self.offers[0]
+        Coupon.objects.filter(pk=offer.pk).update(expiry_date=timezone.now() + timedelta(seconds=1))
+        card = self.listing()[0]
+        self.assertEqual((card.pk, card.store.name, card.category.slug), (offer.pk, 'Store', 'category'))
+        self.assertEqual(card.get_absolute_url(), Coupon.objects.get(pk=offer.pk).get_absolute_url())
+        self.assertIsNone(card.store.logo)
+        self.assertFalse(card.is_expired)
+        # Expiry is checked when the card is shown, not when it was cached
+        with mock.patch('coupons.listing_cache.timezone.now', return_value=timezone.now() + timedelta(seconds=2)):
+            self.assertTrue(self.listing()[0].is_expired)
+
+
+class GenerationTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.offer = make_offer('Half price')
+        self.tag = Tag.objects.create(name='Shoes')
+
+    def bumped(self, action, *scopes):
+        """The subset of `scopes` whose generation `action` changed."""
+        before = get_generations(scopes)
+        action()
+        after = get_generations(scopes)
+        return {scope for scope in scopes if after[scope] != before[scope]}
+
+    def test_recreated_counter_does_not_reuse_a_generation(self):
+        first = get_generations(['offers'])['offers']
+        bump('offers')
+        caches['default'].delete('generation:offers')
+        with mock.patch('coupons.cache_keys.time.time', return_value=time.time() + 1):
+            self.assertGreater(get_generations(['offers'])['offers'], first + 1)
+
+    def test_offer_edit_bumps_old_and_new_scopes(self):
+        store, category = self.offer.store_id, self.offer.category_id
+        self.offer.store = Store.objects.create(name='Other', slug='other', website='http://other.example')
+        scopes = ('offers', f'store:{store}', f'store:{self.offer.store.pk}', f'category:{category}',
+                  f'section:{self.offer.section}', 'stores', f'tag:{self.tag.pk}')
+        self.assertEqual(
+            self.bumped(self.offer.save, *scopes),
+            {'offers', f'store:{store}', f'store:{self.offer.store.pk}', f'category:{category}',
+             f'section:{self.offer.section}'},
+        )
+
+    def test_tag_changes_bump_the_tag_from_either_side(self):
+        scope = f'tag:{self.tag.pk}'
+        self.assertEqual(self.bumped(lambda: self.offer.tags.add(self.tag), scope, 'offers'), {scope})
+        self.assertEqual(self.bumped(self.tag.offers.clear, scope, 'offers'), {scope})
+        self.offer.tags.add(self.tag)
+        # The links are gone by post_delete; the tag is still bumped
+        self.assertEqual(self.bumped(self.offer.delete, scope), {scope})
+
+    def test_store_rename_refreshes_cached_cards(self):
+        self.assertEqual(OfferListing('all', Coupon.objects.all())[0].store.name, 'Store')
+        store = self.offer.store
+        store.name = 'Renamed'
+        self.assertEqual(self.bumped(store.save, 'stores', f'store:{store.pk}', 'categories'),
+                         {'stores', f'store:{store.pk}'})
+        self.assertEqual(OfferListing('all', Coupon.objects.all())[0].store.name, 'Renamed')
+
+
+@override_settings(ANALYTICS_BUFFER={'ASYNC': False}, ANALYTICS_SAMPLING={'ENABLED': False})
+class PageCacheTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.offer = make_offer('Half price')
+        self.url = f'/store/{self.offer.store.slug}/'
+
+    def get(self, client=None, url=None):
+        return (client or self.client).get(url or self.url)
+
+    def page_token(self, response):
+        tokens = set(re.findall(rb'name="csrfmiddlewaretoken" value="([^"]+)"', response.content))
+        self.assertEqual(len(tokens), 1)
+        return tokens.pop().decode()
+
+    def test_hits_carry_each_visitors_csrf_token(self):
+        first = self.get()
+        self.assertEqual(first['X-Page-Cache'], 'MISS')
+        other = self.client_class()
+        hit = self.get(other)
+        self.assertEqual(hit['X-Page-Cache'], 'HIT')
+
+        for client, response in ((self.client, first), (other, hit)):
+            self.assertNotIn(b'__page_cache_csrf_token__', response.content)
+            secret = client.cookies['csrftoken'].value
+            self.assertTrue(_does_token_match(self.page_token(response), secret))
+            self.assertIn('private', response['Cache-Control'])
+        self.assertNotEqual(self.client.cookies['csrftoken'].value, other.cookies['csrftoken'].value)
+
+    def test_only_declared_params_split_the_cache(self):
+        self.get()
+        self.assertEqual(self.get(url=f'{self.url}?utm_source=mail')['X-Page-Cache'], 'HIT')
+        self.assertEqual(self.get(url=f'{self.url}?sort=oldest')['X-Page-Cache'], 'MISS')
+
+    def test_purged_when_the_store_changes(self):
+        self.get()
+        store = self.offer.store
+        store.name = 'Renamed'
+        store.save()
+        response = self.get()
+        self.assertEqual(response['X-Page-Cache'], 'MISS')
+        self.assertContains(response, 'Renamed')
+
+    def test_signed_in_visitors_bypass_the_cache(self):
+        self.get()
+        self.client.force_login(User.objects.get(username='owner'))
+        self.assertNotIn('X-Page-Cache', self.get())
@@ -0,0 +1,361 @@
+"""
+Two-tier cache backend.
+
+L1 is a per-process LRU in front of L2, the shared cache alias named by
+LOCATION (Redis in production). L1 entries live at most L1_TIMEOUT
+seconds and L1_MAX_ENTRIES bounds its size. L1 keeps the objects
+themselves, so a hit costs neither a round trip nor unpickling. Callers
+share those objects, so only keys starting with one of L1_KEY_PREFIXES
+(read-mostly values nobody mutates) use L1; everything else goes straight
+to L2.
+
+Writes go to L2 and drop the key from this process's L1, then the key is
+published on the invalidation bus so the other workers drop it too (not
+for a successful add(), as no worker can hold a key L2 did not have):
+'redis' uses pub/sub on REDIS_URL, 'local' connects the caches of a
+single process (runserver, tests). A lost message leaves a worker stale
+for at most L1_TIMEOUT seconds.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'coupons.tiered_cache.TwoTierCache',
+            'LOCATION': 'shared',
+            'OPTIONS': {'BUS': 'redis', 'REDIS_URL': redis_url},
+        },
+        'shared': {...},
+    }
+"""
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIER_OPTIONS = {
+    'L1_MAX_ENTRIES': 1000,
+    'L1_TIMEOUT': 5,  # Seconds, bounds staleness when an invalidation is lost
+    # Small, hot values; page cache bodies are large and written on every
+    # miss, so they stay L2-only
+    'L1_KEY_PREFIXES': [
+        'generation:', 'homepage_', 'offer_listing_',
+        'all_stores', 'all_categories', 'category_detail_',
+    ],
+    'BUS': 'local',
+    'REDIS_URL': None,
+    'CHANNEL': 'cache_invalidation',
+    'NAME': '',  # Gives caches over the same L2 separate L1s in one process
+}
+
+_MISSING = object()
+
+
+class LocalTier:
+    """Bounded LRU of (expires_at, value), keyed by the full cache key."""
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return _MISSING
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class LocalBus:
+    """Invalidation bus between the caches of one process."""
+
+    _subscribers = []
+    _lock = threading.Lock()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def publish(self, origin, keys):
+        for callback in list(self._subscribers):
+            callback(origin, keys)
+
+
+class RedisBus:
+    """Invalidation bus over Redis pub/sub, one listener thread per process."""
+
+    def __init__(self, url, channel):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured('The redis invalidation bus requires the redis package.')
+        if not url:
+            raise ImproperlyConfigured('The redis invalidation bus requires REDIS_URL.')
+        self._client = redis.Redis.from_url(url)
+        self.channel = channel
+
+    def subscribe(self, callback):
+        threading.Thread(target=self._listen, args=(callback,), daemon=True).start()
+
+    def _listen(self, callback):
+        while True:
+            try:
+                pubsub = self._client.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        # Confirms every (re)subscription, including the ones
+                        # redis-py makes by itself after a dropped connection;
+                        # messages may have been missed meanwhile
+                        callback(None, None)
+                    elif message['type'] == 'message':
+                        data = json.loads(message['data'])
+                        callback(data['origin'], data['keys'])
+            except Exception:
+                logger.exception('Cache invalidation listener failed, reconnecting')
+                callback(None, None)
+                time.sleep(1)
+
+    def publish(self, origin, keys):
+        try:
+            self._client.publish(self.channel, json.dumps({'origin': origin, 'keys': keys}))
+        except Exception:
+            logger.exception('Could not publish cache invalidation')
+
+
+class _TierState:
+    """Per-process L1, L2 counters and bus subscription of one cache."""
+
+    def __init__(self, options):
+        self.pid = os.getpid()
+        self.origin = uuid.uuid4().hex
+        self.l1 = LocalTier(options['L1_MAX_ENTRIES'], options['L1_TIMEOUT'])
+        self.l2_hits = 0
+        self.l2_misses = 0
+        # Bumped by every invalidation, so a read racing one is not kept
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+        if options['BUS'] == 'redis':
+            self.bus = RedisBus(options['REDIS_URL'], options['CHANNEL'])
+        elif options['BUS'] == 'local':
+            self.bus = LocalBus()
+        else:
+            raise ImproperlyConfigured(f"Unknown cache invalidation bus {options['BUS']!r}.")
+        self.bus.subscribe(self.receive)
+
+    def receive(self, origin, keys):
+        if origin == self.origin:
+            return
+        self.drop(keys)
+
+    def drop(self, keys):
+        """Drop `keys` from L1, or all of it when keys is None."""
+        with self.lock:
+            self.epoch += 1
+        if keys is None:
+            self.l1.clear()
+        else:
+            self.l1.delete(keys)
+
+    def record_l2(self, hits, misses):
+        with self.lock:
+            self.l2_hits += hits
+            self.l2_misses += misses
+
+
+# Like LocMemCache, state is per process and shared by the per-thread
+# backend instances Django creates
+_states = {}
+_states_lock = threading.Lock()
+
+
+class TwoTierCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._l2_alias = location
+        self._options = dict(DEFAULT_TIER_OPTIONS)
+        self._options.update(params.get('OPTIONS', {}))
+        self._prefixes = tuple(self._options['L1_KEY_PREFIXES'])
+        self._name = f"{location}:{self._options['NAME']}"
+
+    @property
+    def _state(self):
+        state = _states.get(self._name)
+        if state is None or state.pid != os.getpid():
+            # First use in this process (or after a fork)
+            with _states_lock:
+                state = _states.get(self._name)
+                if state is None or state.pid != os.getpid():
+                    state = _states[self._name] = _TierState(self._options)
+        return state
+
+    @property
+    def _l2(self):
+        return caches[self._l2_alias]
+
+    def _uses_l1(self, key):
+        return key.startswith(self._prefixes)
+
+    def _invalidate(self, keys, version=None, publish=True):
+        l1_keys = [self.make_key(key, version) for key in keys if self._uses_l1(key)]
+        if l1_keys:
+            state = self._state
+            state.drop(l1_keys)
+            if publish:
+                state.bus.publish(state.origin, l1_keys)
+
+    # Reads
+
+    def get(self, key, default=None, version=None):
+        state = self._state
+        if not self._uses_l1(key):
+            value = self._l2.get(key, _MISSING, version=version)
+            state.record_l2(value is not _MISSING, value is _MISSING)
+            return default if value is _MISSING else value
+
+        l1_key = self.make_key(key, version)
+        value = state.l1.get(l1_key)
+        if value is not _MISSING:
+            return value
+        epoch = state.epoch
+        value = self._l2.get(key, _MISSING, version=version)
+        state.record_l2(value is not _MISSING, value is _MISSING)
+        if value is _MISSING:
+            return default
+        if state.epoch == epoch:
+            state.l1.set(l1_key, value)
+        return value
+
+    def get_many(self, keys, version=None):
+        state = self._state
+        found = {}
+        l1_keys = {}
+        for key in keys:
+            if self._uses_l1(key):
+                l1_key = self.make_key(key, version)
+                value = state.l1.get(l1_key)
+                if value is not _MISSING:
+                    found[key] = value
+                    continue
+                l1_keys[key] = l1_key
+
+        missing = [key for key in keys if key not in found]
+        if missing:
+            epoch = state.epoch
+            from_l2 = self._l2.get_many(missing, version=version)
+            state.record_l2(len(from_l2), len(missing) - len(from_l2))
+            if state.epoch == epoch:
+                for key, value in from_l2.items():
+                    if key in l1_keys:
+                        state.l1.set(l1_keys[key], value)
+            found.update(from_l2)
+        return found
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    # Writes go to L2, then L1 copies everywhere are dropped
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self._l2.add(key, value, timeout, version=version)
+        if added:
+            # Other workers can only hold a copy if L2 lost the key within
+            # their L1_TIMEOUT
+            self._invalidate([key], version, publish=False)
+        return added
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._l2.set(key, value, timeout, version=version)
+        self._invalidate([key], version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self._l2.set_many(data, timeout, version=version)
+        self._invalidate(list(data), version)
+        return failed
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._l2.touch(key, timeout, version=version)
+
+    def delete(self, key, version=None):
+        deleted = self._l2.delete(key, version=version)
+        self._invalidate([key], version)
+        return deleted
+
+    def delete_many(self, keys, version=None):
+        self._l2.delete_many(keys, version=version)
+        self._invalidate(list(keys), version)
+
+    def incr(self, key, delta=1, version=None):
+        value = self._l2.incr(key, delta, version=version)
+        self._invalidate([key], version)
+        return value
+
+    def decr(self, key, delta=1, version=None):
+        value = self._l2.decr(key, delta, version=version)
+        self._invalidate([key], version)
+        return value
+
+    def clear(self):
+        self._l2.clear()
+        state = self._state
+        state.drop(None)
+        state.bus.publish(state.origin, None)
+
+    def close(self, **kwargs):
+        # The L2 alias is closed with the other caches
+        pass
+
+    def stats(self):
+        """Hit and miss counters per tier for this process."""
+        state = self._state
+        lookups = state.l2_hits + state.l2_misses
+        return {
+            'l1': state.l1.stats(),
+            'l2': {
+                'hits': state.l2_hits,
+                'misses': state.l2_misses,
+                'hit_rate': round(state.l2_hits / lookups, 4) if lookups else 0.0,
+            },
+        }
@@ -16,7 +16,7 @@ from django.conf import settings
 from django.views.decorators.http import require_POST
 from django.views.decorators.csrf import csrf_exempt
 from django.db.models import Count
-from rest_framework import viewsets
+from rest_framework import status, viewsets
 from rest_framework.permissions import IsAuthenticated
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters
@@ -26,6 +26,7 @@ from rest_framework.response import Response
 from django.contrib.admin.views.decorators import staff_member_required
 from django.utils import timezone
 import datetime
+import logging
 import requests
 from django.core.cache import cache
 from django.views.decorators.cache import cache_page
@@ -40,11 +41,26 @@ from .serializers import (
     StoreSerializer, CategorySerializer, UserOfferSerializer, OfferUsageSerializer
 )
 from .forms import NewsletterForm
+from analytics.context import track_object
+from .cache_keys import cache_key
+from .hot_cache import get_or_build
+from .listing_cache import OfferListing
+from .page_cache import page_cache, add_surrogate_keys, offer_surrogate_keys
 from .seo_utils import (
     get_meta_title, get_meta_description, get_breadcrumbs, 
     get_structured_data, get_open_graph_data, get_meta_keywords
 )
 
+logger = logging.getLogger(__name__)
+
+def record_activity(request, activity_type, description, **data):
+    """Record a user action for analytics; a failure never fails the request"""
+    try:
+        from analytics.activity import record_user_activity
+        record_user_activity(request, activity_type, description, **data)
+    except Exception:
+        logger.exception('Error recording %s user activity', activity_type)
+
 # API ViewSets
 class OfferViewSet(viewsets.ModelViewSet):
     queryset = Coupon.objects.filter(is_active=True)
@@ -64,18 +80,19 @@ class OfferViewSet(viewsets.ModelViewSet):
         serializer.save(created_by=self.request.user)
     
     @action(detail=True, methods=['post'])
-    def save_offer(self, request, slug=None):
+    def save_offer(self, request, pk=None):
         offer = self.get_object()
         user_offer, created = UserOffer.objects.get_or_create(
             user=request.user,
             offer=offer
         )
         if created:
+            record_activity(request, 'save_offer', f'Saved "{offer.title}"', slug=offer.slug)
             return Response({'status': 'offer saved'}, status=status.HTTP_201_CREATED)
         return Response({'status': 'offer already saved'}, status=status.HTTP_200_OK)
     
     @action(detail=True, methods=['post'])
-    def use_offer(self, request, slug=None):
+    def use_offer(self, request, pk=None):
         offer = self.get_object()
         
         # Check if offer is expired
@@ -100,6 +117,8 @@ class OfferViewSet(viewsets.ModelViewSet):
         # Mark as used if user saved it
         UserOffer.objects.filter(user=request.user, offer=offer).update(is_used=True)
         
+        record_activity(request, 'use_offer', f'Used "{offer.title}"', slug=offer.slug)
+        
         return Response({'status': 'offer used', 'code': offer.code}, status=status.HTTP_200_OK)
     
     @action(detail=False, methods=['get'])
@@ -218,13 +237,6 @@ class HomeView(ListView):
     paginate_by = 12
     
     def get_queryset(self):
-        # Try to get from cache first
-        cache_key = f'homepage_latest_offers_{self.request.GET.get("sort", "newest")}'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
         # Get sort parameter
         sort = self.request.GET.get('sort', 'newest')
         
@@ -243,45 +255,42 @@ class HomeView(ListView):
         else:  # newest
             offers = offers.order_by('-is_featured', '-created_at')
             
-        # Cache the queryset
-        cache.set(cache_key, offers, 60 * 5)  # Cache for 5 minutes
-            
-        return offers
+        # Cache the listing pages, not the queryset
+        return OfferListing(
+            f'homepage_latest_offers_{sort}', offers,
+            per_page=self.paginate_by, page=self.request.GET.get('page'),
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Try to get featured offers from cache
-        featured_offers = cache.get('homepage_featured_offers')
-        if featured_offers is None:
-            featured_offers = Coupon.objects.filter(
-                is_active=True,
-                is_featured=True
-            )[:6]
-            cache.set('homepage_featured_offers', featured_offers, 60 * 5)  # Cache for 5 minutes
+        # Featured and expiring soon offers are cached as card listings
+        featured_offers = OfferListing(
+            'homepage_featured_offers',
+            Coupon.objects.filter(is_active=True, is_featured=True)[:6]
+        )
         
-        # Try to get expiring soon offers from cache
-        expiring_soon = cache.get('homepage_expiring_soon')
-        if expiring_soon is None:
-            soon = timezone.now() + timezone.timedelta(days=7)
-            expiring_soon = Coupon.objects.filter(
+        soon = timezone.now() + timezone.timedelta(days=7)
+        expiring_soon = OfferListing(
+            'homepage_expiring_soon',
+            Coupon.objects.filter(
                 is_active=True,
                 expiry_date__lte=soon,
                 expiry_date__gte=timezone.now()
             )[:6]
-            cache.set('homepage_expiring_soon', expiring_soon, 60 * 5)  # Cache for 5 minutes
-        
-        # Try to get stores from cache
-        stores = cache.get('homepage_stores')
-        if stores is None:
-            stores = Store.objects.filter(is_active=True)[:10]
-            cache.set('homepage_stores', stores, 60 * 15)  # Cache for 15 minutes
+        )
         
-        # Try to get categories from cache
-        categories = cache.get('homepage_categories')
-        if categories is None:
-            categories = Category.objects.filter(is_active=True)
-            cache.set('homepage_categories', categories, 60 * 15)  # Cache for 15 minutes
+        # Stores and categories are cached for 15 minutes
+        stores = get_or_build(
+            cache_key('homepage_stores', 'stores'),
+            lambda: list(Store.objects.filter(is_active=True)[:10]),
+            60 * 15,
+        )
+        categories = get_or_build(
+            cache_key('homepage_categories', 'categories'),
+            lambda: list(Category.objects.filter(is_active=True)),
+            60 * 15,
+        )
         
         context['featured_offers'] = featured_offers
         context['expiring_soon'] = expiring_soon
@@ -291,7 +300,11 @@ class HomeView(ListView):
         
         # Get homepage SEO data
         try:
-            homepage_seo = HomePageSEO.objects.get()
+            homepage_seo = get_or_build(
+                cache_key('homepage_seo', 'homepage_seo'),
+                HomePageSEO.objects.get,
+                60 * 15,  # Cache for 15 minutes
+            )
             context['meta_title'] = homepage_seo.meta_title
             context['meta_description'] = homepage_seo.meta_description
             context['meta_keywords'] = homepage_seo.meta_keywords
@@ -370,6 +383,7 @@ class HomeView(ListView):
                 
         return context
 
+@page_cache(60 * 5, params=['sort', 'page'])
 def deal_section(request, section):
     """View for listing deals by section"""
     # Validate section
@@ -414,10 +428,15 @@ def deal_section(request, section):
     else:  # newest
         offers = offers.order_by('-created_at')
     
-    # Pagination
-    paginator = Paginator(offers, 12)
+    # Pagination over cached listing pages
     page_number = request.GET.get('page')
+    offers = OfferListing(
+        f'section_{section}_offers_{sort}', offers,
+        scopes=[f'section:{section}'], per_page=12, page=page_number
+    )
+    paginator = Paginator(offers, 12)
     page_obj = paginator.get_page(page_number)
+    add_surrogate_keys(request, f'section:{section}', *offer_surrogate_keys(page_obj))
     
     # Get section title
     section_titles = {
@@ -449,6 +468,9 @@ def deal_detail(request, section, slug):
         # Redirect to the correct section
         return redirect('deal_detail', section=offer.section, slug=slug)
     
+    # Let the analytics middleware count this view without re-fetching the offer
+    track_object(request, offer)
+    
     # Check if offer is expired
     if offer.is_expired:
         # Return 410 Gone status for expired offers
@@ -513,7 +535,7 @@ def legacy_coupon_redirect(request, slug):
     offer = get_object_or_404(Coupon, slug=slug)
     return redirect(offer.get_absolute_url(), permanent=True)
 
-@method_decorator(cache_page(60 * 15), name='dispatch')
+@page_cache(60 * 15, params=['sort'])
 class StoreDetailView(DetailView):
     model = Store
     template_name = 'store_detail.html'
@@ -523,35 +545,37 @@ class StoreDetailView(DetailView):
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        track_object(self.request, self.object)
         
         # Get sort parameter
         sort = self.request.GET.get('sort', 'newest')
         
-        # Try to get offers from cache
-        cache_key = f'store_{self.object.slug}_offers_{sort}'
-        offers = cache.get(cache_key)
+        # Base queryset
+        offers = Coupon.objects.filter(
+            store=self.object,
+            is_active=True
+        )
         
-        if offers is None:
-            # Base queryset
-            offers = Coupon.objects.filter(
-                store=self.object,
-                is_active=True
-            )
-            
-            # Apply sorting
-            if sort == 'expiring':
-                soon = timezone.now() + timezone.timedelta(days=7)
-                offers = offers.filter(expiry_date__lte=soon, expiry_date__gte=timezone.now()).order_by('expiry_date')
-            elif sort == 'popular':
-                offers = offers.order_by('-usage_count')
-            elif sort == 'discount_high':
-                offers = offers.order_by('-discount_value')
-            else:  # newest
-                offers = offers.order_by('-created_at')
-                
-            # Cache the offers
-            cache.set(cache_key, offers, 60 * 5)  # Cache for 5 minutes
+        # Apply sorting
+        if sort == 'expiring':
+            soon = timezone.now() + timezone.timedelta(days=7)
+            offers = offers.filter(expiry_date__lte=soon, expiry_date__gte=timezone.now()).order_by('expiry_date')
+        elif sort == 'popular':
+            offers = offers.order_by('-usage_count')
+        elif sort == 'discount_high':
+            offers = offers.order_by('-discount_value')
+        else:  # newest
+            offers = offers.order_by('-created_at')
             
+        # Cache the cards of the whole listing, not the queryset
+        offers = OfferListing(
+            f'store_{self.object.slug}_offers_{sort}', offers,
+            scopes=[f'store:{self.object.pk}']
+        )
+        
+        # Tag the cached page so edits purge it
+        add_surrogate_keys(self.request, f'store:{self.object.slug}', 'stores', *offer_surrogate_keys(offers))
+        
         context['offers'] = offers
         context['stores'] = Store.objects.filter(is_active=True)
         context['current_sort'] = sort
@@ -580,7 +604,7 @@ class StoreDetailView(DetailView):
         
         return context
 
-@method_decorator(cache_page(60 * 15), name='dispatch')
+@page_cache(60 * 15, params=['sort'])
 class CategoryDetailView(DetailView):
     model = Category
     template_name = 'category_detail.html'
@@ -589,51 +613,43 @@ class CategoryDetailView(DetailView):
     slug_url_kwarg = 'category_slug'
     
     def get_object(self, queryset=None):
-        # Try to get from cache first
-        cache_key = f'category_detail_{self.kwargs["category_slug"]}'
-        cached_object = cache.get(cache_key)
-        
-        if cached_object is not None:
-            return cached_object
-            
-        obj = super().get_object(queryset)
-        
-        # Cache the object
-        cache.set(cache_key, obj, 60 * 10)  # Cache for 10 minutes
-        
-        return obj
+        # Cached for 10 minutes
+        key = cache_key(f'category_detail_{self.kwargs["category_slug"]}', 'categories')
+        return get_or_build(key, lambda: super(CategoryDetailView, self).get_object(queryset), 60 * 10)
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        track_object(self.request, self.object)
         
         # Get sort parameter
         sort = self.request.GET.get('sort', 'newest')
         
-        # Try to get offers from cache
-        cache_key = f'category_{self.object.slug}_offers_{sort}'
-        offers = cache.get(cache_key)
+        # Base queryset
+        offers = Coupon.objects.filter(
+            category=self.object,
+            is_active=True
+        )
         
-        if offers is None:
-            # Base queryset
-            offers = Coupon.objects.filter(
-                category=self.object,
-                is_active=True
-            )
-            
-            # Apply sorting
-            if sort == 'expiring':
-                soon = timezone.now() + timezone.timedelta(days=7)
-                offers = offers.filter(expiry_date__lte=soon, expiry_date__gte=timezone.now()).order_by('expiry_date')
-            elif sort == 'popular':
-                offers = offers.order_by('-usage_count')
-            elif sort == 'discount_high':
-                offers = offers.order_by('-discount_value')
-            else:  # newest
-                offers = offers.order_by('-created_at')
-                
-            # Cache the offers
-            cache.set(cache_key, offers, 60 * 5)  # Cache for 5 minutes
+        # Apply sorting
+        if sort == 'expiring':
+            soon = timezone.now() + timezone.timedelta(days=7)
+            offers = offers.filter(expiry_date__lte=soon, expiry_date__gte=timezone.now()).order_by('expiry_date')
+        elif sort == 'popular':
+            offers = offers.order_by('-usage_count')
+        elif sort == 'discount_high':
+            offers = offers.order_by('-discount_value')
+        else:  # newest
+            offers = offers.order_by('-created_at')
             
+        # Cache the cards of the whole listing, not the queryset
+        offers = OfferListing(
+            f'category_{self.object.slug}_offers_{sort}', offers,
+            scopes=[f'category:{self.object.pk}']
+        )
+        
+        # Tag the cached page so edits purge it
+        add_surrogate_keys(self.request, f'category:{self.object.slug}', 'stores', *offer_surrogate_keys(offers))
+        
         context['offers'] = offers
         context['stores'] = Store.objects.filter(is_active=True)
         context['current_sort'] = sort
@@ -674,13 +690,6 @@ class SearchView(ListView):
         query = self.request.GET.get('q', '')
         sort = self.request.GET.get('sort', 'newest')
         
-        # Try to get from cache first
-        cache_key = f'search_{query}_{sort}'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
         # Base queryset - only active offers/deals
         offers = Coupon.objects.filter(is_active=True)
         
@@ -707,10 +716,11 @@ class SearchView(ListView):
         else:  # newest
             offers = offers.order_by('-is_featured', '-created_at')
             
-        # Cache the queryset
-        cache.set(cache_key, offers, 60 * 5)  # Cache for 5 minutes
-            
-        return offers
+        # Cache the listing pages, not the queryset
+        return OfferListing(
+            f'search_{query}_{sort}', offers,
+            per_page=self.paginate_by, page=self.request.GET.get('page'),
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -720,7 +730,7 @@ class SearchView(ListView):
         # Add search result count
         query = self.request.GET.get('q', '')
         if query:
-            context['search_results_count'] = self.get_queryset().count()
+            context['search_results_count'] = len(self.object_list)
         
         # Add SEO data
         context['meta_title'] = f"Search Results for '{query}' - CouPradise" if query else "Search Offers - CouPradise"
@@ -740,11 +750,11 @@ def save_offer(request, slug):
     if created:
         # Update analytics
         try:
-            from analytics.models import OfferAnalytics
-            analytics, created = OfferAnalytics.objects.get_or_create(offer=offer)
-            analytics.increment_saves()
+            from analytics.counters import counter_engine
+            counter_engine.incr('offer', offer.pk, 'saves')
         except Exception as e:
             print(f"Error updating offer analytics: {e}")
+        record_activity(request, 'save_offer', f'Saved "{offer.title}"', slug=offer.slug)
         
         messages.success(request, f'"{offer.title}" has been saved to your offers!')
     else:
@@ -780,6 +790,8 @@ def use_offer(request, slug):
     # Mark as used if user saved it
     UserOffer.objects.filter(user=request.user, offer=offer).update(is_used=True)
     
+    record_activity(request, 'use_offer', f'Used "{offer.title}"', slug=offer.slug)
+    
     messages.success(request, f'Offer code: {offer.code}')
     return redirect('deal_detail', section=offer.section, slug=offer.slug)
 
@@ -926,13 +938,6 @@ class AllOffersView(ListView):
         # Get sort parameter
         sort = self.request.GET.get('sort', 'newest')
         
-        # Try to get from cache first
-        cache_key = f'all_offers_{sort}'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
         # Base queryset
         offers = Coupon.objects.filter(is_active=True)
         
@@ -948,10 +953,11 @@ class AllOffersView(ListView):
         else:  # newest
             offers = offers.order_by('-is_featured', '-created_at')
             
-        # Cache the queryset
-        cache.set(cache_key, offers, 60 * 5)  # Cache for 5 minutes
-            
-        return offers
+        # Cache the listing pages, not the queryset
+        return OfferListing(
+            f'all_offers_{sort}', offers,
+            per_page=self.paginate_by, page=self.request.GET.get('page'),
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -991,13 +997,6 @@ class FeaturedOffersView(ListView):
         # Get sort parameter
         sort = self.request.GET.get('sort', 'newest')
         
-        # Try to get from cache first
-        cache_key = f'featured_offers_{sort}'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
         # Base queryset - only featured offers
         offers = Coupon.objects.filter(
             is_active=True,
@@ -1015,10 +1014,11 @@ class FeaturedOffersView(ListView):
         else:  # newest
             offers = offers.order_by('-created_at')
             
-        # Cache the queryset
-        cache.set(cache_key, offers, 60 * 5)  # Cache for 5 minutes
-            
-        return offers
+        # Cache the listing pages, not the queryset
+        return OfferListing(
+            f'featured_offers_{sort}', offers,
+            per_page=self.paginate_by, page=self.request.GET.get('page'),
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1058,13 +1058,6 @@ class ExpiringOffersView(ListView):
         # Get sort parameter
         sort = self.request.GET.get('sort', 'expiring')
         
-        # Try to get from cache first
-        cache_key = f'expiring_offers_{sort}'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
         # Base queryset - only offers expiring within 7 days
         soon = timezone.now() + timezone.timedelta(days=7)
         offers = Coupon.objects.filter(
@@ -1083,10 +1076,12 @@ class ExpiringOffersView(ListView):
         else:  # newest
             offers = offers.order_by('-created_at')
             
-        # Cache the queryset
-        cache.set(cache_key, offers, 60 * 3)  # Cache for 3 minutes (shorter for expiring offers)
-            
-        return offers
+        # Cache the listing pages, not the queryset
+        return OfferListing(
+            f'expiring_offers_{sort}', offers,
+            per_page=self.paginate_by, page=self.request.GET.get('page'),
+            timeout=60 * 3,  # Shorter for expiring offers
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1126,13 +1121,6 @@ class LatestOffersView(ListView):
         # Get sort parameter
         sort = self.request.GET.get('sort', 'newest')
         
-        # Try to get from cache first
-        cache_key = f'latest_offers_{sort}'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
         # Base queryset
         offers = Coupon.objects.filter(is_active=True)
         
@@ -1147,10 +1135,11 @@ class LatestOffersView(ListView):
         else:  # newest
             offers = offers.order_by('-created_at')
             
-        # Cache the queryset
-        cache.set(cache_key, offers, 60 * 5)  # Cache for 5 minutes
-            
-        return offers
+        # Cache the listing pages, not the queryset
+        return OfferListing(
+            f'latest_offers_{sort}', offers,
+            per_page=self.paginate_by, page=self.request.GET.get('page'),
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1187,19 +1176,9 @@ class AllStoresView(ListView):
     paginate_by = 12
     
     def get_queryset(self):
-        # Try to get from cache first
-        cache_key = 'all_stores'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
-        queryset = Store.objects.filter(is_active=True)
-        
-        # Cache the queryset
-        cache.set(cache_key, queryset, 60 * 10)  # Cache for 10 minutes
-            
-        return queryset
+        # Cached for 10 minutes, as a list so pages slice it without queries
+        key = cache_key('all_stores', 'stores')
+        return get_or_build(key, lambda: list(Store.objects.filter(is_active=True)), 60 * 10)
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1235,19 +1214,9 @@ class AllCategoriesView(ListView):
     paginate_by = 12
     
     def get_queryset(self):
-        # Try to get from cache first
-        cache_key = 'all_categories'
-        cached_queryset = cache.get(cache_key)
-        
-        if cached_queryset is not None:
-            return cached_queryset
-            
-        queryset = Category.objects.filter(is_active=True)
-        
-        # Cache the queryset
-        cache.set(cache_key, queryset, 60 * 10)  # Cache for 10 minutes
-            
-        return queryset
+        # Cached for 10 minutes, as a list so pages slice it without queries
+        key = cache_key('all_categories', 'categories')
+        return get_or_build(key, lambda: list(Category.objects.filter(is_active=True)), 60 * 10)
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1373,6 +1342,7 @@ def newsletter_subscribe(request):
                 # Reactivate subscription
                 subscriber.is_active = True
                 subscriber.save()
+                record_subscription(request)
                 
                 # Send reactivation email
                 send_subscription_email(email, "Welcome back to CouPradise!")
@@ -1384,6 +1354,7 @@ def newsletter_subscribe(request):
         
         # Create new subscriber
         subscriber = form.save()
+        record_subscription(request)
         
         # Send confirmation email
         send_subscription_email(email, "Welcome to CouPradise!")
@@ -1401,6 +1372,10 @@ def newsletter_subscribe(request):
             'errors': errors
         }, status=400)
 
+def record_subscription(request):
+    """Record a newsletter subscription in the visitor's activity"""
+    record_activity(request, 'subscribe', 'Subscribed to the newsletter')
+
 def send_subscription_email(email, subject):
     """Send subscription confirmation email"""
     try:
@@ -1654,8 +1629,12 @@ def tag_detail(request, tag_slug):
         is_active=True
     ).order_by('-created_at')
     
-    paginator = Paginator(offers, 12)
     page_number = request.GET.get('page')
+    offers = OfferListing(
+        f'tag_{tag.slug}_offers', offers,
+        scopes=[f'tag:{tag.pk}'], per_page=12, page=page_number
+    )
+    paginator = Paginator(offers, 12)
     page_obj = paginator.get_page(page_number)
     
     context = {
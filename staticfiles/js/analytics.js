@@ -105,52 +105,86 @@ copyButtons.forEach(button => {
 });
 
 // Function to track events
-// Function to track events
-// analytics.js
-// analytics.js
+// Events are queued and sent in batches; sendBeacon delivers the rest on page hide
+const EVENT_BATCH_URL = '/analytics/track-events/';
+const EVENT_BATCH_SIZE = 20;
+const EVENT_FLUSH_DELAY = 2000;
+const EVENT_RETRY_DELAY = 10000;
+let eventQueue = [];
+let eventFlushTimer = null;
+
+function generateEventId() {
+    if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+        return window.crypto.randomUUID();
+    }
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+}
+
 function trackEvent(eventType, page = '', element = '', eventData = {}) {
-    const data = {
+    eventQueue.push({
+        event_id: generateEventId(),
         event_type: eventType,
         page: page || window.location.pathname,
         element: element,
         data: eventData
-    };
+    });
+    
+    if (eventQueue.length >= EVENT_BATCH_SIZE) {
+        flushEvents();
+    } else if (!eventFlushTimer) {
+        eventFlushTimer = setTimeout(flushEvents, EVENT_FLUSH_DELAY);
+    }
+}
+
+function flushEvents(useBeacon = false) {
+    if (eventFlushTimer) {
+        clearTimeout(eventFlushTimer);
+        eventFlushTimer = null;
+    }
+    if (eventQueue.length === 0) {
+        return;
+    }
+    
+    const batch = eventQueue.splice(0, eventQueue.length);
+    const body = JSON.stringify(batch);
+    
+    if (useBeacon && navigator.sendBeacon && navigator.sendBeacon(EVENT_BATCH_URL, body)) {
+        return;
+    }
     
-    fetch('/analytics/track-event/', {
+    fetch(EVENT_BATCH_URL, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
             'X-CSRFToken': getCookie('csrftoken')
         },
-        body: JSON.stringify(data)
+        body: body,
+        keepalive: true
     })
     .then(response => {
-        // First check if the response is actually JSON
-        const contentType = response.headers.get('content-type');
-        if (!contentType || !contentType.includes('application/json')) {
-            throw new Error(`Expected JSON response, got ${contentType}`);
-        }
-        
-        if (!response.ok) {
+        if (response.status >= 500) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
-        return response.json();
-    })
-    .then(data => {
-        console.log('Event tracked successfully:', data);
     })
     .catch(error => {
-        console.error('Error tracking event:', error);
-        
-        // For debugging, log the response text
-        if (error.response) {
-            error.response.text().then(text => {
-                console.error('Response text:', text);
-            });
+        console.error('Error tracking events:', error);
+        // Re-queue network and server errors; event IDs make the retry idempotent
+        eventQueue = batch.concat(eventQueue);
+        if (!eventFlushTimer) {
+            eventFlushTimer = setTimeout(flushEvents, EVENT_RETRY_DELAY);
         }
     });
 }
 
+document.addEventListener('visibilitychange', function() {
+    if (document.visibilityState === 'hidden') {
+        flushEvents(true);
+    }
+});
+window.addEventListener('pagehide', function() {
+    flushEvents(true);
+});
+
 // Function to get CSRF token
 function getCookie(name) {
     let cookieValue = null;